@@ -9,8 +9,22 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
+from django.core.exceptions import ImproperlyConfigured
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "core.settings")
+# Servi en ASGI : les lectures du catalogue passent par les vues asynchrones
+os.environ.setdefault("CATALOG_ASYNC_VIEWS", "true")
+# Chaque requête ASGI a son propre thread : pas de connexions persistantes, la
+# réutilisation passe par le pool (DB_POOL_MAX_SIZE, PostgreSQL)
+os.environ.setdefault("DB_CONN_MAX_AGE", "0")
 
 application = get_asgi_application()
+
+persistent = [alias for alias, database in settings.DATABASES.items() if database.get("CONN_MAX_AGE")]
+if persistent:
+    raise ImproperlyConfigured(
+        f"Connexions persistantes impossibles en ASGI ({', '.join(persistent)}) : "
+        "DB_CONN_MAX_AGE doit valoir 0, utiliser DB_POOL_MAX_SIZE"
+    )
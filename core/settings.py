@@ -1,6 +1,9 @@
+import importlib.util
 import os
 from datetime import timedelta
 from pathlib import Path
+import dj_database_url
+from django.core.exceptions import ImproperlyConfigured
 from dotenv import load_dotenv
 
 PORT = int(os.environ.get("PORT", 8000))  # Par défaut, 8000 si non défini
@@ -32,12 +35,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'products.timing.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'products.replicas.PrimaryPinningMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -62,13 +67,115 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'core.wsgi.application'
 
+# Base de données : DATABASE_URL (PostgreSQL en production), SQLite locale sinon.
+# Les connexions sont conservées DB_CONN_MAX_AGE secondes entre les requêtes
+# et vérifiées avant réutilisation.
+DB_CONN_MAX_AGE = int(os.getenv('DB_CONN_MAX_AGE', 600))
+
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    'default': dj_database_url.config(
+        default=f"sqlite:///{BASE_DIR / 'db.sqlite3'}",
+        conn_max_age=DB_CONN_MAX_AGE,
+        conn_health_checks=True,
+    )
 }
 
+# Réplicas en lecture (voir products/replicas.py) : DATABASE_REPLICA_URLS, URLs
+# séparées par des virgules. En local, une copie du fichier SQLite suffit :
+# DATABASE_REPLICA_URLS=sqlite:///replica.sqlite3
+DATABASE_REPLICAS = []
+for index, url in enumerate(filter(None, os.getenv('DATABASE_REPLICA_URLS', '').split(',')), start=1):
+    alias = f'replica_{index}'
+    DATABASES[alias] = dj_database_url.parse(url.strip(), conn_max_age=DB_CONN_MAX_AGE, conn_health_checks=True)
+    # Les tests lisent la base de test principale au lieu d'en créer une
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['products.replicas.ReplicaRouter']
+# Retard maximal (secondes) au-delà duquel un réplica est écarté, et durée
+# pendant laquelle un client qui vient d'écrire lit la base principale
+DATABASE_REPLICA_MAX_LAG = float(os.getenv('DATABASE_REPLICA_MAX_LAG', 5))
+DATABASE_REPLICA_PIN_SECONDS = int(os.getenv('DATABASE_REPLICA_PIN_SECONDS', 10))
+
+for database in DATABASES.values():
+    if database['ENGINE'] == 'django.db.backends.postgresql':
+        database.setdefault('OPTIONS', {}).update({
+            'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', 5)),
+        })
+        if os.getenv('DB_STATEMENT_TIMEOUT'):
+            database['OPTIONS']['options'] = f"-c statement_timeout={os.getenv('DB_STATEMENT_TIMEOUT')}"
+        if os.getenv('DB_POOL_MAX_SIZE'):
+            # Pool de connexions intégré (psycopg 3 avec l'extra [pool]) ; incompatible
+            # avec les connexions persistantes, qu'il remplace
+            if importlib.util.find_spec('psycopg_pool') is None:
+                raise ImproperlyConfigured("DB_POOL_MAX_SIZE exige psycopg[pool] (pip install 'psycopg[binary,pool]')")
+            database['CONN_MAX_AGE'] = 0
+            database['OPTIONS']['pool'] = {
+                'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 2)),
+                'max_size': int(os.getenv('DB_POOL_MAX_SIZE')),
+                'timeout': int(os.getenv('DB_POOL_TIMEOUT', 10)),
+            }
+    elif database['ENGINE'] == 'django.db.backends.sqlite3':
+        # WAL : les lectures ne sont plus bloquées par l'écriture d'une commande.
+        # Transactions IMMEDIATE : le verrou d'écriture est pris au BEGIN, un
+        # écrivain concurrent attend alors busy_timeout au lieu d'échouer.
+        database.setdefault('OPTIONS', {}).update({
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': int(os.getenv('DB_SQLITE_BUSY_TIMEOUT', 20)),
+            'init_command': ';'.join([
+                'PRAGMA journal_mode=WAL',
+                'PRAGMA synchronous=NORMAL',
+                f"PRAGMA mmap_size={int(os.getenv('DB_SQLITE_MMAP_SIZE', 256 * 1024 * 1024))}",
+                'PRAGMA temp_store=MEMORY',
+                'PRAGMA cache_size=-20000',
+            ]),
+        })
+
+# Cache partagé (Redis, paquet redis requis) si REDIS_URL est défini,
+# mémoire locale sinon (développement, tests)
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_URL'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Cache des réponses du catalogue (voir products/cache.py)
+CATALOG_CACHE_ENABLED = os.getenv('CATALOG_CACHE_ENABLED', 'true').lower() == 'true'
+CATALOG_CACHE_TIMEOUT = int(os.getenv('CATALOG_CACHE_TIMEOUT', 300))
+
+# Lectures du catalogue par les vues asynchrones de products/async_views.py ;
+# activé par défaut quand le projet est servi par core.asgi
+CATALOG_ASYNC_VIEWS = os.getenv('CATALOG_ASYNC_VIEWS', 'false').lower() == 'true'
+
+# Lectures du catalogue et des commandes sérialisées par projection values()
+# (products/compiled.py) plutôt que par les ModelSerializer
+CATALOG_COMPILED_SERIALIZERS = os.getenv('CATALOG_COMPILED_SERIALIZERS', 'true').lower() == 'true'
+
+# Mesures par requête (products/timing.py) : en-tête Server-Timing, et journal
+# des requêtes plus longues que SLOW_REQUEST_MS (0 : désactivé)
+REQUEST_TIMING = os.getenv('REQUEST_TIMING', 'false').lower() == 'true'
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', 0))
+SLOW_REQUEST_QUERIES = int(os.getenv('SLOW_REQUEST_QUERIES', 5))
+
+# Métriques Prometheus servies par /metrics (products/metrics.py), désactivées
+# par défaut ; sous gunicorn, PROMETHEUS_MULTIPROC_DIR est défini par
+# gunicorn.conf.py. /metrics n'est servi qu'au personnel connecté ou avec
+# « Authorization: Bearer <METRICS_TOKEN> »
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'false').lower() == 'true'
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Export des commandes (products/views.py) : les commandes créées depuis moins de
+# ORDER_EXPORT_SAFETY_LAG secondes sont laissées à l'export suivant
+ORDER_EXPORT_SAFETY_LAG = int(os.getenv('ORDER_EXPORT_SAFETY_LAG', 60))
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -105,6 +212,20 @@ STATICFILES_FINDERS = [
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Déclinaisons des images du catalogue (voir products/renditions.py)
+IMAGE_RENDITION_WIDTHS = (320, 640, 960, 1280)
+
+# File de tâches en base exécutée par run_worker (voir products/queue.py)
+TASK_ALWAYS_EAGER = os.getenv('TASK_ALWAYS_EAGER', 'false').lower() == 'true'
+TASK_RETRY_BACKOFF = int(os.getenv('TASK_RETRY_BACKOFF', 10))
+# Une tâche sans signal de son worker depuis TASK_TIMEOUT secondes est remise en file
+TASK_HEARTBEAT_INTERVAL = int(os.getenv('TASK_HEARTBEAT_INTERVAL', 30))
+TASK_TIMEOUT = int(os.getenv('TASK_TIMEOUT', 120))
+TASK_RETENTION_DAYS = int(os.getenv('TASK_RETENTION_DAYS', 7))
+
+EMAIL_BACKEND = os.getenv('EMAIL_BACKEND', 'django.core.mail.backends.console.EmailBackend')
+DEFAULT_FROM_EMAIL = os.getenv('DEFAULT_FROM_EMAIL', 'boutique@localhost')
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
@@ -115,6 +236,15 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.AllowAny',
     ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'products.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'products.renderers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10,
     'DEFAULT_FILTER_BACKENDS': [
@@ -151,4 +281,5 @@ CORS_ALLOW_HEADERS = [
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
+    'idempotency-key',
 ]
@@ -0,0 +1,30 @@
+"""
+Configuration gunicorn, lue d'office depuis la racine du projet.
+
+Les workers partagent le répertoire PROMETHEUS_MULTIPROC_DIR où chacun écrit
+ses métriques ; /metrics les agrège (voir products/metrics.py).
+"""
+import glob
+import os
+import tempfile
+
+# Défini avant tout import de prometheus_client, et hérité par les workers
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'prometheus-multiproc'))
+
+
+def on_starting(server):
+    # Les valeurs d'une exécution précédente ne doivent pas être agrégées
+    directory = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, '*.db')):
+        os.remove(path)
+
+
+def post_worker_init(worker):
+    from products import metrics
+    metrics.worker_started()
+
+
+def child_exit(server, worker):
+    from products import metrics
+    metrics.worker_exited(worker.pid)
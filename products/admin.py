@@ -1,5 +1,53 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.contrib import admin
-from .models import Category, Product, ProductImage, Review, Wishlist
+from django.contrib import messages
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Count, F, FloatField
+from django.db.models.functions import Cast, NullIf
+from django.utils.functional import cached_property
+from django.utils import timezone
+from .models import Category, Product, ProductImage, Review, Task, Wishlist
+from .pagination import approximate_count
+from .queue import get_stats
+from .replicas import replica_reads
+from .search import get_search_backend
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginateur des grandes tables : au-delà de ADMIN_EXACT_COUNT_LIMIT lignes
+    estimées, le nombre affiché vient de l'estimation du planificateur
+    PostgreSQL plutôt que d'un COUNT(*) complet (voir pagination.approximate_count).
+    """
+
+    @cached_property
+    def count(self):
+        estimate = approximate_count(self.object_list)
+        # Hors PostgreSQL, approximate_count fait déjà un comptage exact
+        exact = connections[self.object_list.db].vendor != 'postgresql'
+        if exact or estimate > getattr(settings, 'ADMIN_EXACT_COUNT_LIMIT', 10000):
+            return estimate
+        return super().count
+
+class ReplicaReadAdmin(admin.ModelAdmin):
+    """ Liste (GET) lue sur un réplica ; actions et modifications restent sur la base principale """
+
+    def changelist_view(self, request, extra_context=None):
+        if request.method != 'GET':
+            return super().changelist_view(request, extra_context)
+        with replica_reads():
+            response = super().changelist_view(request, extra_context)
+            # Les résultats sont lus au rendu du gabarit : il doit avoir lieu dans le bloc
+            if hasattr(response, 'render'):
+                response.render()
+        return response
+
+class LargeTableAdmin(ReplicaReadAdmin):
+    paginator = EstimatedCountPaginator
+    # Évite le second COUNT(*) (table entière) affiché à côté des résultats filtrés
+    show_full_result_count = False
 
 class ProductImageInline(admin.TabularInline):
     model = ProductImage
@@ -12,19 +60,33 @@ class ReviewInline(admin.TabularInline):
     can_delete = False
 
 @admin.register(Category)
-class CategoryAdmin(admin.ModelAdmin):
+class CategoryAdmin(ReplicaReadAdmin):
     list_display = ('name', 'slug', 'is_active', 'product_count')
     list_filter = ('is_active',)
     search_fields = ('name', 'description')
     prepopulated_fields = {'slug': ('name',)}
     ordering = ('name',)
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_product_count()
+
+    @admin.display(description='Nombre de produits', ordering='num_products')
+    def product_count(self, obj):
+        return obj.num_products
+
 @admin.register(Product)
-class ProductAdmin(admin.ModelAdmin):
-    list_display = ('name', 'category', 'price', 'stock', 'is_active', 'is_featured', 'average_rating')
-    list_filter = ('category', 'is_active', 'is_featured')
-    search_fields = ('name', 'description', 'ingredients')
+class ProductAdmin(LargeTableAdmin):
+    list_display = (
+        'name', 'category', 'price', 'stock', 'is_active', 'is_featured', 'rating', 'rating_count'
+    )
+    list_filter = ('is_active', 'is_featured', 'category')
+    list_select_related = ('category',)
+    # La description et les ingrédients passent par l'index plein texte plutôt
+    # que par un icontains sur toute la table (voir get_search_results)
+    search_fields = ('name', 'slug')
+    text_search_fields = ('description', 'ingredients')
     prepopulated_fields = {'slug': ('name',)}
+    autocomplete_fields = ('category',)
     readonly_fields = ('average_rating', 'review_count')
     list_editable = ('price', 'stock', 'is_active', 'is_featured')
     inlines = [ProductImageInline, ReviewInline]
@@ -50,18 +112,82 @@ class ProductAdmin(admin.ModelAdmin):
         })
     )
 
+    def get_queryset(self, request):
+        # Note moyenne calculée en base depuis les agrégats stockés, pour pouvoir trier dessus
+        return super().get_queryset(request).annotate(
+            rating_average=Cast('rating_sum', FloatField()) / NullIf(F('rating_count'), 0)
+        )
+
+    @admin.display(description='Note moyenne', ordering='rating_average')
+    def rating(self, obj):
+        return round(obj.rating_average, 2) if obj.rating_average is not None else None
+
+    def get_search_fields(self, request):
+        # Sans moteur plein texte pour la base, icontains comme auparavant
+        if get_search_backend(self.model.objects.db) is None:
+            return (*self.search_fields, *self.text_search_fields)
+        return self.search_fields
+
+    def get_search_results(self, request, queryset, search_term):
+        results, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        backend = get_search_backend(queryset.db)
+        if search_term.strip() and backend is not None:
+            results = results | backend.filter(queryset, search_term)
+        return results, may_have_duplicates
+
 @admin.register(Review)
-class ReviewAdmin(admin.ModelAdmin):
-    list_display = ('product', 'rating', 'is_verified_purchase', 'created_at')
+class ReviewAdmin(LargeTableAdmin):
+    list_display = ('product', 'user', 'rating', 'is_verified_purchase', 'created_at')
     list_filter = ('rating', 'is_verified_purchase', 'created_at')
+    list_select_related = ('product', 'user')
     search_fields = ('product__name', 'comment')
     readonly_fields = ('created_at',)
+    autocomplete_fields = ('product',)
+    raw_id_fields = ('user',)
 
 @admin.register(Wishlist)
-class WishlistAdmin(admin.ModelAdmin):
-    list_display = ( 'product_count', 'created_at')
-    filter_horizontal = ('products',)
+class WishlistAdmin(LargeTableAdmin):
+    list_display = ('id', 'user', 'product_count', 'created_at')
+    list_select_related = ('user',)
+    search_fields = ('user__username', 'user__email')
+    autocomplete_fields = ('products',)
+    raw_id_fields = ('user',)
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(num_products=Count('products'))
 
+    @admin.display(description='Nombre de produits', ordering='num_products')
     def product_count(self, obj):
-        return obj.products.count()
-    product_count.short_description = 'Nombre de produits'
\ No newline at end of file
+        return obj.num_products
+
+@admin.register(Task)
+class TaskAdmin(LargeTableAdmin):
+    """ File des tâches différées, avec sa profondeur et ses latences en tête de liste """
+    change_list_template = 'admin/products/task/change_list.html'
+    list_display = ('name', 'status', 'attempts', 'priority', 'run_at', 'latency', 'duration', 'worker')
+    list_filter = ('status', 'name')
+    search_fields = ('name', 'last_error')
+    ordering = ('-created_at',)
+    readonly_fields = ('started_at', 'heartbeat_at', 'finished_at', 'worker', 'created_at')
+    actions = ['retry']
+
+    @admin.display(description='Attente')
+    def latency(self, obj):
+        if obj.started_at:
+            return max(obj.started_at - obj.run_at, timedelta(0))
+
+    @admin.display(description='Durée')
+    def duration(self, obj):
+        if obj.started_at and obj.finished_at:
+            return obj.finished_at - obj.started_at
+
+    @admin.action(description='Relancer les tâches sélectionnées')
+    def retry(self, request, queryset):
+        count = queryset.exclude(status='running').update(
+            status='pending', run_at=timezone.now(), attempts=0, worker=''
+        )
+        self.message_user(request, f"{count} tâches remises en file", messages.SUCCESS)
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = {**(extra_context or {}), 'queue_stats': get_stats()}
+        return super().changelist_view(request, extra_context)
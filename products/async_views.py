@@ -0,0 +1,177 @@
+"""
+Lectures les plus fréquentes du catalogue en vues asynchrones, pour un
+déploiement ASGI (voir core/asgi.py et le Procfile).
+
+Chaque vue rend la même réponse JSON que l'action correspondante du viewset
+DRF : le viewset prépare toujours la requête, le queryset et la sérialisation
+(compilée, voir compiled.py), mais les entrées-sorties (validateurs du GET
+conditionnel et cache lus en un passage, puis requêtes SQL de la page par l'ORM
+asynchrone) sont attendues : un worker sert d'autres connexions pendant ce
+temps au lieu de les attendre.
+
+Ce qui n'a pas d'équivalent asynchrone (API navigable, réponses d'erreur, autres
+méthodes que GET/HEAD) est délégué au viewset synchrone.
+"""
+from types import SimpleNamespace
+
+from asgiref.sync import markcoroutinefunction, sync_to_async
+from django.core.exceptions import ObjectDoesNotExist
+from django.http import Http404, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework.exceptions import APIException
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+from . import cache
+from .conditional import catalog_last_modified, compute_etag
+from .replicas import replica_read_count, replica_reads
+from .timing import span
+from .views import CategoryViewSet, ProductViewSet
+
+
+class Fallback(Exception):
+    """ La requête doit être servie par le viewset synchrone """
+
+
+class AsyncCatalogView:
+    """ Vue asynchrone d'une action de lecture d'un viewset du catalogue """
+
+    def __init__(self, viewset, action):
+        self.viewset = viewset
+        self.action = action
+        self.sync_view = sync_to_async(viewset.as_view({'get': action}))
+        # Django reconnaît ainsi une vue asynchrone
+        markcoroutinefunction(self)
+
+    async def __call__(self, request, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return await self.sync_view(request, **kwargs)
+        try:
+            with replica_reads():
+                return await self.respond(request, kwargs)
+        except (Fallback, APIException, Http404, ObjectDoesNotExist):
+            # Le viewset reprend la requête et rend l'erreur comme d'habitude
+            return await self.sync_view(request, **kwargs)
+
+    def get_view(self, request, kwargs):
+        """ Viewset initialisé comme par dispatch(), sans authentification (lectures publiques) """
+        view = self.viewset(action_map={'get': self.action})
+        view.args, view.kwargs = (), kwargs
+        view.format_kwarg = None
+        view.headers = view.default_response_headers
+        view.request = view.initialize_request(request, **kwargs)
+        view.request.accepted_renderer, view.request.accepted_media_type = (
+            view.perform_content_negotiation(view.request)
+        )
+        if not isinstance(view.request.accepted_renderer, JSONRenderer):
+            raise Fallback
+        view.check_permissions(view.request)
+        return view
+
+    async def respond(self, request, kwargs):
+        view = self.get_view(request, kwargs)
+        lookup = await sync_to_async(self.lookup)(request, view, kwargs)
+        if lookup.not_modified is not None:
+            return lookup.not_modified
+
+        data = lookup.data
+        replica_reads = replica_read_count()
+        if data is None:
+            data = await getattr(self, self.action)(view)
+            if lookup.key is not None and replica_read_count() == replica_reads:
+                await cache.get_cache().aset(lookup.key, data, cache.get_timeout())
+
+        response = self.render(view, data)
+        if lookup.key is not None:
+            response['X-Cache'] = 'MISS' if lookup.data is None else 'HIT'
+        if replica_read_count() == replica_reads:
+            response['ETag'] = lookup.etag
+            if lookup.timestamp is not None:
+                response['Last-Modified'] = http_date(lookup.timestamp)
+        return response
+
+    def lookup(self, request, view, kwargs):
+        """
+        Validateurs du GET conditionnel puis réponse en cache, comme les
+        décorateurs de views.py. L'API de cache de Django n'étant pas nativement
+        asynchrone (chaque appel ``a*`` passe par un thread), tout est lu en un
+        seul passage synchrone.
+        """
+        generations = cache.get_generations(view.cache_dependencies)
+        last_modified = catalog_last_modified(view, kwargs)
+        lookup = SimpleNamespace(
+            etag=compute_etag(view, view.request, kwargs, last_modified, generations),
+            timestamp=int(last_modified.timestamp()) if last_modified else None,
+            key=None, data=None,
+        )
+        lookup.not_modified = get_conditional_response(
+            request, etag=lookup.etag, last_modified=lookup.timestamp
+        )
+        if lookup.not_modified is None and cache.is_enabled():
+            lookup.key = cache.make_key(view, view.request, kwargs, generations)
+            lookup.data = cache.get_cache().get(lookup.key)
+            cache._record('miss' if lookup.data is None else 'hit', cache.cache_name(view))
+        return lookup
+
+    def render(self, view, data):
+        # Réponse déjà rendue : le gestionnaire ASGI n'a pas à repasser par un
+        # thread pour appeler Response.render()
+        drf_response = view.finalize_response(view.request, Response(data))
+        drf_response.render()
+        response = HttpResponse(drf_response.content, status=drf_response.status_code)
+        for header, value in drf_response.items():
+            response[header] = value
+        return response
+
+    async def filter_queryset(self, view, queryset):
+        # La validation des filtres sur clé étrangère (ModelChoiceFilter) interroge la base
+        if set(getattr(view, 'filterset_fields', ())) & view.request.query_params.keys():
+            return await sync_to_async(view.filter_queryset)(queryset)
+        return view.filter_queryset(queryset)
+
+    async def serialize(self, view, projection, rows):
+        # Seuls les serializers imbriqués chargés à part interrogent la base
+        with span('serialize'):
+            if projection.loaders:
+                return await sync_to_async(projection.serialize)(rows, view.get_serializer_context())
+            return projection.serialize(rows, view.get_serializer_context())
+
+    async def paginate(self, view, queryset):
+        projection = view.get_projection() if view.use_compiled() else None
+        if projection is not None:
+            queryset = view.get_rows(queryset, projection)
+        paginator = view.paginator
+        if hasattr(paginator, 'apaginate_queryset'):
+            page = await paginator.apaginate_queryset(queryset, view.request, view)
+        else:
+            page = await sync_to_async(view.paginate_queryset)(queryset)
+        if projection is not None:
+            return view.get_paginated_response(await self.serialize(view, projection, page)).data
+        with span('serialize'):
+            data = view.get_serializer(page, many=True).data
+        return view.get_paginated_response(data).data
+
+    async def list(self, view):
+        return await self.paginate(view, await self.filter_queryset(view, view.get_queryset()))
+
+    async def featured(self, view):
+        return await self.paginate(view, view.get_queryset().filter(is_featured=True))
+
+    async def retrieve(self, view):
+        queryset = await self.filter_queryset(view, view.get_queryset())
+        lookup = {view.lookup_field: view.kwargs[view.lookup_url_kwarg or view.lookup_field]}
+        if not view.use_compiled() or view.has_object_permissions():
+            instance = await queryset.aget(**lookup)
+            view.check_object_permissions(view.request, instance)
+            with span('serialize'):
+                return view.get_serializer(instance).data
+        projection = view.get_projection()
+        row = await projection.values(queryset).aget(**lookup)
+        return (await self.serialize(view, projection, [row]))[0]
+
+
+product_list = AsyncCatalogView(ProductViewSet, 'list')
+product_featured = AsyncCatalogView(ProductViewSet, 'featured')
+product_detail = AsyncCatalogView(ProductViewSet, 'retrieve')
+category_list = AsyncCatalogView(CategoryViewSet, 'list')
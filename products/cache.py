@@ -0,0 +1,185 @@
+"""
+Cache des réponses du catalogue.
+
+Une réponse est mise en cache sous une clé qui combine la vue, l'action, les
+paramètres de requête normalisés et le numéro de génération de chaque modèle
+dont elle dépend. Les signaux incrémentent la génération d'un modèle à
+chaque écriture : les anciennes entrées ne sont alors plus jamais
+relues et expirent d'elles-mêmes. L'instant de chaque incrément est gardé à
+côté de la génération : il date les réponses (Last-Modified) sans reculer
+quand la ligne la plus récente est supprimée ou désactivée.
+"""
+import hashlib
+import time
+from datetime import datetime, timezone
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework.response import Response
+
+from . import metrics, replicas
+
+KEY_PREFIX = 'catalog'
+STATS = ('hit', 'miss')
+
+
+def get_cache():
+    return caches[getattr(settings, 'CATALOG_CACHE_ALIAS', 'default')]
+
+
+def is_enabled():
+    return getattr(settings, 'CATALOG_CACHE_ENABLED', True)
+
+
+def get_timeout():
+    return getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300)
+
+
+def _generation_key(model):
+    return f'{KEY_PREFIX}:generation:{model._meta.label_lower}'
+
+
+def _bumped_at_key(model):
+    return f'{KEY_PREFIX}:bumped-at:{model._meta.label_lower}'
+
+
+def _initial_generation():
+    # Une génération évincée ne doit pas reprendre une valeur déjà utilisée
+    return int(time.time() * 1000)
+
+
+def get_generations(models):
+    cache = get_cache()
+    keys = [_generation_key(model) for model in models]
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            cache.add(key, _initial_generation(), timeout=None)
+            generations[key] = cache.get(key)
+    return [generations[key] for key in keys]
+
+
+def bump_generation(*models):
+    """ Invalide toutes les réponses dépendant de ``models`` """
+    cache = get_cache()
+    for model in models:
+        key = _generation_key(model)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, _initial_generation(), timeout=None)
+    keys = [_bumped_at_key(model) for model in models]
+    previous = cache.get_many(keys)
+    # Jamais en arrière, même si les horloges des serveurs diffèrent un peu
+    now = time.time()
+    cache.set_many({key: max(now, previous.get(key, now)) for key in keys}, timeout=None)
+
+
+def get_bumped_at(models):
+    """ Instant du dernier incrément de génération de ``models`` (maintenant s'il a été évincé) """
+    cache = get_cache()
+    keys = [_bumped_at_key(model) for model in models]
+    values = cache.get_many(keys)
+    missing = [key for key in keys if key not in values]
+    if missing:
+        now = time.time()
+        for key in missing:
+            cache.add(key, now, timeout=None)
+        values.update(cache.get_many(missing))
+    timestamps = [values.get(key, time.time()) for key in keys]
+    return datetime.fromtimestamp(max(timestamps), tz=timezone.utc) if timestamps else None
+
+
+def bump_generation_on_commit(*models, using='default'):
+    # Incrémente tout de suite (lectures dans la même transaction) puis à nouveau
+    # après validation : entre les deux, un lecteur concurrent a pu remettre les
+    # anciennes données en cache sous la génération intermédiaire
+    bump_generation(*models)
+    transaction.on_commit(lambda: bump_generation(*models), using=using)
+
+
+def _record(stat, view_name):
+    metrics.record_cache(view_name, stat)
+    cache = get_cache()
+    for key in (f'{KEY_PREFIX}:stats:{stat}', f'{KEY_PREFIX}:stats:{stat}:{view_name}'):
+        try:
+            cache.incr(key)
+        except ValueError:
+            if not cache.add(key, 1, timeout=None):
+                cache.incr(key)
+
+
+def get_stats(view_names=()):
+    """ Compteurs de hits/misses partagés par tous les workers """
+    cache = get_cache()
+    scopes = [None, *view_names]
+    keys = {
+        (scope, stat): f'{KEY_PREFIX}:stats:{stat}' + (f':{scope}' if scope else '')
+        for scope in scopes for stat in STATS
+    }
+    values = cache.get_many(keys.values())
+    stats = {}
+    for scope in scopes:
+        hits = values.get(keys[(scope, 'hit')], 0)
+        misses = values.get(keys[(scope, 'miss')], 0)
+        total = hits + misses
+        stats[scope or 'total'] = {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / total if total else None,
+        }
+    return stats
+
+
+def make_key(view, request, kwargs, generations=None):
+    """ ``generations`` : déjà lues par l'appelant, relues sinon """
+    query = sorted(
+        (name, sorted(values)) for name, values in request.query_params.lists()
+    )
+    if generations is None:
+        generations = get_generations(view.cache_dependencies)
+    raw = repr((
+        request.get_host(), sorted(kwargs.items()), query, generations,
+        request.accepted_renderer.format,
+    ))
+    digest = hashlib.sha1(raw.encode('utf-8')).hexdigest()
+    return f'{KEY_PREFIX}:response:{cache_name(view)}:{digest}'
+
+
+def cache_name(view):
+    return f'{view.__class__.__name__}.{getattr(view, "action", None) or view.request.method.lower()}'
+
+
+def cache_catalog_response(method):
+    """
+    Décorateur de méthode de vue : sert la réponse depuis le cache si la clé
+    existe, sinon exécute la vue et met en cache les réponses 200 lues sur la
+    base principale : un réplica en retard remettrait sous la nouvelle
+    génération les données d'avant l'écriture. La vue doit déclarer
+    ``cache_dependencies`` (les modèles dont dépend son contenu).
+    """
+    @wraps(method)
+    def wrapper(self, request, *args, **kwargs):
+        if request.method != 'GET' or not is_enabled():
+            return method(self, request, *args, **kwargs)
+
+        cache = get_cache()
+        key = make_key(self, request, kwargs)
+        name = cache_name(self)
+        cached = cache.get(key)
+        if cached is not None:
+            _record('hit', name)
+            response = Response(cached)
+            response['X-Cache'] = 'HIT'
+            return response
+
+        _record('miss', name)
+        replica_reads = replicas.replica_read_count()
+        response = method(self, request, *args, **kwargs)
+        if response.status_code == 200 and replicas.replica_read_count() == replica_reads:
+            cache.set(key, response.data, get_timeout())
+        response['X-Cache'] = 'MISS'
+        return response
+    return wrapper
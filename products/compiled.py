@@ -0,0 +1,388 @@
+"""
+Sérialisation « compilée » en lecture seule.
+
+Un ModelSerializer parcourt chaque champ de chaque objet : get_attribute sur
+l'instance, test de None, puis to_representation. Ici le serializer est
+analysé une seule fois : chaque champ devient une ou plusieurs colonnes de
+values() et une conversion choisie d'avance (le plus souvent aucune), puis les
+lignes sont projetées directement en dictionnaires, sans instancier les
+modèles. Le résultat est identique à celui du serializer.
+
+Les serializers imbriqués sont joints dans la même requête quand ils ne lisent
+que des colonnes (clé étrangère), sinon chargés en une requête par champ comme
+un prefetch_related, avec les annotations dont ils ont besoin (ANNOTATIONS). Les champs calculés (propriétés de modèle,
+SerializerMethodField) sont évalués sur la ligne elle-même : les colonnes dont
+ils dépendent sont déclarées dans COMPUTED_COLUMNS.
+"""
+from collections import defaultdict
+from decimal import Decimal
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db.models import Prefetch
+from django.db.models.query import ValuesIterable
+from django.http import Http404
+from rest_framework.generics import get_object_or_404
+from rest_framework.permissions import BasePermission
+from rest_framework import serializers
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+from .models import Category, Product, Review
+from .renditions import build_srcsets
+from .serializers import ImageRenditionsField
+from .sparse import DynamicFieldsMixin, SparseFieldsMixin, normalize_selection
+from .timing import span
+
+# Colonnes (ou annotations) lues par les champs calculés, par (modèle, nom du champ)
+COMPUTED_COLUMNS = {
+    (Product, 'is_in_stock'): ('stock',),
+    (Product, 'average_rating'): ('rating_sum', 'rating_count'),
+    (Product, 'review_count'): ('rating_count',),
+    (Product, 'rating_histogram'): tuple(f'rating_{rating}_count' for rating in Review.RATING_RANGE),
+    (Category, 'product_count'): ('num_products',),
+}
+# Annotations lues par les champs calculés, ajoutées au queryset d'un serializer imbriqué
+ANNOTATIONS = {
+    (Category, 'num_products'): lambda queryset: queryset.with_product_count(),
+}
+# to_representation() qui rendent la valeur lue en base telle quelle
+IDENTITY_REPRESENTATIONS = {
+    serializers.CharField.to_representation,
+    serializers.IntegerField.to_representation,
+    serializers.BooleanField.to_representation,
+    serializers.ReadOnlyField.to_representation,
+}
+
+
+class NotJoinable(Exception):
+    """ Le serializer imbriqué ne peut pas être lu par jointure (champ calculé, liste) """
+
+
+class Row(dict):
+    """ Ligne de values() lisible aussi par attribut (propriétés de modèle, curseurs de pagination) """
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+class RowIterable(ValuesIterable):
+    def __iter__(self):
+        for row in super().__iter__():
+            yield Row(row)
+
+
+def _converter(field):
+    """ Conversion d'une valeur non nulle, ou None si elle est rendue telle quelle """
+    if isinstance(field, serializers.ChoiceField):
+        if all(isinstance(choice, str) for choice in field.choices):
+            return None
+        return field.to_representation
+    if isinstance(field, serializers.DecimalField):
+        if (not getattr(field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING) or field.localize or field.decimal_places is None
+                or getattr(field, 'normalize_output', False)):
+            return field.to_representation
+        # Les valeurs lues en base sont des Decimal déjà à l'échelle du champ
+        exponent = Decimal(1).scaleb(-field.decimal_places)
+        return lambda value: format(value.quantize(exponent, rounding=field.rounding), 'f')
+    if type(field).to_representation in IDENTITY_REPRESENTATIONS:
+        return None
+    return field.to_representation
+
+
+class Projection:
+    """ Sérialisation compilée d'une instance de ModelSerializer (voir compile_serializer) """
+
+    def __init__(self, serializer, prefix=''):
+        self.serializer = serializer
+        self.model = serializer.Meta.model
+        self.prefix = prefix
+        self.pk_column = prefix + self.model._meta.pk.attname
+        self.columns = [self.pk_column]
+        self.getters = []
+        # Serializers imbriqués chargés par une requête séparée : nom -> chargeur
+        self.loaders = {}
+        # Relations lues, pour restrict() : jointes (select_related) et préchargées
+        self.joined = []
+        self.prefetched = {}
+        for name, field in serializer.fields.items():
+            self.getters.append((name, self.compile_field(name, field)))
+
+    def add_columns(self, *columns):
+        for column in columns:
+            if self.prefix + column not in self.columns:
+                self.columns.append(self.prefix + column)
+
+    def column_getter(self, column, convert):
+        column = self.prefix + column
+        if convert is None:
+            return lambda row, state: row[column]
+        return lambda row, state: None if row[column] is None else convert(row[column])
+
+    def compile_field(self, name, field):
+        source = field.source
+        if isinstance(field, serializers.ListSerializer):
+            return self.compile_many(name, field)
+        if isinstance(field, serializers.BaseSerializer):
+            return self.compile_one(name, field)
+        if isinstance(field, ImageRenditionsField):
+            model_field = self.model._meta.get_field(field.image_field)
+            self.add_columns(field.image_field, 'renditions')
+            image, renditions = self.prefix + field.image_field, self.prefix + 'renditions'
+            return lambda row, state: build_srcsets(
+                row[image], row[renditions], field.image_field, model_field.storage, state['request']
+            )
+        if isinstance(field, serializers.SerializerMethodField):
+            method = getattr(self.serializer, field.method_name)
+            return self.compile_computed(name, lambda row: method(row))
+        if isinstance(field, serializers.PrimaryKeyRelatedField) and field.pk_field is None:
+            column = self.model._meta.get_field(source).attname
+            self.add_columns(column)
+            return self.column_getter(column, None)
+        if isinstance(field, (serializers.RelatedField, serializers.ManyRelatedField)) or source == '*':
+            raise ImproperlyConfigured(f"{type(self.serializer).__name__}.{name} : champ non compilable")
+
+        attribute = getattr(self.model, source, None)
+        if isinstance(attribute, property):
+            convert = _converter(field)
+            getter = attribute.fget
+            if convert is not None:
+                return self.compile_computed(name, lambda row: (
+                    None if (value := getter(row)) is None else convert(value)
+                ))
+            return self.compile_computed(name, getter)
+        column = source.replace('.', '__')
+        if '.' in source:
+            self.joined.append(self.prefix + column.rpartition('__')[0])
+        if isinstance(field, serializers.FileField):
+            if '.' in source:
+                raise ImproperlyConfigured(f"{type(self.serializer).__name__}.{name} : fichier d'un modèle lié")
+            return self.compile_file(column, field)
+        self.add_columns(column)
+        return self.column_getter(column, _converter(field))
+
+    def compile_computed(self, name, compute):
+        try:
+            columns = COMPUTED_COLUMNS[(self.model, name)]
+        except KeyError:
+            raise ImproperlyConfigured(f"COMPUTED_COLUMNS : colonnes de {self.model.__name__}.{name} non déclarées")
+        if self.prefix:
+            raise NotJoinable
+        self.add_columns(*columns)
+        return lambda row, state: compute(row)
+
+    def compile_file(self, column, field):
+        self.add_columns(column)
+        column = self.prefix + column
+        if not getattr(field, 'use_url', api_settings.UPLOADED_FILES_USE_URL):
+            return lambda row, state: row[column] or None
+        storage = self.model._meta.get_field(column[len(self.prefix):]).storage
+
+        def getter(row, state):
+            if not row[column]:
+                return None
+            url = storage.url(row[column])
+            return url if state['request'] is None else state['request'].build_absolute_uri(url)
+        return getter
+
+    def compile_one(self, name, field):
+        """ Clé étrangère : jointe si le serializer imbriqué ne lit que des colonnes """
+        foreign_key = self.model._meta.get_field(field.source)
+        try:
+            joined = Projection(field, prefix=f'{self.prefix}{foreign_key.name}__')
+        except NotJoinable:
+            pass
+        else:
+            self.add_columns(foreign_key.attname, *(column[len(self.prefix):] for column in joined.columns))
+            self.joined += [self.prefix + foreign_key.name, *joined.joined]
+            return lambda row, state: None if row[joined.pk_column] is None else joined.build(row, state)
+        if self.prefix:
+            raise NotJoinable
+
+        self.add_columns(foreign_key.attname)
+        column = self.prefix + foreign_key.attname
+        nested = Projection(field)
+        self.prefetched[foreign_key.name] = Prefetch(foreign_key.name, queryset=nested.get_queryset())
+
+        def load(rows, context):
+            ids = {row[column] for row in rows} - {None}
+            related = list(nested.values(nested.get_queryset().filter(pk__in=ids)))
+            return dict(zip((row[nested.pk_column] for row in related), nested.serialize(related, context)))
+        self.loaders[name] = load
+        return lambda row, state: state[name].get(row[column])
+
+    def compile_many(self, name, field):
+        """ Relation inverse (many=True) : une requête pour toutes les lignes, comme un prefetch """
+        if self.prefix:
+            raise NotJoinable
+        relation = self.model._meta.get_field(field.source)
+        foreign_key = relation.field
+        nested = Projection(field.child)
+        self.prefetched[field.source] = field.source
+
+        def load(rows, context):
+            ids = [row[self.pk_column] for row in rows]
+            queryset = foreign_key.model._default_manager.filter(**{f'{foreign_key.name}__in': ids})
+            related = list(nested.values(queryset, foreign_key.attname))
+            grouped = defaultdict(list)
+            for row, data in zip(related, nested.serialize(related, context)):
+                grouped[row[foreign_key.attname]].append(data)
+            return grouped
+        self.loaders[name] = load
+        return lambda row, state: state[name].get(row[self.pk_column], [])
+
+    def get_queryset(self):
+        """ Queryset du modèle portant les annotations lues par la projection (serializer imbriqué) """
+        queryset = self.model._default_manager.all()
+        for column in self.columns:
+            if (self.model, column) in ANNOTATIONS:
+                queryset = ANNOTATIONS[(self.model, column)](queryset)
+        return queryset
+
+    def values(self, queryset, *extra):
+        """
+        Queryset de lignes (Row) portant les colonnes de la projection, les
+        annotations existantes (tri par pertinence, comptages) et ``extra``.
+        """
+        columns = [*self.columns, *queryset.query.annotations, *extra]
+        queryset = queryset.prefetch_related(None).values('pk', *dict.fromkeys(columns))
+        queryset._iterable_class = RowIterable
+        return queryset
+
+    def restrict(self, queryset, *extra):
+        """
+        Queryset d'instances (chemin des serializers) réduit aux colonnes et
+        relations lues par la projection : only(), select_related des seules
+        jointures et préchargement des seules relations servies, en gardant les
+        Prefetch déjà déclarés par le queryset.
+        """
+        prefetches = dict(self.prefetched)
+        for lookup in queryset._prefetch_related_lookups:
+            through = lookup.prefetch_through if isinstance(lookup, Prefetch) else lookup
+            if through.split('__')[0] in prefetches:
+                prefetches[through.split('__')[0]] = lookup
+        annotations = queryset.query.annotations
+        queryset = queryset.select_related(None).prefetch_related(None)
+        if self.joined:
+            queryset = queryset.select_related(*self.joined)
+        return queryset.prefetch_related(*prefetches.values()).only(
+            *(column for column in dict.fromkeys([*self.columns, *extra]) if column not in annotations)
+        )
+
+    def build(self, row, state):
+        return {name: getter(row, state) for name, getter in self.getters}
+
+    def serialize(self, rows, context=None):
+        """ Dictionnaires identiques à ``serializer_class(rows, many=True, context=context).data`` """
+        context = context or {}
+        rows = list(rows)
+        state = {'request': context.get('request')}
+        for name, load in self.loaders.items():
+            state[name] = load(rows, context) if rows else {}
+        return [self.build(row, state) for row in rows]
+
+
+def compile_serializer(serializer_class, fields=None, expand=()):
+    """
+    Projection (mise en cache) de ``serializer_class``, réduite à la sélection
+    ?fields= / ?expand=. La clé du cache est la sélection normalisée : les noms
+    inconnus sont refusés (400) avant d'y entrer.
+    """
+    if issubclass(serializer_class, DynamicFieldsMixin):
+        return _compile_serializer(serializer_class, *normalize_selection(serializer_class, fields, expand))
+    return _compile_serializer(serializer_class)
+
+
+@lru_cache(maxsize=256)
+def _compile_serializer(serializer_class, fields=None, expand=()):
+    if issubclass(serializer_class, DynamicFieldsMixin):
+        serializer = serializer_class()
+        serializer.select_fields(fields, expand)
+        return Projection(serializer)
+    return Projection(serializer_class())
+
+
+class CompiledSerializerMixin(SparseFieldsMixin):
+    """
+    Vue DRF dont les lectures (list, retrieve) sérialisent par la projection
+    compilée de get_serializer_class(), réduite aux champs demandés (?fields=,
+    ?expand=), au lieu d'instancier les modèles. Désactivable par
+    CATALOG_COMPILED_SERIALIZERS = False : les serializers sont alors utilisés
+    sur un queryset restreint de la même façon (Projection.restrict).
+    """
+
+    def use_compiled(self):
+        return getattr(settings, 'CATALOG_COMPILED_SERIALIZERS', True)
+
+    def has_object_permissions(self):
+        """
+        Une permission de la vue contrôle-t-elle l'objet lui-même ? Elle attend
+        alors une instance : retrieve passe par les serializers.
+        """
+        return any(
+            type(permission).has_object_permission is not BasePermission.has_object_permission
+            for permission in self.get_permissions()
+        )
+
+    def get_projection(self, serializer_class=None):
+        return compile_serializer(serializer_class or self.get_serializer_class(), *self.get_field_selection())
+
+    def get_ordering_columns(self):
+        """ Champs de tri lus par le curseur de pagination sur la dernière ligne servie """
+        ordering = getattr(self, 'ordering_fields', None)
+        ordering = list(ordering) if isinstance(ordering, (list, tuple)) else []
+        default_ordering = getattr(self.paginator, 'default_ordering', None)
+        if default_ordering:
+            ordering.append(default_ordering.lstrip('-'))
+        return ordering
+
+    def get_rows(self, queryset, projection):
+        return projection.values(queryset, *self.get_ordering_columns())
+
+    def restrict_queryset(self, queryset, serializer_class=None):
+        """ Queryset d'instances réduit aux champs demandés, pour les actions servies par les serializers """
+        return self.get_projection(serializer_class).restrict(queryset, *self.get_ordering_columns())
+
+    def list_response(self, queryset, serializer_class=None):
+        """ Réponse de liste (paginée si la vue l'est), par la projection si elle est activée """
+        serializer_class = serializer_class or self.get_serializer_class()
+        if not self.use_compiled():
+            queryset = self.restrict_queryset(queryset, serializer_class)
+            page = self.paginate_queryset(queryset)
+            with span('serialize'):
+                data = self.get_selected_serializer(serializer_class, queryset if page is None else page, many=True).data
+        else:
+            projection = self.get_projection(serializer_class)
+            rows = self.get_rows(queryset, projection)
+            page = self.paginate_queryset(rows)
+            with span('serialize'):
+                data = projection.serialize(rows if page is None else page, self.get_serializer_context())
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
+
+    def list(self, request, *args, **kwargs):
+        return self.list_response(self.filter_queryset(self.get_queryset()))
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        lookup = {self.lookup_field: self.kwargs[lookup_url_kwarg]}
+        queryset = self.filter_queryset(self.get_queryset())
+        if not self.use_compiled() or self.has_object_permissions():
+            instance = get_object_or_404(self.restrict_queryset(queryset), **lookup)
+            self.check_object_permissions(request, instance)
+            with span('serialize'):
+                return Response(self.get_serializer(instance).data)
+
+        projection = self.get_projection()
+        try:
+            row = projection.values(queryset).get(**lookup)
+        except (queryset.model.DoesNotExist, TypeError, ValueError, ValidationError):
+            raise Http404
+        with span('serialize'):
+            return Response(projection.serialize([row], self.get_serializer_context())[0])
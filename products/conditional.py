@@ -0,0 +1,77 @@
+"""
+GET conditionnels (ETag / Last-Modified / 304) pour les vues du catalogue.
+
+Les validateurs sont calculés sans sérialiser la réponse. Last-Modified est la
+plus récente de deux dates : un simple Max('updated_at') fourni par la vue,
+et le dernier incrément de génération du cache du catalogue. Ce dernier
+avance aussi lors des suppressions et désactivations, là où le Max reculerait.
+L'ETag combine cette date avec les générations et les paramètres de la
+requête.
+"""
+import hashlib
+from functools import wraps
+
+from django.db.models import Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from . import cache, replicas
+
+
+def latest_update(queryset, *fields):
+    """ Plus récente des dates ``fields`` sur le queryset, en une seule agrégation """
+    values = queryset.aggregate(**{f'latest_{index}': Max(field) for index, field in enumerate(fields)})
+    dates = [value for value in values.values() if value is not None]
+    return max(dates) if dates else None
+
+
+def catalog_last_modified(view, kwargs):
+    """ Last-Modified de la vue : ne recule jamais (voir le docstring du module) """
+    dates = [view.get_last_modified(**kwargs), cache.get_bumped_at(view.cache_dependencies)]
+    dates = [date for date in dates if date is not None]
+    return max(dates) if dates else None
+
+
+def compute_etag(view, request, kwargs, last_modified, generations=None):
+    if generations is None:
+        generations = cache.get_generations(view.cache_dependencies)
+    query = sorted((name, sorted(values)) for name, values in request.query_params.lists())
+    raw = repr((
+        cache.cache_name(view), sorted(kwargs.items()), query,
+        generations,
+        last_modified.isoformat() if last_modified else None,
+        request.accepted_renderer.format,
+    ))
+    return quote_etag(hashlib.sha1(raw.encode('utf-8')).hexdigest())
+
+
+def conditional_catalog_response(method):
+    """
+    Décorateur de méthode de vue : répond 304 si le client a déjà la version
+    courante, sinon ajoute ETag et Last-Modified à la réponse. Une réponse lue
+    sur un réplica n'en reçoit pas : ses données peuvent précéder les
+    générations courantes, que le client revaliderait indéfiniment. La vue
+    fournit ``get_last_modified(**kwargs)`` et ``cache_dependencies``.
+    """
+    @wraps(method)
+    def wrapper(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return method(self, request, *args, **kwargs)
+
+        last_modified = catalog_last_modified(self, kwargs)
+        etag = compute_etag(self, request, kwargs, last_modified)
+        timestamp = int(last_modified.timestamp()) if last_modified else None
+        not_modified = get_conditional_response(
+            request._request, etag=etag, last_modified=timestamp
+        )
+        if not_modified is not None:
+            return not_modified
+
+        replica_reads = replicas.replica_read_count()
+        response = method(self, request, *args, **kwargs)
+        if response.status_code == 200 and replicas.replica_read_count() == replica_reads:
+            response['ETag'] = etag
+            if timestamp is not None:
+                response['Last-Modified'] = http_date(timestamp)
+        return response
+    return wrapper
@@ -0,0 +1,91 @@
+"""
+Export en flux des commandes (CSV ou NDJSON).
+
+Les commandes sont lues par QuerySet.iterator(chunk_size=...) avec leurs lignes
+préchargées bloc par bloc, et chaque ligne de sortie est envoyée au client dès
+qu'elle est produite : la mémoire reste constante quel que soit le volume.
+
+En CSV, une commande sans ligne garde une ligne aux colonnes d'article vides,
+et les textes qu'un tableur lirait comme une formule sont préfixés par « ' ».
+"""
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from rest_framework.renderers import BaseRenderer
+
+ORDER_COLUMNS = ['id', 'created_at', 'status', 'first_name', 'last_name', 'email', 'phone', 'address', 'total_price']
+ITEM_COLUMNS = ['product_id', 'product_name', 'quantity', 'price']
+CSV_HEADER = ['order_' + column if column == 'id' else column for column in ORDER_COLUMNS] + ITEM_COLUMNS
+# Premiers caractères qui font d'une cellule une formule (injection CSV)
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+class _ErrorRenderer(BaseRenderer):
+    """ Les réponses d'erreur (400, 403) sont rendues en JSON ; l'export lui-même est en flux """
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data, cls=DjangoJSONEncoder).encode(self.charset)
+
+
+class CSVRenderer(_ErrorRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+class NDJSONRenderer(_ErrorRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+
+class _Echo:
+    """ Pseudo-fichier : csv.writer renvoie directement la ligne écrite """
+
+    def write(self, value):
+        return value
+
+
+def _order_values(order):
+    return [getattr(order, column) for column in ORDER_COLUMNS]
+
+
+def csv_cell(value):
+    """ Texte neutralisé pour un tableur : une formule devient une chaîne """
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def csv_rows(orders):
+    """
+    Une ligne par ligne de commande, les colonnes de la commande répétées (une
+    ligne aux colonnes d'article vides pour une commande sans ligne)
+    """
+    writer = csv.writer(_Echo())
+    yield writer.writerow(CSV_HEADER)
+    for order in orders:
+        values = _order_values(order)
+        values[1] = values[1].isoformat()
+        items = [
+            [item.product_id, item.product.name, item.quantity, item.price] for item in order.items.all()
+        ] or [[''] * len(ITEM_COLUMNS)]
+        for item in items:
+            yield writer.writerow([csv_cell(value) for value in values + item])
+
+
+def ndjson_rows(orders):
+    """ Un objet JSON par commande, lignes imbriquées """
+    for order in orders:
+        document = dict(zip(ORDER_COLUMNS, _order_values(order)))
+        document['items'] = [
+            dict(zip(ITEM_COLUMNS, (item.product_id, item.product.name, item.quantity, item.price)))
+            for item in order.items.all()
+        ]
+        yield json.dumps(document, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+
+
+EXPORT_FORMATS = {
+    'csv': (csv_rows, 'text/csv; charset=utf-8'),
+    'ndjson': (ndjson_rows, 'application/x-ndjson; charset=utf-8'),
+}
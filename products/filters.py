@@ -0,0 +1,60 @@
+from datetime import datetime, timezone
+
+import django_filters
+from django.db.models import Q
+from rest_framework import filters
+from rest_framework.exceptions import ValidationError
+
+from .models import Order
+from .search import get_search_backend
+
+
+class FullTextSearchFilter(filters.SearchFilter):
+    """
+    ?search= servi par le moteur plein texte (voir search.py), classé par
+    pertinence. Sans moteur pour la base courante, on garde le comportement
+    icontains de SearchFilter sur search_fields.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        terms = request.query_params.get(self.search_param, '').strip()
+        backend = get_search_backend(queryset.db) if terms else None
+        if backend is None:
+            return super().filter_queryset(request, queryset, view)
+        return backend.search(queryset, terms)
+
+
+EXPORT_CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def export_cursor(created_at, pk):
+    """ Position (created_at, id) de la dernière commande exportée : « 2024-05-01T08:30:00.000000Z_42 » """
+    return f'{created_at.astimezone(timezone.utc):{EXPORT_CURSOR_FORMAT}}_{pk}'
+
+
+def parse_export_cursor(value):
+    created_at, _, pk = value.rpartition('_')
+    return datetime.strptime(created_at, EXPORT_CURSOR_FORMAT).replace(tzinfo=timezone.utc), int(pk)
+
+
+class OrderExportFilter(django_filters.FilterSet):
+    """
+    Filtres de l'export des commandes. ``after`` reprend l'export après la
+    dernière commande reçue (en-tête X-Export-Cursor de l'export précédent),
+    dans l'ordre (created_at, id).
+    """
+    created_after = django_filters.IsoDateTimeFilter(field_name='created_at', lookup_expr='gte')
+    created_before = django_filters.IsoDateTimeFilter(field_name='created_at', lookup_expr='lt')
+    status = django_filters.MultipleChoiceFilter(choices=Order.STATUS_CHOICES)
+    after = django_filters.CharFilter(method='filter_after')
+
+    class Meta:
+        model = Order
+        fields = []
+
+    def filter_after(self, queryset, name, value):
+        try:
+            created_at, pk = parse_export_cursor(value)
+        except ValueError:
+            raise ValidationError({name: ['Curseur invalide.']})
+        return queryset.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk))
@@ -0,0 +1,232 @@
+import json
+import platform
+import resource
+import statistics
+import subprocess
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from products import cache
+from products.models import Category, Order, Product
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def peak_rss_mb():
+    # ru_maxrss est en kilo-octets sous Linux, en octets sous macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if platform.system() == 'Darwin' else 1024), 1)
+
+
+class Command(BaseCommand):
+    help = (
+        "Mesure chaque route de products/urls.py (débit, latences p50/p95/p99, "
+        "requêtes SQL, RSS max) via le client de test ou un serveur local, résultat en JSON. "
+        "Les routes d'écriture (POST, DELETE) ne sont mesurées qu'avec --writes"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50, help="Requêtes mesurées par endpoint")
+        parser.add_argument('--warmup', type=int, default=5)
+        parser.add_argument('--base-url', help="ex. http://127.0.0.1:8000 (gunicorn) ; client de test sinon")
+        parser.add_argument('--concurrency', type=int, default=1, help="Clients simultanés (mode HTTP)")
+        parser.add_argument('--token', help="Jeton JWT pour les endpoints authentifiés (mode HTTP)")
+        parser.add_argument('--user', help="Utilisateur pour les endpoints authentifiés (client de test)")
+        parser.add_argument('--cold', action='store_true',
+                            help="Vide le cache du catalogue avant chaque requête (client de test)")
+        parser.add_argument('--only', nargs='*', default=None, help="Noms des endpoints à mesurer")
+        parser.add_argument('--writes', action='store_true',
+                            help="Mesure aussi les routes d'écriture (crée des commandes, des avis...)")
+        parser.add_argument('--output', help="Fichier JSON de sortie (sortie standard sinon)")
+
+    def handle(self, *args, **options):
+        endpoints = self.get_endpoints()
+        if options['only']:
+            endpoints = [endpoint for endpoint in endpoints if endpoint[0] in options['only']]
+        if not endpoints:
+            raise CommandError("Aucun endpoint à mesurer : lancer seed_catalog d'abord")
+
+        if options['base_url']:
+            runner = self.http_runner(options)
+        else:
+            runner = self.client_runner(options)
+
+        results = {}
+        for name, method, url, payload, authenticated in endpoints:
+            if authenticated and not (options['token'] or options['user']):
+                continue
+            if method != 'GET' and not options['writes']:
+                continue
+            self.stderr.write(f"{name} {method} {url}")
+            results[name] = runner(method, url, payload, options)
+
+        report = {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'revision': self.git_revision(),
+            'mode': 'http' if options['base_url'] else 'test-client',
+            'database': connection.vendor,
+            'catalog': {
+                'products': Product.objects.count(),
+                'categories': Category.objects.count(),
+                'orders': Order.objects.count(),
+            },
+            'options': {key: options[key] for key in ('requests', 'warmup', 'concurrency', 'cold', 'writes')},
+            'endpoints': results,
+            'peak_rss_mb': peak_rss_mb(),
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as handle:
+                handle.write(output)
+        else:
+            self.stdout.write(output)
+
+    def get_endpoints(self):
+        """
+        (nom, méthode, url, corps JSON, authentifié) pour chaque route de
+        products/urls.py ; les routes d'écriture ont une méthode autre que GET
+        """
+        product = Product.objects.filter(is_active=True).order_by('-rating_count').first()
+        category = Category.objects.filter(is_active=True).first()
+        order = Order.objects.order_by('-pk').first()
+        endpoints = [
+            ('product-list', 'GET', '/api/products/', None, False),
+            ('product-list-filtered', 'GET', '/api/products/?ordering=-price&in_stock=1&min_price=10', None, False),
+            ('product-search', 'GET', '/api/products/?search=creme+hydratante', None, False),
+            ('product-featured', 'GET', '/api/products/featured/', None, False),
+            ('product-facets', 'GET', '/api/products/facets/?in_stock=1', None, False),
+            ('category-list', 'GET', '/api/categories/', None, False),
+            ('order-list', 'GET', '/api/orders/', None, False),
+            ('order-export', 'GET', '/api/orders/export/?format=ndjson', None, True),
+            ('wishlist-list', 'GET', '/api/wishlist/', None, True),
+            ('wishlist-items', 'GET', '/api/wishlist/items/', None, True),
+            # La fiche sert toujours la liste de l'utilisateur, quel que soit l'identifiant
+            ('wishlist-detail', 'GET', '/api/wishlist/0/', None, True),
+        ]
+        if product is not None:
+            endpoints += [
+                ('product-detail', 'GET', f'/api/products/{product.slug}/', None, False),
+                ('product-by-slug', 'GET', f'/api/products/{product.slug}/by_slug/', None, False),
+                ('product-similar', 'GET', f'/api/products/{product.slug}/similar/', None, False),
+                ('product-reviews', 'GET', f'/api/products/{product.slug}/reviews/', None, False),
+                ('product-low-stock', 'GET', '/api/products/low_stock/', None, True),
+                ('wishlist-contains', 'GET', f'/api/wishlist/contains/?ids={product.pk}', None, True),
+                ('product-review', 'POST', f'/api/products/{product.slug}/review/',
+                 {'rating': 5, 'comment': 'Mesure de performance'}, True),
+                ('order-create', 'POST', '/api/orders/create/', {
+                    'first_name': 'Bench', 'last_name': 'Api', 'email': 'bench@example.com', 'address': 'Paris',
+                    'items': [{'product': product.pk, 'quantity': 1}],
+                }, False),
+                ('wishlist-add', 'POST', f'/api/wishlist/add/{product.pk}/', None, True),
+                ('wishlist-remove', 'DELETE', f'/api/wishlist/remove/{product.pk}/', None, True),
+                ('wishlist-contains-post', 'POST', '/api/wishlist/contains/', {'product_ids': [product.pk]}, True),
+                ('wishlist-bulk', 'POST', '/api/wishlist/bulk/', {'add': [product.pk], 'remove': []}, True),
+            ]
+        if category is not None:
+            endpoints += [
+                ('category-detail', 'GET', f'/api/categories/{category.slug}/', None, False),
+                ('category-products', 'GET', f'/api/categories/{category.slug}/products/', None, False),
+            ]
+        if order is not None:
+            endpoints.append(('order-detail', 'GET', f'/api/orders/{order.pk}/', None, False))
+        return endpoints
+
+    def summarize(self, latencies, elapsed, statuses, queries=None):
+        summary = {
+            'requests': len(latencies),
+            'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+            'latency_ms': {
+                'mean': round(statistics.fmean(latencies), 2),
+                'p50': round(percentile(latencies, 0.50), 2),
+                'p95': round(percentile(latencies, 0.95), 2),
+                'p99': round(percentile(latencies, 0.99), 2),
+                'max': round(max(latencies), 2),
+            },
+            'statuses': {str(code): statuses.count(code) for code in sorted(set(statuses))},
+        }
+        if queries is not None:
+            summary['queries'] = {'min': min(queries), 'max': max(queries)}
+        return summary
+
+    def client_runner(self, options):
+        client = APIClient()
+        if options['user']:
+            client.force_authenticate(get_user_model().objects.get(username=options['user']))
+
+        def request(method, url, payload):
+            return client.generic(
+                method, url, json.dumps(payload) if payload is not None else '', content_type='application/json'
+            )
+
+        def run(method, url, payload, options):
+            for _ in range(options['warmup']):
+                request(method, url, payload)
+            latencies, statuses, queries = [], [], []
+            started = time.perf_counter()
+            for _ in range(options['requests']):
+                if options['cold']:
+                    cache.get_cache().clear()
+                with CaptureQueriesContext(connection) as context:
+                    request_started = time.perf_counter()
+                    response = request(method, url, payload)
+                    latencies.append((time.perf_counter() - request_started) * 1000)
+                statuses.append(response.status_code)
+                queries.append(len(context.captured_queries))
+            return self.summarize(latencies, time.perf_counter() - started, statuses, queries)
+        return run
+
+    def http_runner(self, options):
+        headers = {'Accept': 'application/json'}
+        if options['token']:
+            headers['Authorization'] = f"Bearer {options['token']}"
+        base_url = options['base_url'].rstrip('/')
+
+        def fetch(method, url, payload):
+            data = json.dumps(payload).encode() if payload is not None else None
+            request = urllib.request.Request(
+                base_url + url, data=data, method=method,
+                headers={**headers, 'Content-Type': 'application/json'} if data is not None else headers,
+            )
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request) as response:
+                    response.read()
+                    status = response.status
+            except urllib.error.HTTPError as error:
+                status = error.code
+            return (time.perf_counter() - started) * 1000, status
+
+        def run(method, url, payload, options):
+            for _ in range(options['warmup']):
+                fetch(method, url, payload)
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+                samples = list(pool.map(lambda _: fetch(method, url, payload), range(options['requests'])))
+            elapsed = time.perf_counter() - started
+            return self.summarize(
+                [latency for latency, _ in samples], elapsed, [status for _, status in samples]
+            )
+        return run
+
+    def git_revision(self):
+        try:
+            return subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, text=True
+            ).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,110 @@
+import json
+import statistics
+import time
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from products.compiled import compile_serializer
+from products.models import Category, Order, Product
+from products.renderers import ORJSONRenderer
+from products.serializers import CategorySerializer, OrderSerializer, ProductListSerializer, ProductSerializer
+
+from .bench_api import Command as BenchCommand, percentile
+
+
+def get_cases(size):
+    """ (nom, classe de serializer, queryset des vues) pour chaque lecture mesurée """
+    return [
+        ('product-list', ProductListSerializer, Product.objects.for_listing().filter(is_active=True)[:size]),
+        ('product-detail', ProductSerializer, Product.objects.for_detail().filter(is_active=True)[:1]),
+        ('category-list', CategorySerializer, Category.objects.with_product_count().filter(is_active=True)[:size]),
+        ('order-list', OrderSerializer, Order.objects.with_items().order_by('-created_at')[:size]),
+    ]
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare la sérialisation DRF (ModelSerializer) et la projection compilée, puis le "
+        "rendu JSON de DRF et celui d'orjson, sur les lectures du catalogue et des commandes ; résultat en JSON"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=200, help="Mesures par cas")
+        parser.add_argument('--warmup', type=int, default=10)
+        parser.add_argument('--size', type=int, default=20, help="Objets par liste (taille de page)")
+        parser.add_argument('--only', nargs='*', default=None, help="Noms des cas à mesurer")
+        parser.add_argument('--output', help="Fichier JSON de sortie (sortie standard sinon)")
+
+    def handle(self, *args, **options):
+        request = Request(RequestFactory().get('/api/'))
+        context = {'request': request}
+        cases = [case for case in get_cases(options['size']) if not options['only'] or case[0] in options['only']]
+        if not cases:
+            raise CommandError("Aucun cas à mesurer")
+
+        results = {}
+        for name, serializer_class, queryset in cases:
+            self.stderr.write(name)
+            projection = compile_serializer(serializer_class)
+            data = serializer_class(queryset, many=True, context=context).data
+            if not data:
+                self.stderr.write(f"{name} : aucune donnée, cas ignoré (lancer seed_catalog)")
+                continue
+            if projection.serialize(projection.values(queryset), context) != data:
+                raise CommandError(f"{name} : la projection compilée diffère du serializer")
+
+            renderers = {'drf_json': JSONRenderer(), 'orjson': ORJSONRenderer()}
+            results[name] = {
+                'objects': len(data),
+                'serialization': self.compare({
+                    'drf': lambda: serializer_class(queryset.all(), many=True, context=context).data,
+                    'compiled': lambda: projection.serialize(projection.values(queryset), context),
+                }, options),
+                'rendering': self.compare({
+                    renderer_name: lambda renderer=renderer: renderer.render(data)
+                    for renderer_name, renderer in renderers.items()
+                }, options),
+                'response_bytes': len(renderers['orjson'].render(data)),
+            }
+
+        report = {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'revision': BenchCommand().git_revision(),
+            'database': connection.vendor,
+            'iterations': options['iterations'],
+            'results': results,
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as handle:
+                handle.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def compare(self, variants, options):
+        """ Latences de chaque variante et accélération de la dernière par rapport à la première """
+        measures = {name: self.measure(run, options) for name, run in variants.items()}
+        reference, candidate = measures[next(iter(measures))], measures[list(measures)[-1]]
+        measures['speedup'] = round(reference['p50_ms'] / candidate['p50_ms'], 2) if candidate['p50_ms'] else None
+        return measures
+
+    def measure(self, run, options):
+        for _ in range(options['warmup']):
+            run()
+        latencies = []
+        with CaptureQueriesContext(connection) as queries:
+            for _ in range(options['iterations']):
+                start = time.perf_counter()
+                run()
+                latencies.append((time.perf_counter() - start) * 1000)
+        return {
+            'p50_ms': round(statistics.median(latencies), 3),
+            'p95_ms': round(percentile(latencies, 0.95), 3),
+            'queries': len(queries) // options['iterations'],
+        }
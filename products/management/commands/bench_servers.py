@@ -0,0 +1,120 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand, CommandError
+
+from .bench_api import Command as BenchCommand
+
+# Configurations comparées : même application, même nombre de processus
+SERVERS = {
+    'wsgi': ['core.wsgi:application', '--worker-class', 'sync'],
+    'wsgi-threads': ['core.wsgi:application', '--worker-class', 'gthread', '--threads', '8'],
+    'asgi': ['core.asgi:application', '--worker-class', 'uvicorn_worker.UvicornWorker'],
+}
+HOT_ENDPOINTS = ['product-list', 'product-featured', 'product-detail', 'category-list']
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare les lectures du catalogue servies par gunicorn en WSGI (workers sync ou "
+        "threads) et en ASGI (uvicorn, vues asynchrones) : débit et latences par endpoint, en JSON"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--servers', nargs='*', choices=sorted(SERVERS), default=['wsgi', 'asgi'])
+        parser.add_argument('--workers', type=int, default=2, help="Processus gunicorn par serveur")
+        parser.add_argument('--concurrency', type=int, default=64, help="Clients simultanés")
+        parser.add_argument('--requests', type=int, default=1000, help="Requêtes mesurées par endpoint")
+        parser.add_argument('--warmup', type=int, default=20)
+        parser.add_argument('--only', nargs='*', default=HOT_ENDPOINTS, help="Noms des endpoints (voir bench_api)")
+        parser.add_argument('--output', help="Fichier JSON de sortie (sortie standard sinon)")
+
+    def handle(self, *args, **options):
+        bench = BenchCommand(stdout=self.stdout, stderr=self.stderr)
+        endpoints = [endpoint for endpoint in bench.get_endpoints() if endpoint[0] in options['only']]
+        if not endpoints:
+            raise CommandError("Aucun endpoint à mesurer : lancer seed_catalog d'abord")
+
+        results = {}
+        for name in options['servers']:
+            with self.server(name, options['workers']) as base_url:
+                run = bench.http_runner({**options, 'base_url': base_url, 'token': None})
+                results[name] = {}
+                for endpoint, url, _ in endpoints:
+                    self.stderr.write(f"{name} {endpoint} {url}")
+                    results[name][endpoint] = run(url, options)
+
+        report = {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'revision': bench.git_revision(),
+            'workers': options['workers'],
+            'concurrency': options['concurrency'],
+            'results': results,
+            'summary': self.summarize(results),
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as handle:
+                handle.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def summarize(self, results):
+        """ Débit et p95 de chaque serveur, rapportés au premier de la liste """
+        servers = list(results)
+        summary = {}
+        for endpoint in results[servers[0]]:
+            reference = results[servers[0]][endpoint]
+            summary[endpoint] = {}
+            for server in servers:
+                measure = results[server][endpoint]
+                summary[endpoint][server] = {
+                    'throughput_rps': measure['throughput_rps'],
+                    'p95_ms': measure['latency_ms']['p95'],
+                    'throughput_ratio': round(measure['throughput_rps'] / reference['throughput_rps'], 2),
+                }
+        return summary
+
+    @contextmanager
+    def server(self, name, workers):
+        """ Lance gunicorn sur un port libre le temps du bloc, et renvoie son URL """
+        port = free_port()
+        env = {**os.environ, 'CATALOG_ASYNC_VIEWS': 'true' if name == 'asgi' else 'false'}
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', *SERVERS[name], '--workers', str(workers),
+             '--bind', f'127.0.0.1:{port}', '--log-level', 'warning'],
+            env=env,
+        )
+        try:
+            base_url = f'http://127.0.0.1:{port}'
+            self.wait_ready(base_url, process)
+            yield base_url
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+
+    def wait_ready(self, base_url, process, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise CommandError(f"Le serveur s'est arrêté au démarrage (code {process.returncode})")
+            try:
+                urllib.request.urlopen(base_url + '/api/categories/', timeout=1).read()
+                return
+            except (urllib.error.URLError, ConnectionError, TimeoutError):
+                time.sleep(0.2)
+        raise CommandError(f"Serveur injoignable sur {base_url}")
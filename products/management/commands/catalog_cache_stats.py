@@ -0,0 +1,15 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from products import cache
+
+
+class Command(BaseCommand):
+    help = "Affiche les compteurs hit/miss du cache du catalogue"
+
+    def add_arguments(self, parser):
+        parser.add_argument('views', nargs='*', help="ex. ProductViewSet.list")
+
+    def handle(self, *args, **options):
+        self.stdout.write(json.dumps(cache.get_stats(options['views']), indent=2))
@@ -0,0 +1,278 @@
+import csv
+import io
+import json
+import os
+import sys
+import time
+from decimal import Decimal, InvalidOperation
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models.functions import Now
+from django.utils.text import slugify
+
+from products import cache, tasks
+from products.models import Category, Product
+from products.search import get_search_backend
+
+TRUE_VALUES = {'1', 'true', 'yes', 'oui', 'vrai'}
+FALSE_VALUES = {'0', 'false', 'no', 'non', 'faux', ''}
+
+
+def parse_decimal(value):
+    try:
+        return Decimal(str(value).strip().replace(',', '.'))
+    except InvalidOperation:
+        raise ValueError(f"nombre invalide : {value!r}")
+
+
+def parse_optional_decimal(value):
+    return None if value in (None, '') else parse_decimal(value)
+
+
+def parse_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"entier invalide : {value!r}")
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    normalized = str(value).strip().lower()
+    if normalized in TRUE_VALUES:
+        return True
+    if normalized in FALSE_VALUES:
+        return False
+    raise ValueError(f"booléen invalide : {value!r}")
+
+
+def parse_text(value):
+    return '' if value is None else str(value)
+
+
+# Colonnes importables et leur conversion ; s'y ajoutent slug et category (slug de la catégorie)
+PARSERS = {
+    'name': parse_text,
+    'description': parse_text,
+    'price': parse_decimal,
+    'discount_price': parse_optional_decimal,
+    'stock': parse_int,
+    'ingredients': parse_text,
+    'usage_instructions': parse_text,
+    'weight': parse_text,
+    'is_active': parse_bool,
+    'is_featured': parse_bool,
+    'image': parse_text,
+    'thumbnail': parse_text,
+}
+IMPORTED_FIELDS = [*PARSERS, 'category_id']
+SEARCH_FIELDS = {'name', 'description', 'ingredients'}
+SLUG_LENGTH = Product._meta.get_field('slug').max_length
+
+
+def iter_csv(handle):
+    yield from csv.DictReader(handle)
+
+
+def iter_ndjson(handle):
+    for line in handle:
+        if line.strip():
+            yield json.loads(line)
+
+
+def iter_json(handle, buffer_size=1 << 16):
+    """ Éléments d'un tableau JSON lus au fil du fichier, sans charger le tableau entier """
+    decoder = json.JSONDecoder()
+    buffer = handle.read(buffer_size).lstrip()
+    if not buffer.startswith('['):
+        raise CommandError("Le fichier JSON doit contenir un tableau d'objets")
+    buffer = buffer[1:]
+    while True:
+        buffer = buffer.lstrip().lstrip(',').lstrip()
+        if buffer.startswith(']'):
+            return
+        try:
+            item, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            more = handle.read(buffer_size)
+            if not more:
+                raise CommandError("Fichier JSON tronqué")
+            buffer += more
+            continue
+        yield item
+        buffer = buffer[end:]
+
+
+READERS = {'csv': iter_csv, 'ndjson': iter_ndjson, 'jsonl': iter_ndjson, 'json': iter_json}
+
+
+class Command(BaseCommand):
+    help = (
+        "Importe ou met à jour des produits depuis un fichier CSV, JSON ou NDJSON, par lots "
+        "(bulk_create avec mise à jour sur conflit de slug)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Fichier à importer, ou - pour l'entrée standard")
+        parser.add_argument('--format', choices=sorted(READERS), help="Déduit de l'extension par défaut")
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Affiche les créations et modifications sans rien écrire")
+        parser.add_argument('--create-categories', action='store_true',
+                            help="Crée les catégories inconnues au lieu de rejeter les lignes")
+
+    def handle(self, *args, **options):
+        import_format = options['format'] or os.path.splitext(options['path'])[1].lstrip('.').lower()
+        if import_format not in READERS:
+            raise CommandError("Format inconnu : préciser --format")
+        self.dry_run = options['dry_run']
+        self.create_categories = options['create_categories']
+        self.categories = dict(Category.objects.values_list('slug', 'pk'))
+        self.generated_slugs = {}
+        self.touched_categories = set()
+        self.stats = dict.fromkeys(('created', 'updated', 'unchanged', 'errors'), 0)
+        self.search_backend = get_search_backend()
+        started = time.perf_counter()
+
+        if options['path'] == '-':
+            handle = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8-sig')
+        else:
+            handle = open(options['path'], encoding='utf-8-sig', newline='')
+        with handle:
+            chunk = []
+            for line, row in enumerate(READERS[import_format](handle), start=1):
+                chunk.append((line, row))
+                if len(chunk) >= options['chunk_size']:
+                    self.import_chunk(chunk)
+                    chunk = []
+            if chunk:
+                self.import_chunk(chunk)
+
+        if not self.dry_run and (self.stats['created'] or self.stats['updated']):
+            with transaction.atomic():
+                # Une seule invalidation pour tout l'import au lieu d'une par ligne
+                Category.objects.filter(pk__in=self.touched_categories).update(updated_at=Now())
+                cache.bump_generation_on_commit(Product, Category)
+                tasks.rebuild_similarity_index.enqueue_on_commit(unique=True)
+
+        elapsed = time.perf_counter() - started
+        total = sum(self.stats.values())
+        self.stdout.write(self.style.SUCCESS(
+            f"{'Simulation : ' if self.dry_run else ''}{total} lignes en {elapsed:.1f} s "
+            f"({total / elapsed if elapsed else 0:.0f} lignes/s) : "
+            f"{self.stats['created']} créés, {self.stats['updated']} modifiés, "
+            f"{self.stats['unchanged']} inchangés, {self.stats['errors']} erreurs"
+        ))
+
+    def error(self, line, message):
+        self.stats['errors'] += 1
+        self.stderr.write(f"Ligne {line} : {message}")
+
+    def resolve_category(self, slug):
+        if slug not in self.categories and self.create_categories:
+            if self.dry_run:
+                self.stdout.write(f"+ catégorie {slug}")
+                self.categories[slug] = None
+            else:
+                category, _ = Category.objects.get_or_create(
+                    slug=slug, defaults={'name': slug.replace('-', ' ').capitalize()}
+                )
+                self.categories[slug] = category.pk
+        if slug not in self.categories:
+            raise ValueError(f"catégorie inconnue : {slug!r}")
+        return self.categories[slug]
+
+    def make_slug(self, row):
+        """
+        Slug fourni, sinon dérivé du nom ; les homonymes du fichier reçoivent
+        un suffixe selon leur ordre d'apparition, ce qui rend un nouvel import
+        du même fichier idempotent.
+        """
+        if row.get('slug'):
+            return slugify(row['slug'])[:SLUG_LENGTH]
+        base = slugify(row.get('name') or '')
+        if not base:
+            raise ValueError("ni slug ni nom")
+        occurrence = self.generated_slugs.get(base, 0) + 1
+        self.generated_slugs[base] = occurrence
+        suffix = f'-{occurrence}' if occurrence > 1 else ''
+        return base[:SLUG_LENGTH - len(suffix)] + suffix
+
+    def parse_row(self, row):
+        values = {
+            field: parser(row[field]) for field, parser in PARSERS.items() if field in row
+        }
+        if row.get('category'):
+            values['category_id'] = self.resolve_category(row['category'])
+        return self.make_slug(row), values
+
+    def import_chunk(self, chunk):
+        records = {}
+        for line, row in chunk:
+            try:
+                slug, values = self.parse_row(row)
+            except (ValueError, TypeError, AttributeError) as error:
+                self.error(line, error)
+                continue
+            # Un même slug deux fois dans le lot : la dernière ligne l'emporte
+            records[slug] = (line, values)
+
+        fields = sorted({field for _, values in records.values() for field in values})
+        existing = {
+            product['slug']: product
+            for product in Product.objects.filter(slug__in=records).values('slug', *IMPORTED_FIELDS)
+        }
+
+        to_save, reindex, new_images = [], [], []
+        for slug, (line, values) in records.items():
+            current = existing.get(slug)
+            if current is None:
+                if 'name' not in values or 'price' not in values or 'category_id' not in values:
+                    self.error(line, "nom, prix et catégorie requis pour un nouveau produit")
+                    continue
+                changes = values
+                self.stats['created'] += 1
+            else:
+                changes = {field: value for field, value in values.items() if current[field] != value}
+                if not changes:
+                    self.stats['unchanged'] += 1
+                    continue
+                self.stats['updated'] += 1
+
+            if self.dry_run:
+                self.show_diff(slug, current, changes)
+                continue
+            # L'INSERT ... ON CONFLICT porte toutes les colonnes : celles absentes
+            # de la ligne reprennent leur valeur actuelle
+            to_save.append(Product(**{**(current or {}), **values, 'slug': slug}))
+            self.touched_categories.update({values.get('category_id'), (current or {}).get('category_id')} - {None})
+            if current is None or SEARCH_FIELDS & changes.keys():
+                reindex.append(slug)
+            if 'image' in changes:
+                new_images.append(slug)
+
+        if self.dry_run or not to_save:
+            return
+        with transaction.atomic():
+            Product.objects.bulk_create(
+                to_save, update_conflicts=True, unique_fields=['slug'],
+                update_fields=[*fields, 'updated_at'],
+            )
+            saved = Product.objects.filter(slug__in=reindex + new_images).only(
+                'pk', 'slug', 'name', 'description', 'ingredients'
+            )
+            if self.search_backend is not None:
+                self.search_backend.index_products([product for product in saved if product.slug in reindex])
+            tasks.generate_image_renditions.enqueue_many(
+                [(Product._meta.label, product.pk) for product in saved if product.slug in new_images]
+            )
+
+    def show_diff(self, slug, current, changes):
+        if current is None:
+            self.stdout.write(f"+ {slug}")
+            return
+        self.stdout.write(f"~ {slug}")
+        for field, value in changes.items():
+            self.stdout.write(f"    {field} : {current[field]!r} -> {value!r}")
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Max, Min, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from products import cache
+from products.models import Product, Review
+
+
+def rating_aggregates():
+    """
+    Agrégats de notes de chaque produit en sous-requêtes corrélées : calculés
+    par la base dans l'UPDATE lui-même, un avis écrit entre-temps n'est pas écrasé
+    par une valeur lue plus tôt
+    """
+    reviews = Review.objects.filter(product=OuterRef('pk')).order_by().values('product')
+
+    def aggregate(expression):
+        return Coalesce(Subquery(reviews.annotate(value=expression).values('value')), 0)
+
+    return {
+        'rating_sum': aggregate(Sum('rating')),
+        'rating_count': aggregate(Count('id')),
+        **{
+            f'rating_{rating}_count': aggregate(Count('id', filter=Q(rating=rating)))
+            for rating in Review.RATING_RANGE
+        },
+    }
+
+
+class Command(BaseCommand):
+    help = "Recalcule en masse les agrégats de notes stockés sur Product à partir des avis"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Produits par requête UPDATE (tranches d'identifiants)")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        bounds = Product.objects.aggregate(first=Min('pk'), last=Max('pk'))
+        aggregates = rating_aggregates()
+
+        updated = 0
+        with transaction.atomic():
+            if bounds['first'] is not None:
+                for start in range(bounds['first'], bounds['last'] + 1, batch_size):
+                    updated += Product.objects.filter(pk__gte=start, pk__lt=start + batch_size).update(**aggregates)
+            cache.bump_generation_on_commit(Product)
+
+        self.stdout.write(self.style.SUCCESS(f"{updated} produits mis à jour"))
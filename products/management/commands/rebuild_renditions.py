@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from products.renditions import IMAGE_FIELDS, generate_renditions, needs_renditions
+
+
+class Command(BaseCommand):
+    help = "Génère les déclinaisons (largeurs et WebP) manquantes des images du catalogue"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help="Régénère aussi les déclinaisons à jour")
+
+    def handle(self, *args, **options):
+        for model in IMAGE_FIELDS:
+            processed = 0
+            for instance in model.objects.order_by('pk').iterator(chunk_size=500):
+                if options['force'] or needs_renditions(instance):
+                    processed += generate_renditions(model, instance.pk, force=options['force'])
+            self.stdout.write(f"{model._meta.verbose_name_plural} : {processed} images déclinées")
+        self.stdout.write(self.style.SUCCESS("Déclinaisons à jour"))
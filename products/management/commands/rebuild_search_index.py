@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from products import cache
+from products.models import Product
+from products.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = "Reconstruit l'index de recherche plein texte des produits"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        backend = get_search_backend(options['database'])
+        if backend is None:
+            self.stderr.write("Aucun moteur de recherche plein texte pour cette base")
+            return
+        queryset = Product.objects.using(options['database']).only('pk', 'name', 'description', 'ingredients')
+        with transaction.atomic(using=options['database']):
+            indexed = backend.rebuild(queryset, chunk_size=options['batch_size'])
+            cache.bump_generation_on_commit(Product, using=options['database'])
+        self.stdout.write(self.style.SUCCESS(f"{indexed} produits indexés"))
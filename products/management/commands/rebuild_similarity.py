@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from products.similarity import get_top_k, rebuild_similarity_index
+
+
+class Command(BaseCommand):
+    help = "Recalcule l'index des produits similaires (top K voisins par produit)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=None)
+        parser.add_argument('--chunk-size', type=int, default=512)
+
+    def handle(self, *args, **options):
+        top_k = options['top_k'] or get_top_k()
+        count = rebuild_similarity_index(chunk_size=options['chunk_size'], top_k=top_k)
+        self.stdout.write(self.style.SUCCESS(f"{count} produits indexés ({top_k} voisins max)"))
@@ -0,0 +1,54 @@
+import multiprocessing
+import signal
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from products.queue import Worker
+
+
+def run_worker(concurrency, poll_interval, burst):
+    worker = Worker(concurrency=concurrency, poll_interval=poll_interval)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    return worker.run(burst=burst)
+
+
+class Command(BaseCommand):
+    help = "Exécute les tâches différées de la file en base (retries, tâches planifiées et périodiques)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=2, help="Threads par processus")
+        parser.add_argument('--processes', type=int, default=1, help="Processus workers")
+        parser.add_argument('--poll-interval', type=float, default=1.0, help="Secondes entre deux lectures de la file vide")
+        parser.add_argument('--burst', action='store_true', help="S'arrêter dès que la file est vide")
+
+    def handle(self, *args, **options):
+        worker_args = (options['concurrency'], options['poll_interval'], options['burst'])
+        self.stdout.write(
+            f"Worker démarré : {options['processes']} processus x {options['concurrency']} threads"
+        )
+        if options['processes'] == 1:
+            executed = run_worker(*worker_args)
+            self.stdout.write(self.style.SUCCESS(f"{executed} tâches exécutées"))
+            return
+
+        # Les processus enfants ne doivent pas hériter des connexions du parent
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        processes = [
+            context.Process(target=run_worker, args=worker_args) for _ in range(options['processes'])
+        ]
+        for process in processes:
+            process.start()
+
+        def stop(*args):
+            # SIGTERM aux enfants : ils terminent leurs tâches en cours puis s'arrêtent
+            for process in processes:
+                process.terminate()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        for process in processes:
+            process.join()
+        self.stdout.write(self.style.SUCCESS("Workers arrêtés"))
@@ -0,0 +1,231 @@
+import random
+import secrets
+import time
+from bisect import bisect
+from decimal import Decimal
+from itertools import accumulate
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.text import slugify
+
+from products import cache
+from products.models import (
+    Category, Order, OrderItem, Product, ProductImage, Review, Wishlist
+)
+from products.search import get_search_backend
+
+CATEGORY_NAMES = [
+    'Soins du visage', 'Soins du corps', 'Cheveux', 'Maquillage', 'Parfums',
+    'Hygiène', 'Bébé', 'Solaires', 'Homme', 'Bien-être',
+]
+PRODUCT_TYPES = [
+    'Crème', 'Sérum', 'Lait', 'Huile', 'Baume', 'Gel', 'Masque', 'Shampooing',
+    'Savon', 'Lotion', 'Gommage', 'Eau micellaire',
+]
+PRODUCT_QUALITIES = [
+    'hydratant', 'nourrissant', 'apaisant', 'purifiant', 'revitalisant',
+    'éclat', 'anti-âge', 'matifiant', 'réparateur', 'protecteur',
+]
+INGREDIENTS = [
+    "huile d'argan", 'beurre de karité', 'aloe vera', 'acide hyaluronique',
+    'glycérine', 'vitamine E', 'huile de jojoba', 'eau de rose', 'argile blanche',
+    'beurre de cacao', 'huile de coco', 'extrait de thé vert', 'niacinamide',
+    'panthénol', 'camomille', 'lavande', 'calendula', 'huile d\'amande douce',
+]
+FIRST_NAMES = ['Camille', 'Léa', 'Manon', 'Chloé', 'Inès', 'Lucas', 'Hugo', 'Louis', 'Nathan', 'Sarah']
+LAST_NAMES = ['Martin', 'Bernard', 'Dubois', 'Thomas', 'Robert', 'Richard', 'Petit', 'Durand', 'Leroy', 'Moreau']
+COMMENTS = [
+    'Très bon produit, je recommande.', 'Texture agréable, odeur légère.',
+    'Correct mais un peu cher.', 'Ne convient pas à ma peau.', 'Parfait, déjà racheté deux fois.',
+]
+# Notes très majoritairement positives, comme sur la plupart des boutiques
+RATING_WEIGHTS = {1: 4, 2: 5, 3: 12, 4: 32, 5: 47}
+ORDER_STATUS_WEIGHTS = {'delivered': 70, 'shipped': 10, 'processing': 8, 'pending': 7, 'cancelled': 5}
+
+
+class Command(BaseCommand):
+    help = (
+        "Génère un catalogue synthétique (catégories, produits, images, avis, listes de "
+        "souhaits, commandes) par bulk_create en lots ; adapté à des millions de lignes"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--products', type=int, default=1000)
+        parser.add_argument('--images-per-product', type=int, default=2,
+                            help="Nombre moyen d'images additionnelles par produit")
+        parser.add_argument('--reviews-per-product', type=float, default=5,
+                            help="Nombre moyen d'avis par produit (distribution à queue lourde)")
+        parser.add_argument('--wishlists', type=int, default=200)
+        parser.add_argument('--orders', type=int, default=2000)
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--no-search-index', action='store_true',
+                            help="Ne pas alimenter l'index plein texte (rebuild_search_index plus tard)")
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.chunk_size = options['chunk_size']
+        self.run = secrets.token_hex(3)
+        started = time.perf_counter()
+
+        categories = self.create_categories(options['categories'])
+        product_ids, prices = self.create_products(categories, options)
+        # Popularité de Zipf : quelques produits concentrent avis, favoris et ventes
+        popularity = list(accumulate(1 / (rank + 1) for rank in range(len(product_ids))))
+        self.random.shuffle(product_ids)
+        self.create_wishlists(product_ids, popularity, options['wishlists'])
+        self.create_orders(product_ids, prices, popularity, options['orders'])
+        cache.bump_generation_on_commit(Category, Product, ProductImage, Review)
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Catalogue généré en {elapsed:.1f} s ; lancer rebuild_similarity pour l'index de similarité"
+        ))
+
+    def log(self, message):
+        self.stdout.write(message)
+
+    def pick(self, weights):
+        return self.random.choices(list(weights), weights=list(weights.values()))[0]
+
+    def create_categories(self, count):
+        categories = Category.objects.bulk_create([
+            Category(
+                name=f'{CATEGORY_NAMES[index % len(CATEGORY_NAMES)]} {index // len(CATEGORY_NAMES) + 1}',
+                slug=f'{slugify(CATEGORY_NAMES[index % len(CATEGORY_NAMES)])}-{self.run}-{index}',
+                description='Catégorie générée',
+            )
+            for index in range(count)
+        ], batch_size=self.chunk_size)
+        self.log(f"{len(categories)} catégories")
+        return categories
+
+    def create_products(self, categories, options):
+        total = options['products']
+        search_backend = None if options['no_search_index'] else get_search_backend()
+        # Tailles de catégories inégales : poids tirés d'une loi de Pareto
+        category_weights = list(accumulate(self.random.paretovariate(1.5) for _ in categories))
+        product_ids, prices = [], {}
+        mean_reviews = options['reviews_per_product']
+
+        for start in range(0, total, self.chunk_size):
+            products, reviews, images = [], [], []
+            for index in range(start, min(start + self.chunk_size, total)):
+                product = self.build_product(index, categories, category_weights)
+                # Nombre d'avis à queue lourde (Pareto, alpha=2) de moyenne mean_reviews
+                reviews_count = min(int((self.random.paretovariate(2) - 1) * mean_reviews), 10000)
+                ratings = [self.pick(RATING_WEIGHTS) for _ in range(reviews_count)]
+                product.rating_sum = sum(ratings)
+                product.rating_count = len(ratings)
+                for rating in Review.RATING_RANGE:
+                    setattr(product, f'rating_{rating}_count', ratings.count(rating))
+                products.append((product, ratings))
+
+            with transaction.atomic():
+                created = Product.objects.bulk_create([product for product, _ in products])
+                for product, ratings in products:
+                    reviews.extend(
+                        Review(
+                            product=product, rating=rating, comment=self.random.choice(COMMENTS),
+                            is_verified_purchase=self.random.random() < 0.6,
+                        )
+                        for rating in ratings
+                    )
+                    images.extend(
+                        ProductImage(
+                            product=product, image=f'products/additional/seed-{product.pk}-{order}.jpg',
+                            alt_text=product.name, order=order,
+                        )
+                        for order in range(self.random.randint(0, options['images_per_product'] * 2))
+                    )
+                Review.objects.bulk_create(reviews, batch_size=self.chunk_size)
+                ProductImage.objects.bulk_create(images, batch_size=self.chunk_size)
+                if search_backend is not None:
+                    search_backend.index_products(created)
+
+            for product in created:
+                product_ids.append(product.pk)
+                prices[product.pk] = product.price
+            self.log(f"{len(product_ids)}/{total} produits")
+        return product_ids, prices
+
+    def build_product(self, index, categories, category_weights):
+        name = (
+            f'{self.random.choice(PRODUCT_TYPES)} {self.random.choice(PRODUCT_QUALITIES)} '
+            f'{self.random.choice(INGREDIENTS)}'
+        )
+        category = categories[bisect(category_weights, self.random.random() * category_weights[-1])]
+        # Prix log-normaux (médiane ~ 18 €), quelques promotions
+        price = Decimal(str(round(min(self.random.lognormvariate(2.9, 0.6), 99999), 2)))
+        discount = (price * Decimal('0.8')).quantize(Decimal('0.01')) if self.random.random() < 0.15 else None
+        return Product(
+            name=name.capitalize(),
+            slug=f'{slugify(name)[:30]}-{self.run}-{index}',
+            description=f'{name.capitalize()} pour un usage quotidien.',
+            ingredients=', '.join(self.random.sample(INGREDIENTS, self.random.randint(2, 6))),
+            usage_instructions='Appliquer matin et soir.',
+            weight=f'{self.random.choice([30, 50, 100, 200, 250, 500])} ml',
+            price=price,
+            discount_price=discount,
+            category=category,
+            # Stock : beaucoup de petits stocks, quelques ruptures
+            stock=0 if self.random.random() < 0.08 else int(self.random.expovariate(1 / 40)),
+            image=f'products/seed-{index}.jpg',
+            is_featured=self.random.random() < 0.05,
+        )
+
+    def sample_products(self, product_ids, popularity, count):
+        return {
+            product_ids[bisect(popularity, self.random.random() * popularity[-1])]
+            for _ in range(count)
+        }
+
+    def create_wishlists(self, product_ids, popularity, count):
+        through = Wishlist.products.through
+        for start in range(0, count, self.chunk_size):
+            with transaction.atomic():
+                wishlists = Wishlist.objects.bulk_create(
+                    [Wishlist() for _ in range(min(self.chunk_size, count - start))]
+                )
+                links = [
+                    through(wishlist_id=wishlist.pk, product_id=product_id)
+                    for wishlist in wishlists
+                    for product_id in self.sample_products(
+                        product_ids, popularity, int(self.random.expovariate(1 / 6)) + 1
+                    )
+                ]
+                through.objects.bulk_create(links, batch_size=self.chunk_size)
+        self.log(f"{count} listes de souhaits")
+
+    def create_orders(self, product_ids, prices, popularity, count):
+        for start in range(0, count, self.chunk_size):
+            orders, lines = [], []
+            for _ in range(min(self.chunk_size, count - start)):
+                items = [
+                    (product_id, 1 + int(self.random.expovariate(1)))
+                    for product_id in self.sample_products(
+                        product_ids, popularity, 1 + int(self.random.expovariate(1 / 1.5))
+                    )
+                ]
+                first_name, last_name = self.random.choice(FIRST_NAMES), self.random.choice(LAST_NAMES)
+                orders.append(Order(
+                    first_name=first_name,
+                    last_name=last_name,
+                    email=f'{slugify(first_name)}.{slugify(last_name)}{self.random.randint(1, 9999)}@example.com',
+                    address=f'{self.random.randint(1, 200)} rue de la Paix, Paris',
+                    status=self.pick(ORDER_STATUS_WEIGHTS),
+                    total_price=sum(prices[product_id] * quantity for product_id, quantity in items),
+                ))
+                lines.append(items)
+
+            with transaction.atomic():
+                Order.objects.bulk_create(orders)
+                OrderItem.objects.bulk_create([
+                    OrderItem(order=order, product_id=product_id, quantity=quantity,
+                              price=prices[product_id] * quantity)
+                    for order, items in zip(orders, lines)
+                    for product_id, quantity in items
+                ], batch_size=self.chunk_size)
+            self.log(f"{min(start + self.chunk_size, count)}/{count} commandes")
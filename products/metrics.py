@@ -0,0 +1,144 @@
+"""
+Métriques Prometheus, servies au format texte par /metrics.
+
+- http_request_duration_seconds : histogramme des requêtes par route (nom de
+  l'URL, ou son motif si elle n'est pas nommée), méthode et statut ;
+- http_request_db_queries et db_query_duration_seconds : requêtes SQL par
+  requête HTTP, et durée de chacune par base ;
+- catalog_cache_requests_total : hits et misses du cache du catalogue par vue
+  (taux de hit : rate des hits / rate du total) ;
+- gunicorn_* : workers vivants, requêtes et mémoire de chaque worker, sorties
+  de workers ;
+- compteurs métier : commandes créées, lignes de commande, réservations de
+  stock refusées, avis déposés.
+
+Les requêtes ne sont mesurées par timing.ServerTimingMiddleware, et /metrics
+servi, qu'avec METRICS_ENABLED.
+Sous gunicorn, chaque worker écrit ses valeurs dans PROMETHEUS_MULTIPROC_DIR
+(défini par gunicorn.conf.py) et /metrics agrège les fichiers de tous les
+workers, quel que soit celui qui répond.
+"""
+import os
+import resource
+
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest,
+    multiprocess,
+)
+
+REQUEST_DURATION = Histogram(
+    'http_request_duration_seconds', "Durée des requêtes HTTP", ['route', 'method', 'status'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+REQUEST_QUERIES = Histogram(
+    'http_request_db_queries', "Requêtes SQL par requête HTTP", ['route'],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89),
+)
+QUERY_DURATION = Histogram(
+    'db_query_duration_seconds', "Durée des requêtes SQL", ['alias'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    'http_requests_in_flight', "Requêtes HTTP en cours", multiprocess_mode='livesum',
+)
+CACHE_REQUESTS = Counter(
+    'catalog_cache_requests', "Lectures du cache du catalogue", ['view', 'result'],
+)
+
+WORKERS = Gauge('gunicorn_workers', "Workers gunicorn vivants", multiprocess_mode='livesum')
+WORKER_REQUESTS = Gauge(
+    'gunicorn_worker_requests', "Requêtes servies par chaque worker vivant", multiprocess_mode='liveall',
+)
+WORKER_MAX_RSS = Gauge(
+    'gunicorn_worker_max_rss_bytes', "Mémoire résidente maximale de chaque worker vivant",
+    multiprocess_mode='liveall',
+)
+WORKER_EXITS = Counter('gunicorn_worker_exits', "Workers gunicorn terminés (redémarrages compris)")
+
+ORDERS_CREATED = Counter('orders_created', "Commandes créées")
+ORDER_ITEMS = Counter('order_line_items', "Lignes des commandes créées")
+STOCK_RESERVATION_FAILURES = Counter('stock_reservation_failures', "Commandes refusées faute de stock")
+REVIEWS_SUBMITTED = Counter('reviews_submitted', "Avis déposés")
+
+UNMATCHED_ROUTE = 'unmatched'
+
+
+def route_name(request):
+    """ Libellé de la route : borné, identique pour les vues synchrones et asynchrones """
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return UNMATCHED_ROUTE
+    return match.view_name if match.url_name else match.route
+
+
+def request_started():
+    REQUESTS_IN_FLIGHT.inc()
+
+
+def observe_request(request, response, timing):
+    """ Enregistre une requête terminée (``timing`` : timing.RequestTiming) """
+    route = route_name(request)
+    REQUESTS_IN_FLIGHT.dec()
+    REQUEST_DURATION.labels(route, request.method, response.status_code).observe(timing.spans['total'] / 1000)
+    REQUEST_QUERIES.labels(route).observe(timing.sql_count)
+    WORKER_REQUESTS.inc()
+    # ru_maxrss est en kilo-octets sous Linux
+    WORKER_MAX_RSS.set(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+
+def observe_query(alias, duration):
+    QUERY_DURATION.labels(alias).observe(duration / 1000)
+
+
+def record_cache(view_name, result):
+    CACHE_REQUESTS.labels(view_name, result).inc()
+
+
+def record_order(line_items):
+    ORDERS_CREATED.inc()
+    ORDER_ITEMS.inc(line_items)
+
+
+def worker_started():
+    """ Hook post_worker_init de gunicorn (dans le worker) """
+    WORKERS.set(1)
+
+
+def worker_exited(pid):
+    """ Hook child_exit de gunicorn (dans le processus maître) """
+    WORKER_EXITS.inc()
+    if is_multiprocess():
+        multiprocess.mark_process_dead(pid)
+
+
+def is_multiprocess():
+    return 'PROMETHEUS_MULTIPROC_DIR' in os.environ
+
+
+def render():
+    """ Exposition texte : agrégée sur tous les workers en multiprocessus """
+    if is_multiprocess():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
+
+
+def metrics_view(request):
+    """
+    /metrics, si METRICS_ENABLED : réservé au personnel connecté ou, pour le
+    collecteur, à « Authorization: Bearer <METRICS_TOKEN> »
+    """
+    if not getattr(settings, 'METRICS_ENABLED', False):
+        raise Http404
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    authorized = request.user.is_staff or (
+        token and constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}')
+    )
+    if not authorized:
+        return HttpResponseForbidden()
+    return HttpResponse(render(), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,110 @@
+"""
+Index plein texte des produits (voir products/search.py) : table FTS5 sous
+SQLite, table de documents tsvector + GIN sous PostgreSQL, remplies à partir
+des produits existants.
+
+Le DDL et la normalisation du texte sont recopiés ici tels qu'à la création
+de l'index, pour que la migration ne dépende pas du code courant de
+l'application ; rebuild_search_index réindexe avec le code courant.
+"""
+import re
+import unicodedata
+
+from django.db import migrations
+
+FRENCH_SUFFIXES = (
+    'issements', 'issement', 'ements', 'ement', 'ations', 'ation', 'atrices',
+    'atrice', 'ateurs', 'ateur', 'euses', 'euse', 'antes', 'ante', 'ants',
+    'ant', 'iques', 'ique', 'ives', 'ive', 'ifs', 'if', 'eux', 'ees', 'ee',
+    'es', 'er', 'e', 's', 'x',
+)
+
+
+def stem(word):
+    if word.endswith('aux') and len(word) > 5:
+        return word[:-3] + 'al'
+    for suffix in FRENCH_SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKD', (text or '').lower())
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(stem(word) for word in re.findall(r'\w+', text))
+
+
+def install_sqlite(schema_editor, Product):
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS products_product_fts "
+        "USING fts5(name, description, ingredients, tokenize='unicode61 remove_diacritics 2')"
+    )
+    products = Product.objects.using(schema_editor.connection.alias).values_list(
+        'pk', 'name', 'description', 'ingredients'
+    )
+    with schema_editor.connection.cursor() as cursor:
+        cursor.executemany(
+            'INSERT INTO products_product_fts (rowid, name, description, ingredients) VALUES (%s, %s, %s, %s)',
+            [(pk, normalize(name), normalize(description), normalize(ingredients))
+             for pk, name, description, ingredients in products.iterator()]
+        )
+
+
+def install_postgresql(schema_editor, Product):
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS unaccent')
+    schema_editor.execute("""
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_ts_config WHERE cfgname = 'french_unaccent') THEN
+                CREATE TEXT SEARCH CONFIGURATION french_unaccent (COPY = french);
+                ALTER TEXT SEARCH CONFIGURATION french_unaccent
+                    ALTER MAPPING FOR hword, hword_part, word WITH unaccent, french_stem;
+            END IF;
+        END
+        $$
+    """)
+    schema_editor.execute("""
+        CREATE TABLE IF NOT EXISTS products_product_search (
+            product_id bigint PRIMARY KEY REFERENCES products_product (id) ON DELETE CASCADE,
+            document tsvector NOT NULL
+        )
+    """)
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS products_product_search_gin ON products_product_search USING GIN (document)'
+    )
+    schema_editor.execute("""
+        INSERT INTO products_product_search (product_id, document)
+        SELECT id,
+            setweight(to_tsvector('french_unaccent', name), 'A') ||
+            setweight(to_tsvector('french_unaccent', ingredients), 'B') ||
+            setweight(to_tsvector('french_unaccent', description), 'C')
+        FROM products_product
+        ON CONFLICT (product_id) DO NOTHING
+    """)
+
+
+def install_search_index(apps, schema_editor):
+    install = {'sqlite': install_sqlite, 'postgresql': install_postgresql}.get(schema_editor.connection.vendor)
+    if install is not None:
+        install(schema_editor, apps.get_model('products', 'Product'))
+
+
+def uninstall_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS products_product_fts')
+    elif vendor == 'postgresql':
+        schema_editor.execute('DROP TABLE IF EXISTS products_product_search')
+        schema_editor.execute('DROP TEXT SEARCH CONFIGURATION IF EXISTS french_unaccent')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("products", "0005_keyset_pagination_indexes"),
+    ]
+
+    operations = [
+        migrations.RunPython(install_search_index, uninstall_search_index),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def queue_similarity_rebuild(apps, schema_editor):
+    # L'index inversé est vide : les mises à jour incrémentales n'auraient rien
+    # à comparer tant que rebuild_similarity n'est pas passé
+    db_alias = schema_editor.connection.alias
+    if apps.get_model('products', 'Product').objects.using(db_alias).exists():
+        apps.get_model('products', 'Task').objects.using(db_alias).create(
+            name='products.tasks.rebuild_similarity_index', run_at=timezone.now(), priority=-1, max_attempts=3,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0012_task_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductFeature',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('feature', models.IntegerField()),
+                ('weight', models.FloatField()),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='similarity_features', to='products.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['feature', 'product'], name='feature_product_idx')],
+                'unique_together': {('product', 'feature')},
+            },
+        ),
+        migrations.RunPython(queue_similarity_rebuild, migrations.RunPython.noop),
+    ]
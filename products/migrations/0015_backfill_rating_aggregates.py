@@ -0,0 +1,35 @@
+"""
+Agrégats de notes des avis existants : 0004 a ajouté les colonnes à zéro et
+seuls les avis écrits depuis sont comptés par les signaux. Recalculés en une
+requête UPDATE, comme rebuild_ratings, pour toutes les bases qu'elles aient
+déjà appliqué 0004 ou non.
+"""
+from django.db import migrations
+from django.db.models import Count, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def backfill_rating_aggregates(apps, schema_editor):
+    Product = apps.get_model('products', 'Product')
+    Review = apps.get_model('products', 'Review')
+    reviews = Review.objects.filter(product=OuterRef('pk')).order_by().values('product')
+
+    def aggregate(expression):
+        return Coalesce(Subquery(reviews.annotate(value=expression).values('value')), 0)
+
+    Product.objects.using(schema_editor.connection.alias).update(
+        rating_sum=aggregate(Sum('rating')),
+        rating_count=aggregate(Count('id')),
+        **{f'rating_{rating}_count': aggregate(Count('id', filter=Q(rating=rating))) for rating in range(1, 6)}
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0014_task_heartbeat_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_rating_aggregates, migrations.RunPython.noop),
+    ]
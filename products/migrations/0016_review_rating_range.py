@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:14
+"""
+Contrainte de base sur Review.rating (1 à 5), que supposent les colonnes
+rating_<n>_count de Product. Les notes hors bornes déjà enregistrées sont
+ramenées dans l'intervalle et les agrégats de leurs produits recalculés.
+"""
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def clamp_ratings(apps, schema_editor):
+    Product = apps.get_model('products', 'Product')
+    Review = apps.get_model('products', 'Review')
+    reviews = Review.objects.using(schema_editor.connection.alias)
+    out_of_range = reviews.filter(Q(rating__lt=1) | Q(rating__gt=5))
+    product_ids = list(out_of_range.values_list('product_id', flat=True).distinct())
+    if not product_ids:
+        return
+    reviews.filter(rating__lt=1).update(rating=1)
+    reviews.filter(rating__gt=5).update(rating=5)
+
+    product_reviews = Review.objects.filter(product=OuterRef('pk')).order_by().values('product')
+
+    def aggregate(expression):
+        return Coalesce(Subquery(product_reviews.annotate(value=expression).values('value')), 0)
+
+    Product.objects.using(schema_editor.connection.alias).filter(pk__in=product_ids).update(
+        rating_sum=aggregate(Sum('rating')),
+        rating_count=aggregate(Count('id')),
+        **{f'rating_{rating}_count': aggregate(Count('id', filter=Q(rating=rating))) for rating in range(1, 6)}
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0015_backfill_rating_aggregates'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(clamp_ratings, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='review',
+            constraint=models.CheckConstraint(condition=models.Q(('rating__gte', 1), ('rating__lte', 5)), name='review_rating_range'),
+        ),
+    ]
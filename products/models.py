@@ -1,13 +1,30 @@
+from django.conf import settings
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
+from django.db.models import Count, F, Prefetch, Q
+from django.db.models.functions import Now
+from django.utils import timezone
 from django.utils.text import slugify
 
 
+class CategoryQuerySet(models.QuerySet):
+    def with_product_count(self):
+        """ Calcule le nombre de produits en base plutôt qu'une requête par catégorie """
+        return self.annotate(num_products=Count('products'))
+
+
 class Category(models.Model):
     name = models.CharField(max_length=100)
     description = models.TextField(blank=True)
     image = models.ImageField(upload_to='categories/', blank=True)
     slug = models.SlugField(unique=True)
     is_active = models.BooleanField(default=True)
+    # Déclinaisons de l'image générées par renditions.py
+    renditions = models.JSONField(default=dict, blank=True, editable=False)
+    # Aussi mis à jour quand un produit entre ou sort de la catégorie (voir signals.py)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = CategoryQuerySet.as_manager()
 
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -21,6 +38,69 @@ class Category(models.Model):
     def __str__(self):
         return self.name
 
+class ProductQuerySet(models.QuerySet):
+    def for_listing(self):
+        """ Queryset des endpoints de collection : seule la catégorie est jointe """
+        return self.select_related('category')
+
+    def for_detail(self):
+        """
+        Queryset de la fiche produit : catégorie (avec son nombre de produits) et
+        images préchargées. Les avis sont servis par /products/{slug}/reviews/ et
+        les notes sont lues depuis les champs stockés.
+        """
+        return self.prefetch_related(
+            Prefetch('category', queryset=Category.objects.with_product_count()),
+            'additional_images',
+        )
+
+    def facet_counts(self, price_bounds=()):
+        """
+        Effectifs des facettes du catalogue en une seule requête agrégée, groupée
+        par catégorie : produits en stock, mis en avant et par tranche de prix
+        (``price_bounds`` croissantes, tranches [borne, borne suivante[) ; les
+        totaux sont la somme des lignes.
+        """
+        ranges = list(zip((None, *price_bounds), (*price_bounds, None)))
+        aggregates = {
+            'count': Count('pk'),
+            'in_stock': Count('pk', filter=Q(stock__gt=0)),
+            'is_featured': Count('pk', filter=Q(is_featured=True)),
+        }
+        for index, (low, high) in enumerate(ranges):
+            condition = Q(
+                *([Q(price__gte=low)] if low is not None else []),
+                *([Q(price__lt=high)] if high is not None else []),
+            )
+            aggregates[f'price_{index}'] = Count('pk', filter=condition) if condition else Count('pk')
+        # Sans tri : un ORDER BY (pertinence, ?ordering=) s'ajouterait au GROUP BY
+        rows = list(
+            self.order_by().values('category', 'category__name', 'category__slug').annotate(**aggregates)
+        )
+
+        total = sum(row['count'] for row in rows)
+        flags = {}
+        for name in ('in_stock', 'is_featured'):
+            count = sum(row[name] for row in rows)
+            flags[name] = {'true': count, 'false': total - count}
+        return {
+            'count': total,
+            'category': [
+                {'id': row['category'], 'name': row['category__name'], 'slug': row['category__slug'], 'count': row['count']}
+                for row in sorted(rows, key=lambda row: row['category__name'])
+            ],
+            'price': [
+                {
+                    'min_price': str(low) if low is not None else None,
+                    'max_price': str(high) if high is not None else None,
+                    'count': sum(row[f'price_{index}'] for row in rows),
+                }
+                for index, (low, high) in enumerate(ranges)
+            ],
+            **flags,
+        }
+
+
 class Product(models.Model):
     name = models.CharField(max_length=200)
     description = models.TextField()
@@ -37,6 +117,32 @@ class Product(models.Model):
     slug = models.SlugField(unique=True)
     discount_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Déclinaisons de image et thumbnail générées par renditions.py ; la
+    # miniature est elle-même générée si elle n'a pas été fournie
+    renditions = models.JSONField(default=dict, blank=True, editable=False)
+    # Aussi mis à jour par les avis et les images additionnelles (voir signals.py)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    # Agrégats des avis, maintenus par les signaux de Review (voir signals.py)
+    # et reconstruits par la commande rebuild_ratings.
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_1_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_2_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_3_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_4_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_5_count = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = ProductQuerySet.as_manager()
+
+    class Meta:
+        # Index composites des clés de KeysetPagination (tri, id)
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='product_created_id_idx'),
+            models.Index(fields=['price', 'id'], name='product_price_id_idx'),
+            models.Index(fields=['name', 'id'], name='product_name_id_idx'),
+            models.Index(fields=['stock', 'id'], name='product_stock_id_idx'),
+        ]
 
     @property
     def is_in_stock(self):
@@ -44,14 +150,27 @@ class Product(models.Model):
 
     @property
     def average_rating(self):
-        reviews = self.reviews.all()
-        if not reviews:
+        if not self.rating_count:
             return None
-        return sum(review.rating for review in reviews) / len(reviews)
+        return self.rating_sum / self.rating_count
 
     @property
     def review_count(self):
-        return self.reviews.count()
+        return self.rating_count
+
+    @property
+    def rating_histogram(self):
+        return {rating: getattr(self, f'rating_{rating}_count') for rating in Review.RATING_RANGE}
+
+    @classmethod
+    def update_rating_aggregates(cls, product_id, rating, delta):
+        """ Ajoute (delta=1) ou retire (delta=-1) une note, atomiquement en base """
+        cls.objects.filter(pk=product_id).update(
+            rating_sum=F('rating_sum') + rating * delta,
+            rating_count=F('rating_count') + delta,
+            updated_at=Now(),
+            **{f'rating_{rating}_count': F(f'rating_{rating}_count') + delta}
+        )
 
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -66,25 +185,69 @@ class ProductImage(models.Model):
     image = models.ImageField(upload_to='products/additional/')
     alt_text = models.CharField(max_length=200)
     order = models.IntegerField(default=0)
+    renditions = models.JSONField(default=dict, blank=True, editable=False)
 
     class Meta:
         ordering = ['order']
 
+class ProductSimilarity(models.Model):
+    """ Voisins les plus proches d'un produit, précalculés par similarity.py """
+    product = models.ForeignKey(Product, related_name='neighbours', on_delete=models.CASCADE)
+    neighbour = models.ForeignKey(Product, related_name='neighbour_of', on_delete=models.CASCADE)
+    score = models.FloatField()
+
+    class Meta:
+        unique_together = ('product', 'neighbour')
+        indexes = [
+            models.Index(fields=['product', '-score'], name='similarity_product_score_idx'),
+        ]
+
+class ProductFeature(models.Model):
+    """ Coordonnée non nulle du vecteur TF-IDF d'un produit : index inversé de similarity.py """
+    product = models.ForeignKey(Product, related_name='similarity_features', on_delete=models.CASCADE)
+    feature = models.IntegerField()
+    weight = models.FloatField()
+
+    class Meta:
+        unique_together = ('product', 'feature')
+        indexes = [
+            # Lecture des postings d'une colonne
+            models.Index(fields=['feature', 'product'], name='feature_product_idx'),
+        ]
+
 class Review(models.Model):
-    product = models.ForeignKey(Product, related_name='reviews', on_delete=models.CASCADE)
+    RATING_RANGE = range(1, 6)
 
-    rating = models.IntegerField()
+    product = models.ForeignKey(Product, related_name='reviews', on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL)
+    rating = models.IntegerField(validators=[MinValueValidator(1), MaxValueValidator(5)])
     comment = models.TextField()
     is_verified_purchase = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            # Les colonnes rating_<n>_count de Product ne comptent que ces notes
+            models.CheckConstraint(condition=Q(rating__gte=1, rating__lte=5), name='review_rating_range'),
+        ]
 
-class Wishlist(models.Model):
 
+class Wishlist(models.Model):
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.CASCADE)
     products = models.ManyToManyField(Product)
     created_at = models.DateTimeField(auto_now_add=True)
 
 
+class OrderQuerySet(models.QuerySet):
+    def with_items(self):
+        """ Lignes de commande et nom des produits préchargés (OrderSerializer) """
+        return self.prefetch_related(
+            Prefetch('items', queryset=OrderItem.objects.select_related('product').only(
+                'id', 'order_id', 'product_id', 'quantity', 'price', 'product__name'
+            ))
+        )
+
+
 class Order(models.Model):
     STATUS_CHOICES = [
         ('pending', 'En attente'),
@@ -104,6 +267,13 @@ class Order(models.Model):
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = OrderQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='order_created_id_idx'),
+        ]
+
     def __str__(self):
         return f"Commande {self.id} - {self.first_name} {self.last_name}"
 
@@ -116,3 +286,48 @@ class OrderItem(models.Model):
     def __str__(self):
         return f"{self.quantity} x {self.product.name} dans la commande {self.order.id}"
 
+
+class IdempotencyKey(models.Model):
+    """ Clé Idempotency-Key d'une création de commande, pour rejouer les tentatives répétées """
+    key = models.CharField(max_length=255, unique=True)
+    fingerprint = models.CharField(max_length=64)
+    order = models.ForeignKey(Order, related_name='idempotency_keys', on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.key
+
+
+class Task(models.Model):
+    """ Tâche différée de la file en base, exécutée par la commande run_worker (voir queue.py) """
+    STATUS_CHOICES = [
+        ('pending', 'En attente'),
+        ('running', 'En cours'),
+        ('done', 'Terminée'),
+        ('failed', 'Échouée'),
+    ]
+
+    name = models.CharField(max_length=200)
+    args = models.JSONField(default=list, blank=True)
+    kwargs = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    priority = models.SmallIntegerField(default=0)
+    run_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    last_error = models.TextField(blank=True)
+    worker = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    # Dernier signal de vie du worker pendant l'exécution (voir Worker.heartbeat)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Sélection des tâches prêtes par le worker
+            models.Index(fields=['status', 'run_at'], name='task_status_run_at_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.pk}"
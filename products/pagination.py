@@ -0,0 +1,229 @@
+import json
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from datetime import date, datetime
+from decimal import Decimal
+
+from asgiref.sync import sync_to_async
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import connections
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+def approximate_count(queryset):
+    """
+    Estimation du nombre de lignes : sous PostgreSQL on lit l'estimation du
+    planificateur (EXPLAIN) au lieu de lancer un COUNT(*) ; les autres moteurs
+    n'ont pas d'équivalent, on retombe alors sur un comptage exact.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return queryset.count()
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class KeysetPagination(BasePagination):
+    """
+    Pagination par curseur sur le couple (champ de tri, id).
+
+    Chaque page est obtenue par un WHERE sur la dernière clé servie plutôt que
+    par un OFFSET, donc une page profonde coûte autant que la première. Le champ
+    de tri suit le paramètre ?ordering= lorsqu'il fait partie des ordering_fields
+    de la vue. Aucun COUNT(*) n'est lancé sauf si le client passe ?count=approx
+    ou ?count=exact.
+    """
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    ordering_query_param = api_settings.ORDERING_PARAM
+    default_ordering = '-created_at'
+    # Tris par défaut prioritaires lorsque le queryset porte l'annotation
+    # correspondante (pertinence d'une recherche plein texte)
+    annotation_orderings = ('-search_rank',)
+    invalid_cursor_message = 'Curseur invalide.'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = self.get_count(queryset, request)
+        return self.set_page(list(self.get_window(queryset, request, view)))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """ Variante asynchrone pour les vues ASGI (voir async_views.py) """
+        mode = request.query_params.get(self.count_query_param)
+        if mode == 'exact':
+            self.count = await queryset.acount()
+        elif mode == 'approx':
+            self.count = await sync_to_async(approximate_count)(queryset)
+        else:
+            self.count = None
+        return self.set_page([instance async for instance in self.get_window(queryset, request, view)])
+
+    def get_window(self, queryset, request, view):
+        """ Queryset de la page demandée, avec une ligne de plus pour savoir s'il y a une suite """
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.field, self.descending = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request, queryset)
+        if self.cursor is not None and self.cursor['field'] != self.field:
+            raise NotFound(self.invalid_cursor_message)
+
+        # Une page « précédente » se lit dans l'ordre inverse puis est retournée
+        self.backwards = self.cursor is not None and self.cursor['previous']
+        descending = self.descending != self.backwards
+        queryset = queryset.order_by(*self.get_order_terms(descending))
+        if self.cursor is not None:
+            queryset = queryset.filter(self.get_position_filter(self.cursor, descending))
+        return queryset[:self.page_size + 1]
+
+    def set_page(self, results):
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if self.backwards:
+            results.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.cursor is not None
+
+        self.page = results
+        return results
+
+    def get_paginated_response(self, data):
+        payload = OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+        ])
+        if self.count is not None:
+            payload['count'] = self.count
+        payload['results'] = data
+        return Response(payload)
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'count': {'type': 'integer'},
+                'results': schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        try:
+            return _positive_int(
+                request.query_params[self.page_size_query_param],
+                strict=True,
+                cutoff=self.max_page_size
+            )
+        except (KeyError, ValueError):
+            return self.page_size
+
+    def get_ordering(self, request, queryset, view):
+        allowed = getattr(view, 'ordering_fields', None)
+        requested = request.query_params.get(self.ordering_query_param, '')
+        term = requested.split(',')[0].strip()
+        if not isinstance(allowed, (list, tuple)) or term.lstrip('-') not in allowed:
+            term = next(
+                (ordering for ordering in self.annotation_orderings
+                 if ordering.lstrip('-') in queryset.query.annotations),
+                self.default_ordering
+            )
+        field = term.lstrip('-')
+        if field not in queryset.query.annotations:
+            try:
+                queryset.model._meta.get_field(field)
+            except FieldDoesNotExist:
+                field, term = 'pk', '-pk'
+        return field, term.startswith('-')
+
+    def get_count(self, queryset, request):
+        mode = request.query_params.get(self.count_query_param)
+        if mode == 'exact':
+            return queryset.count()
+        if mode == 'approx':
+            return approximate_count(queryset)
+        return None
+
+    def get_order_terms(self, descending):
+        prefix = '-' if descending else ''
+        if self.field == 'pk':
+            return [f'{prefix}pk']
+        return [f'{prefix}{self.field}', f'{prefix}pk']
+
+    def get_position_filter(self, cursor, descending):
+        lookup = 'lt' if descending else 'gt'
+        if self.field == 'pk':
+            return Q(**{f'pk__{lookup}': cursor['id']})
+        return (
+            Q(**{f'{self.field}__{lookup}': cursor['value']}) |
+            Q(**{self.field: cursor['value'], f'pk__{lookup}': cursor['id']})
+        )
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], previous=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.page[0], previous=True)
+
+    def decode_cursor(self, request, queryset):
+        """ Curseur de la requête, sa valeur convertie par le champ de tri (404 si altéré) """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            data = json.loads(b64decode(encoded.encode('ascii')).decode('utf-8'))
+            cursor = {
+                'field': data['f'],
+                'value': None,
+                'id': queryset.model._meta.pk.to_python(data['i']),
+                'previous': bool(data.get('p')),
+            }
+            if cursor['field'] == self.field and self.field != 'pk':
+                cursor['value'] = self.get_ordering_field(queryset).to_python(data['v'])
+                if cursor['value'] is None:
+                    raise ValueError
+        except (TypeError, ValueError, KeyError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return cursor
+
+    def get_ordering_field(self, queryset):
+        if self.field in queryset.query.annotations:
+            return queryset.query.annotations[self.field].output_field
+        return queryset.model._meta.get_field(self.field)
+
+    def encode_cursor(self, instance, previous):
+        value = None if self.field == 'pk' else self._serialize_value(getattr(instance, self.field))
+        data = {'f': self.field, 'v': value, 'i': instance.pk}
+        if previous:
+            data['p'] = 1
+        encoded = b64encode(json.dumps(data, separators=(',', ':')).encode('utf-8')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    @staticmethod
+    def _serialize_value(value):
+        # Conserve la précision complète (microsecondes, décimales) de la clé
+        if isinstance(value, (datetime, date)):
+            return value.isoformat()
+        if isinstance(value, Decimal):
+            return str(value)
+        return value
@@ -0,0 +1,333 @@
+"""
+File de tâches différées stockée en base.
+
+Une fonction décorée par ``@task`` peut être mise en file avec ``enqueue()``
+(éventuellement après un délai ou à une date donnée) ou ``enqueue_on_commit()``
+depuis une vue ou un signal ; elle est alors exécutée par ``manage.py
+run_worker``, sans Celery ni Redis. Les échecs sont retentés avec un délai
+exponentiel, les tâches ``every=`` sont replanifiées périodiquement. Le worker
+signale régulièrement (``heartbeat_at``) que ses tâches sont toujours en cours :
+une tâche dont le signal s'est arrêté (arrêt brutal du worker) est remise en
+file, ou marquée en échec si ses tentatives sont épuisées.
+
+Avec ``TASK_ALWAYS_EAGER = True`` les tâches sont exécutées immédiatement, sans
+worker (développement, tests).
+"""
+import logging
+import os
+import random
+import socket
+import threading
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import timedelta
+from functools import update_wrapper
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connections, transaction
+from django.db.models import Count, F, Max, Q, Subquery
+from django.utils import timezone
+
+from .models import Task
+
+logger = logging.getLogger(__name__)
+
+TASKS = {}
+
+
+def is_eager():
+    return getattr(settings, 'TASK_ALWAYS_EAGER', False)
+
+
+def get_retry_delay(attempts):
+    """ Délai avant la tentative suivante : exponentiel, plafonné, avec un peu d'aléa """
+    base = getattr(settings, 'TASK_RETRY_BACKOFF', 10)
+    ceiling = getattr(settings, 'TASK_RETRY_BACKOFF_MAX', 3600)
+    delay = min(base * 2 ** max(attempts - 1, 0), ceiling)
+    return timedelta(seconds=delay * random.uniform(1, 1.2))
+
+
+def get_timeout():
+    """ Délai sans signal du worker au-delà duquel une tâche « en cours » est considérée perdue """
+    return timedelta(seconds=getattr(settings, 'TASK_TIMEOUT', 120))
+
+
+def get_heartbeat_interval():
+    return timedelta(seconds=getattr(settings, 'TASK_HEARTBEAT_INTERVAL', 30))
+
+
+class TaskFunction:
+    """ Fonction enregistrée dans la file ; reste appelable directement """
+
+    def __init__(self, func, name, max_attempts, priority, every):
+        update_wrapper(self, func)
+        self.func = func
+        self.name = name
+        self.max_attempts = max_attempts
+        self.priority = priority
+        self.every = every
+
+    def __call__(self, *args, **kwargs):
+        return self.func(*args, **kwargs)
+
+    def enqueue(self, *args, delay=None, run_at=None, unique=False, using='default', **kwargs):
+        """
+        Met la tâche en file. Les arguments doivent être sérialisables en JSON.
+        ``unique=True`` ne crée rien si une tâche identique attend déjà.
+        """
+        if is_eager():
+            self.func(*args, **kwargs)
+            return None
+        tasks = Task.objects.using(using)
+        if unique:
+            pending = tasks.filter(name=self.name, status='pending', args=list(args), kwargs=kwargs).first()
+            if pending is not None:
+                return pending
+        if run_at is None:
+            run_at = timezone.now() + (delay or timedelta())
+        return tasks.create(
+            name=self.name, args=list(args), kwargs=kwargs, run_at=run_at,
+            priority=self.priority, max_attempts=self.max_attempts,
+        )
+
+    def enqueue_many(self, args_list, using='default'):
+        """ Met en file une exécution par tuple d'arguments, en un seul INSERT """
+        if is_eager():
+            for args in args_list:
+                self.func(*args)
+            return []
+        now = timezone.now()
+        return Task.objects.using(using).bulk_create([
+            Task(name=self.name, args=list(args), run_at=now, priority=self.priority, max_attempts=self.max_attempts)
+            for args in args_list
+        ], batch_size=1000)
+
+    def enqueue_on_commit(self, *args, using='default', **kwargs):
+        """ Met la tâche en file une fois la transaction courante validée """
+        transaction.on_commit(lambda: self.enqueue(*args, using=using, **kwargs), using=using)
+
+
+def task(func=None, *, name=None, max_attempts=5, priority=0, every=None):
+    """
+    Enregistre une fonction comme tâche. ``every`` (timedelta) la rend
+    périodique : le worker la replanifie après chaque exécution.
+    """
+    def decorator(func):
+        task_name = name or f'{func.__module__}.{func.__qualname__}'
+        TASKS[task_name] = TaskFunction(func, task_name, max_attempts, priority, every)
+        return TASKS[task_name]
+    return decorator(func) if func is not None else decorator
+
+
+def get_stats(window=timedelta(hours=1), sample_size=1000):
+    """
+    Profondeur de la file par statut, tâches prêtes par nom, et latence
+    (attente entre run_at et le début) et durée des tâches terminées récemment.
+    """
+    now = timezone.now()
+    depth = dict(Task.objects.values_list('status').annotate(count=Count('id')).order_by())
+    ready = dict(
+        Task.objects.filter(status='pending', run_at__lte=now)
+        .values_list('name').annotate(count=Count('id')).order_by('-count')
+    )
+    finished = list(
+        Task.objects.filter(status='done', finished_at__gte=now - window)
+        .order_by('-finished_at').values_list('run_at', 'started_at', 'finished_at')[:sample_size]
+    )
+    latencies = sorted(max((started - run_at).total_seconds(), 0) for run_at, started, _ in finished)
+    durations = sorted((end - started).total_seconds() for _, started, end in finished)
+    return {
+        'depth': {status: depth.get(status, 0) for status, _ in Task.STATUS_CHOICES},
+        'ready': ready,
+        'finished': len(finished),
+        'latency': _summary(latencies),
+        'duration': _summary(durations),
+    }
+
+
+def _summary(values):
+    if not values:
+        return None
+    return {
+        'mean': sum(values) / len(values),
+        'p50': values[len(values) // 2],
+        'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+        'max': values[-1],
+    }
+
+
+class Worker:
+    """
+    Exécute les tâches prêtes avec un pool de ``concurrency`` threads. Plusieurs
+    workers (processus ou machines) peuvent tourner sur la même base : une tâche
+    n'est réservée que par un seul d'entre eux.
+    """
+    maintenance_interval = 60
+
+    def __init__(self, concurrency=1, poll_interval=1.0, using='default'):
+        self.name = f'{socket.gethostname()}:{os.getpid()}:{random.randrange(16 ** 4):04x}'
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.using = using
+        self.stopping = threading.Event()
+        self.last_maintenance = None
+        self.last_heartbeat = None
+
+    def tasks(self):
+        return Task.objects.using(self.using)
+
+    def claim(self, limit):
+        """ Réserve jusqu'à ``limit`` tâches prêtes, par priorité puis ancienneté """
+        now = timezone.now()
+        ready = self.tasks().filter(status='pending', run_at__lte=now).order_by('-priority', 'run_at', 'pk')
+        claimed = {
+            'status': 'running', 'worker': self.name, 'started_at': now, 'heartbeat_at': now,
+            'attempts': F('attempts') + 1,
+        }
+        if connections[self.using].features.has_select_for_update_skip_locked:
+            with transaction.atomic(using=self.using):
+                ids = list(ready.select_for_update(skip_locked=True).values_list('pk', flat=True)[:limit])
+                self.tasks().filter(pk__in=ids).update(**claimed)
+        else:
+            # SQLite : un seul UPDATE (les écritures y sont sérialisées) ; la
+            # condition sur le statut écarte les lignes prises entre-temps
+            self.tasks().filter(pk__in=Subquery(ready.values('pk')[:limit]), status='pending').update(**claimed)
+        return list(self.tasks().filter(status='running', worker=self.name, started_at=now))
+
+    def claimed(self, task):
+        """
+        La tâche tant qu'elle est encore réservée par ce worker : une fois
+        remise en file par requeue_stale (et peut-être reprise par un autre
+        worker), l'issue d'une exécution trop lente n'est plus enregistrée
+        """
+        return self.tasks().filter(pk=task.pk, status='running', worker=self.name)
+
+    def execute(self, task):
+        function = TASKS.get(task.name)
+        try:
+            if function is None:
+                raise LookupError(f"Tâche inconnue : {task.name}")
+            function.func(*task.args, **task.kwargs)
+        except Exception:
+            error = traceback.format_exc()
+            now = timezone.now()
+            if task.attempts < task.max_attempts:
+                delay = get_retry_delay(task.attempts)
+                logger.warning("Tâche %s en échec (tentative %s), nouvel essai dans %s", task, task.attempts, delay)
+                self.claimed(task).update(
+                    status='pending', run_at=now + delay, last_error=error, worker=''
+                )
+            else:
+                logger.error("Tâche %s abandonnée après %s tentatives\n%s", task, task.attempts, error)
+                self.claimed(task).update(status='failed', finished_at=now, last_error=error)
+        else:
+            self.claimed(task).update(status='done', finished_at=timezone.now(), last_error='')
+
+    def execute_in_thread(self, task):
+        # Connexion propre au thread du pool : même cycle de vie qu'une requête
+        close_old_connections()
+        try:
+            self.execute(task)
+        finally:
+            close_old_connections()
+
+    def heartbeat(self, force=False):
+        """ Signale, au plus une fois par intervalle, que les tâches réservées par ce worker tournent encore """
+        now = timezone.now()
+        if not force and self.last_heartbeat and now - self.last_heartbeat < get_heartbeat_interval():
+            return
+        self.last_heartbeat = now
+        try:
+            self.tasks().filter(status='running', worker=self.name).update(heartbeat_at=now)
+        except DatabaseError:
+            # SQLite : une tâche qui écrit longuement verrouille toute la base ;
+            # le signal est retenté à l'intervalle suivant
+            logger.warning("Signal de vie des tâches en cours impossible", exc_info=True)
+
+    def requeue_stale(self):
+        """
+        Remet en file les tâches « en cours » dont le worker ne signale plus
+        rien (arrêt brutal) ; celles qui ont épuisé leurs tentatives passent en
+        échec. Renvoie le nombre de tâches remises en file.
+        """
+        now = timezone.now()
+        limit = now - get_timeout()
+        stale = self.tasks().filter(
+            # Sans signal : tâche réservée avant l'ajout de heartbeat_at
+            Q(heartbeat_at__lt=limit) | Q(heartbeat_at__isnull=True, started_at__lt=limit),
+            status='running',
+        )
+        failed = stale.filter(attempts__gte=F('max_attempts')).update(
+            status='failed', finished_at=now, worker='',
+            last_error=f"Worker arrêté pendant l'exécution (aucun signal depuis {get_timeout()})",
+        )
+        if failed:
+            logger.error("%s tâches bloquées abandonnées après leur dernière tentative", failed)
+        return stale.filter(attempts__lt=F('max_attempts')).update(status='pending', worker='')
+
+    def schedule_periodic(self):
+        """ Planifie la prochaine exécution des tâches ``every=`` qui n'en ont pas """
+        periodic = {name: function for name, function in TASKS.items() if function.every}
+        if not periodic:
+            return
+        active = set(
+            self.tasks().filter(name__in=periodic, status__in=('pending', 'running'))
+            .values_list('name', flat=True)
+        )
+        latest = dict(
+            self.tasks().filter(name__in=periodic.keys() - active)
+            .values_list('name').annotate(latest=Max('started_at')).order_by()
+        )
+        for name in periodic.keys() - active:
+            last_run = latest.get(name)
+            run_at = last_run + periodic[name].every if last_run else timezone.now()
+            periodic[name].enqueue(run_at=run_at, using=self.using)
+
+    def maintenance(self):
+        now = timezone.now()
+        if self.last_maintenance and (now - self.last_maintenance).total_seconds() < self.maintenance_interval:
+            return
+        self.last_maintenance = now
+        requeued = self.requeue_stale()
+        if requeued:
+            logger.warning("%s tâches bloquées remises en file", requeued)
+        self.schedule_periodic()
+
+    def run(self, burst=False):
+        """
+        Boucle principale ; ``burst=True`` s'arrête dès que la file est vide.
+        Renvoie le nombre de tâches exécutées.
+        """
+        executed = 0
+        in_flight = set()
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='worker') as pool:
+            while not self.stopping.is_set():
+                self.maintenance()
+                self.heartbeat()
+                free = self.concurrency - len(in_flight)
+                claimed = self.claim(free) if free else []
+                in_flight |= {pool.submit(self.execute_in_thread, task) for task in claimed}
+                if not in_flight:
+                    if burst:
+                        break
+                    self.stopping.wait(self.poll_interval)
+                    continue
+                # Pool plein : on attend une place, en se réveillant pour le signal
+                # de vie des tâches en cours ; sinon on revient voir la file
+                done, in_flight = wait(
+                    in_flight,
+                    timeout=(
+                        get_heartbeat_interval().total_seconds() if len(in_flight) >= self.concurrency
+                        else self.poll_interval
+                    ),
+                    return_when=FIRST_COMPLETED,
+                )
+                executed += len(done)
+            wait(in_flight)
+            executed += len(in_flight)
+        connections.close_all()
+        return executed
+
+    def stop(self, *args):
+        """ Termine les tâches en cours puis s'arrête (utilisable comme gestionnaire de signal) """
+        self.stopping.set()
@@ -0,0 +1,56 @@
+"""
+Rendu et lecture du JSON par orjson.
+
+orjson encode nativement dict, list, str, nombres, datetime, date et UUID. Les
+prix arrivent déjà en chaînes (DecimalField des serializers) ; un Decimal brut et
+les autres types (chaînes traduites, timedelta...) sont convertis par l'encodeur
+de DRF, pour un résultat identique à celui de JSONRenderer.
+
+Les réponses indentées (API navigable, ?indent=) ou en ASCII restent rendues par
+le JSONRenderer de DRF, dont ORJSONRenderer hérite.
+"""
+import orjson
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+from .timing import span
+
+# Clés entières (histogramme des notes) et fuseau UTC noté « Z », comme DRF
+OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z
+
+_encoder = JSONEncoder()
+
+
+def dumps(data):
+    content = orjson.dumps(data, default=_encoder.default, option=OPTIONS)
+    # Séparateurs de ligne JavaScript échappés comme le fait DRF
+    if b'\xe2\x80\xa8' in content or b'\xe2\x80\xa9' in content:
+        content = content.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+    return content
+
+
+class ORJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        renderer_context = renderer_context or {}
+        with span('render'):
+            if self.ensure_ascii or not self.compact or self.get_indent(accepted_media_type, renderer_context):
+                return super().render(data, accepted_media_type, renderer_context)
+            return dumps(data)
+
+
+class ORJSONParser(JSONParser):
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        try:
+            content = stream.read()
+            if encoding.lower().replace('_', '-') not in ('utf-8', 'utf8'):
+                content = content.decode(encoding)
+            return orjson.loads(content)
+        except (orjson.JSONDecodeError, UnicodeDecodeError, LookupError) as exc:
+            raise ParseError(f'JSON parse error - {exc}')
@@ -0,0 +1,188 @@
+"""
+Déclinaisons des images du catalogue.
+
+Chaque image (produit, miniature, image additionnelle, catégorie) est
+redimensionnée avec Pillow en plusieurs largeurs, dans son format d'origine et
+en WebP. Le travail est fait hors requête : les signaux mettent en file la
+tâche generate_image_renditions (voir tasks.py), exécutée par run_worker.
+Les fichiers passent par le stockage configuré (local ou S3) et leurs noms sont
+enregistrés dans le champ JSON ``renditions`` du modèle, ce qui permet aux
+sérialiseurs de construire un ``srcset`` sans requête supplémentaire.
+"""
+import logging
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db.models.functions import Now
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from . import cache
+from .models import Category, Product, ProductImage
+
+logger = logging.getLogger(__name__)
+
+# Champs image déclinés pour chaque modèle
+IMAGE_FIELDS = {
+    Category: ('image',),
+    Product: ('image', 'thumbnail'),
+    ProductImage: ('image',),
+}
+
+# Formats conservés tels quels ; les autres sont déclinés en JPEG
+SOURCE_FORMATS = ('JPEG', 'PNG')
+EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp'}
+SAVE_OPTIONS = {
+    'JPEG': {'quality': 82, 'optimize': True, 'progressive': True},
+    'PNG': {'optimize': True},
+    'WEBP': {'quality': 80, 'method': 4},
+}
+
+
+def get_widths():
+    return tuple(sorted(getattr(settings, 'IMAGE_RENDITION_WIDTHS', (320, 640, 960, 1280))))
+
+
+def get_thumbnail_width():
+    return getattr(settings, 'IMAGE_THUMBNAIL_WIDTH', 320)
+
+
+def _open(field_file):
+    field_file.open('rb')
+    try:
+        image = Image.open(BytesIO(field_file.read()))
+        image.load()
+    finally:
+        field_file.close()
+    # exif_transpose renvoie une copie qui perd le format d'origine
+    oriented = ImageOps.exif_transpose(image)
+    oriented.format = image.format
+    return oriented
+
+
+def _encode(image, width, image_format):
+    if width < image.width:
+        height = max(1, round(image.height * width / image.width))
+        image = image.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+    has_alpha = image.mode in ('RGBA', 'LA') or 'transparency' in image.info
+    if image_format == 'JPEG' or not has_alpha:
+        image = image.convert('RGB')
+    else:
+        image = image.convert('RGBA')
+    buffer = BytesIO()
+    image.save(buffer, image_format, **SAVE_OPTIONS[image_format])
+    return ContentFile(buffer.getvalue())
+
+
+def _rendition_name(source_name, width, image_format):
+    directory, filename = os.path.split(source_name)
+    stem = os.path.splitext(filename)[0]
+    return f'renditions/{directory}/{stem}-{width}w.{EXTENSIONS[image_format]}'
+
+
+def render(field_file, image=None):
+    """
+    Génère les déclinaisons d'une image et renvoie l'entrée à stocker dans
+    ``renditions`` : nom de la source, largeur d'origine et liste de
+    (largeur, format, nom). Les largeurs supérieures à l'original sont ignorées.
+    """
+    image = image or _open(field_file)
+    source_format = image.format if image.format in SOURCE_FORMATS else 'JPEG'
+    widths = [width for width in get_widths() if width < image.width] + [image.width]
+    storage = field_file.storage
+    variants = []
+    for width in widths:
+        for image_format in (source_format, 'WEBP'):
+            name = _rendition_name(field_file.name, width, image_format)
+            # Régénération : on remplace le fichier plutôt que d'en créer un suffixé
+            if storage.exists(name):
+                storage.delete(name)
+            name = storage.save(name, _encode(image, width, image_format))
+            variants.append([width, image_format.lower(), name])
+    return {'source': field_file.name, 'width': image.width, 'variants': variants}
+
+
+def _make_thumbnail(product, image):
+    """ Miniature générée depuis l'image principale quand aucune n'a été fournie """
+    name = f'{os.path.splitext(os.path.basename(product.image.name))[0]}.jpg'
+    product.thumbnail.save(name, _encode(image, get_thumbnail_width(), 'JPEG'), save=False)
+
+
+def is_stale(instance, field_name):
+    field_file = getattr(instance, field_name)
+    entry = instance.renditions.get(field_name)
+    return bool(field_file) and (entry is None or entry['source'] != field_file.name)
+
+
+def needs_renditions(instance):
+    if isinstance(instance, Product) and instance.image and not instance.thumbnail:
+        return True
+    return any(is_stale(instance, field_name) for field_name in IMAGE_FIELDS[type(instance)])
+
+
+def generate_renditions(model, pk, force=False, using='default'):
+    """
+    Génère les déclinaisons manquantes ou périmées d'un objet et les enregistre
+    par un UPDATE (sans repasser par les signaux de sauvegarde).
+    Renvoie le nombre d'images traitées.
+    """
+    instance = model._default_manager.using(using).filter(pk=pk).first()
+    if instance is None:
+        return 0
+
+    renditions = dict(instance.renditions)
+    changes = {}
+    processed = 0
+    for field_name in IMAGE_FIELDS[model]:
+        field_file = getattr(instance, field_name)
+        if model is Product and field_name == 'thumbnail' and not field_file and instance.image:
+            try:
+                _make_thumbnail(instance, _open(instance.image))
+            except (OSError, UnidentifiedImageError):
+                logger.warning("Miniature impossible pour le produit %s", pk, exc_info=True)
+                continue
+            changes['thumbnail'] = instance.thumbnail.name
+        if not (force or is_stale(instance, field_name)):
+            continue
+        if not field_file:
+            renditions.pop(field_name, None)
+            continue
+        try:
+            renditions[field_name] = render(field_file)
+        except (OSError, UnidentifiedImageError):
+            logger.warning("Déclinaisons impossibles pour %s %s (%s)", model.__name__, pk, field_name,
+                           exc_info=True)
+            continue
+        processed += 1
+
+    if not changes and renditions == instance.renditions:
+        return processed
+    # Les URLs servies changent : Last-Modified et cache du catalogue doivent suivre
+    if model is ProductImage:
+        Product.objects.using(using).filter(pk=instance.product_id).update(updated_at=Now())
+    else:
+        changes['updated_at'] = Now()
+    model._default_manager.using(using).filter(pk=pk).update(renditions=renditions, **changes)
+    cache.bump_generation_on_commit(model, using=using)
+    return processed
+
+
+def srcsets(instance, field_name, request=None):
+    """ ``srcset`` par format pour un champ image, ou None si rien n'est généré """
+    field_file = getattr(instance, field_name)
+    return build_srcsets(field_file.name, instance.renditions, field_name, field_file.storage, request)
+
+
+def build_srcsets(name, renditions, field_name, storage, request=None):
+    """ srcsets() à partir des valeurs brutes des colonnes (sérialisation compilée) """
+    entry = (renditions or {}).get(field_name)
+    if not name or entry is None or entry['source'] != name:
+        return None
+    sets = {}
+    for width, image_format, variant in entry['variants']:
+        url = storage.url(variant)
+        if request is not None:
+            url = request.build_absolute_uri(url)
+        sets.setdefault(image_format, []).append(f'{url} {width}w')
+    return {image_format: ', '.join(candidates) for image_format, candidates in sets.items()}
@@ -0,0 +1,195 @@
+"""
+Répartition des lectures entre la base principale et ses réplicas.
+
+Les réplicas sont les alias listés dans DATABASE_REPLICAS. Seules les lectures
+explicitement autorisées y sont envoyées : vues du catalogue (ReplicaReadMixin)
+et listes de l'admin, dans un bloc ``replica_reads()``. Les écritures, les
+commandes et les tâches restent sur la base principale.
+
+Une requête qui écrit lit ensuite la base principale jusqu'à sa fin, et le
+client y reste épinglé (cookie) pendant DATABASE_REPLICA_PIN_SECONDS : il relit
+ses propres écritures même si les réplicas ont du retard. Un réplica dont le
+retard mesuré dépasse DATABASE_REPLICA_MAX_LAG (ou injoignable) est écarté.
+
+Une réponse lue sur un réplica peut précéder la dernière écriture : elle n'est
+ni mise en cache ni datée par des validateurs (voir replica_read_count).
+"""
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+PIN_COOKIE = 'db_primary'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+LAG_CHECK_INTERVAL = 5
+
+_routing = ContextVar('database_routing', default=None)
+# Dernier retard mesuré par réplica : alias -> (instant de la mesure, retard)
+_lags = {}
+
+
+class RoutingState:
+    """
+    État de la requête en cours : lectures sur réplica permises, écriture
+    faite, client épinglé, lectures servies par un réplica
+    """
+
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.replica_reads = False
+        self.wrote = False
+        self.replica_served_reads = 0
+
+    @property
+    def use_replica(self):
+        return self.replica_reads and not (self.pinned or self.wrote)
+
+
+def get_replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def replica_lag(alias):
+    """ Retard de réplication en secondes (PostgreSQL) ; 0 pour les autres moteurs """
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        return 0
+    with connection.cursor() as cursor:
+        # Réplica à jour : pg_last_xact_replay_timestamp() vieillit sans qu'il y ait de retard
+        cursor.execute(
+            "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+            "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+        )
+        return float(cursor.fetchone()[0])
+
+
+def get_lag(alias):
+    """ Retard du réplica, mesuré au plus une fois toutes les LAG_CHECK_INTERVAL secondes """
+    now = time.monotonic()
+    checked_at, lag = _lags.get(alias, (None, None))
+    if checked_at is None or now - checked_at > LAG_CHECK_INTERVAL:
+        try:
+            lag = replica_lag(alias)
+        except DatabaseError:
+            logger.warning("Réplica %s injoignable, lectures sur la base principale", alias, exc_info=True)
+            lag = float('inf')
+        _lags[alias] = (now, lag)
+    return lag
+
+
+def choose_replica():
+    """ Un réplica assez à jour, au hasard ; None si aucun ne convient """
+    max_lag = getattr(settings, 'DATABASE_REPLICA_MAX_LAG', 5)
+    available = [alias for alias in get_replicas() if get_lag(alias) <= max_lag]
+    return random.choice(available) if available else None
+
+
+def replica_read_count():
+    """ Lectures de la requête en cours servies par un réplica : comparer deux relevés """
+    state = _routing.get()
+    return state.replica_served_reads if state is not None else 0
+
+
+@contextmanager
+def replica_reads():
+    """ Autorise les lectures sur un réplica dans le bloc (hors requête épinglée ou ayant écrit) """
+    state = _routing.get()
+    token = None
+    if state is None:
+        token = _routing.set(RoutingState())
+        state = _routing.get()
+    previous, state.replica_reads = state.replica_reads, True
+    try:
+        yield
+    finally:
+        state.replica_reads = previous
+        if token is not None:
+            _routing.reset(token)
+
+
+class ReplicaRouter:
+    """ Routeur : lectures autorisées sur un réplica, tout le reste sur la base principale """
+
+    def db_for_read(self, model, **hints):
+        state = _routing.get()
+        if state is not None and state.use_replica and get_replicas():
+            alias = choose_replica()
+            if alias is not None:
+                state.replica_served_reads += 1
+                return alias
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        # Toujours la base principale, même pour un objet lu sur un réplica
+        state = _routing.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *get_replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class ReplicaReadMixin:
+    """ Vue DRF dont les lectures (GET, HEAD) peuvent être servies par un réplica """
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in SAFE_METHODS:
+            return super().dispatch(request, *args, **kwargs)
+        with replica_reads():
+            return super().dispatch(request, *args, **kwargs)
+
+
+class PrimaryPinningMiddleware:
+    """
+    Suit les écritures de chaque requête. Un client qui a écrit reçoit un cookie
+    qui l'épingle à la base principale le temps que les réplicas rattrapent.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state, token = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            _routing.reset(token)
+        return self.finish(state, response)
+
+    async def __acall__(self, request):
+        state, token = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _routing.reset(token)
+        return self.finish(state, response)
+
+    def start(self, request):
+        state = RoutingState(pinned=request.method not in SAFE_METHODS or PIN_COOKIE in request.COOKIES)
+        return state, _routing.set(state)
+
+    def finish(self, state, response):
+        if state.wrote and get_replicas():
+            response.set_cookie(
+                PIN_COOKIE, '1', max_age=getattr(settings, 'DATABASE_REPLICA_PIN_SECONDS', 10),
+                httponly=True, samesite='Lax',
+            )
+        return response
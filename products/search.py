@@ -0,0 +1,278 @@
+"""
+Recherche plein texte du catalogue.
+
+Deux moteurs interchangeables maintiennent un index à part de la table des
+produits : FTS5 pour SQLite (développement, tests) et tsvector + GIN pour
+PostgreSQL (production). Les deux renvoient un queryset filtré et annoté d'un
+score ``search_rank`` (plus grand = plus pertinent), qui se combine donc avec
+les autres filtres de ProductViewSet.
+"""
+import re
+import unicodedata
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import FloatField
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+SEARCH_RANK = 'search_rank'
+
+_WORD_RE = re.compile(r'\w+')
+
+# Suffixes retirés par le raccourcisseur français, du plus long au plus court
+_FRENCH_SUFFIXES = (
+    'issements', 'issement', 'ements', 'ement', 'ations', 'ation', 'atrices',
+    'atrice', 'ateurs', 'ateur', 'euses', 'euse', 'antes', 'ante', 'ants',
+    'ant', 'iques', 'ique', 'ives', 'ive', 'ifs', 'if', 'eux', 'ees', 'ee',
+    'es', 'er', 'e', 's', 'x',
+)
+
+
+def strip_accents(text):
+    normalized = unicodedata.normalize('NFKD', text)
+    return ''.join(char for char in normalized if not unicodedata.combining(char))
+
+
+def french_stem(word):
+    """ Raccourcisseur léger du français : pluriels et suffixes les plus courants """
+    if word.endswith('aux') and len(word) > 5:
+        return word[:-3] + 'al'
+    for suffix in _FRENCH_SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+
+def tokenize(text):
+    """ Minuscules, sans accents, racinisé : utilisé à l'indexation comme à la requête """
+    return [french_stem(word) for word in _WORD_RE.findall(strip_accents((text or '').lower()))]
+
+
+class BaseSearchBackend:
+    """ Interface commune aux moteurs de recherche de produits """
+    vendor = None
+
+    def __init__(self, using='default'):
+        self.using = using
+
+    @property
+    def connection(self):
+        return connections[self.using]
+
+    def install(self, connection):
+        raise NotImplementedError
+
+    def uninstall(self, connection):
+        raise NotImplementedError
+
+    def index_products(self, products):
+        raise NotImplementedError
+
+    def remove_products(self, product_ids):
+        raise NotImplementedError
+
+    def rank_sql(self, table):
+        """ Sous-requête corrélée (sql, params) calculant le score d'une ligne de ``table`` """
+        raise NotImplementedError
+
+    def match_sql(self):
+        """ Sous-requête (sql, params) renvoyant les ids des produits trouvés """
+        raise NotImplementedError
+
+    def build_query(self, terms):
+        raise NotImplementedError
+
+    def filter(self, queryset, terms):
+        """ Produits trouvés, sans score ni tri (combinable par | avec un autre filtre) """
+        query = self.build_query(terms)
+        if query is None:
+            return queryset.none()
+        match_sql, match_params = self.match_sql()
+        return queryset.filter(pk__in=RawSQL(match_sql, (*match_params, query)))
+
+    def search(self, queryset, terms):
+        query = self.build_query(terms)
+        if query is None:
+            return queryset.none()
+        rank_sql, rank_params = self.rank_sql(queryset.model._meta.db_table)
+        return self.filter(queryset, terms).annotate(**{
+            SEARCH_RANK: RawSQL(rank_sql, (*rank_params, query), output_field=FloatField()),
+        }).order_by(f'-{SEARCH_RANK}', 'pk')
+
+    def rebuild(self, queryset, chunk_size=1000):
+        self.clear()
+        indexed = 0
+        batch = []
+        for product in queryset.iterator(chunk_size=chunk_size):
+            batch.append(product)
+            if len(batch) >= chunk_size:
+                self.index_products(batch)
+                indexed += len(batch)
+                batch = []
+        if batch:
+            self.index_products(batch)
+            indexed += len(batch)
+        return indexed
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class SQLiteSearchBackend(BaseSearchBackend):
+    """
+    Table virtuelle FTS5 classée par BM25. FTS5 n'a pas de racinisation
+    française : les textes sont normalisés par ``tokenize`` avant l'indexation
+    et chaque terme de la requête est cherché comme préfixe.
+    """
+    vendor = 'sqlite'
+    table = 'products_product_fts'
+    # Poids BM25 des colonnes (name, description, ingredients)
+    weights = (10.0, 1.0, 2.0)
+
+    def install(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} "
+                f"USING fts5(name, description, ingredients, tokenize='unicode61 remove_diacritics 2')"
+            )
+
+    def uninstall(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {self.table}')
+
+    def index_products(self, products):
+        rows = [
+            (
+                product.pk,
+                ' '.join(tokenize(product.name)),
+                ' '.join(tokenize(product.description)),
+                ' '.join(tokenize(product.ingredients)),
+            )
+            for product in products
+        ]
+        with self.connection.cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {self.table} WHERE rowid = %s', [(row[0],) for row in rows])
+            cursor.executemany(
+                f'INSERT INTO {self.table} (rowid, name, description, ingredients) VALUES (%s, %s, %s, %s)',
+                rows
+            )
+
+    def remove_products(self, product_ids):
+        with self.connection.cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {self.table} WHERE rowid = %s', [(pk,) for pk in product_ids])
+
+    def clear(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table}')
+
+    def build_query(self, terms):
+        tokens = tokenize(terms)
+        if not tokens:
+            return None
+        return ' '.join(f'"{token}"*' for token in tokens)
+
+    def match_sql(self):
+        return f'SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s', ()
+
+    def rank_sql(self, table):
+        weights = ', '.join(str(weight) for weight in self.weights)
+        return (
+            f'SELECT -bm25({self.table}, {weights}) FROM {self.table} '
+            f'WHERE {self.table} MATCH %s AND rowid = "{table}"."id"'
+        ), ()
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """
+    Table de documents tsvector indexée en GIN, classée par ts_rank. La
+    configuration ``french_unaccent`` combine unaccent et le stemmer français.
+    """
+    vendor = 'postgresql'
+    table = 'products_product_search'
+    config = 'french_unaccent'
+
+    def install(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS unaccent')
+            cursor.execute(f"""
+                DO $$
+                BEGIN
+                    IF NOT EXISTS (SELECT 1 FROM pg_ts_config WHERE cfgname = '{self.config}') THEN
+                        CREATE TEXT SEARCH CONFIGURATION {self.config} (COPY = french);
+                        ALTER TEXT SEARCH CONFIGURATION {self.config}
+                            ALTER MAPPING FOR hword, hword_part, word WITH unaccent, french_stem;
+                    END IF;
+                END
+                $$
+            """)
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {self.table} (
+                    product_id bigint PRIMARY KEY REFERENCES products_product (id) ON DELETE CASCADE,
+                    document tsvector NOT NULL
+                )
+            """)
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {self.table}_gin ON {self.table} USING GIN (document)')
+
+    def uninstall(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {self.table}')
+            cursor.execute(f'DROP TEXT SEARCH CONFIGURATION IF EXISTS {self.config}')
+
+    def index_products(self, products):
+        config = self.config
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                f"""
+                INSERT INTO {self.table} (product_id, document) VALUES (
+                    %s,
+                    setweight(to_tsvector('{config}', %s), 'A') ||
+                    setweight(to_tsvector('{config}', %s), 'B') ||
+                    setweight(to_tsvector('{config}', %s), 'C')
+                )
+                ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document
+                """,
+                [(product.pk, product.name, product.ingredients, product.description) for product in products]
+            )
+
+    def remove_products(self, product_ids):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table} WHERE product_id = ANY(%s)', [list(product_ids)])
+
+    def clear(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'TRUNCATE {self.table}')
+
+    def build_query(self, terms):
+        terms = terms.strip()
+        return terms or None
+
+    def match_sql(self):
+        return (
+            f"SELECT product_id FROM {self.table} "
+            f"WHERE document @@ websearch_to_tsquery('{self.config}', %s)"
+        ), ()
+
+    def rank_sql(self, table):
+        return (
+            f"SELECT ts_rank(document, websearch_to_tsquery('{self.config}', %s)) "
+            f'FROM {self.table} WHERE product_id = "{table}"."id"'
+        ), ()
+
+
+SEARCH_BACKENDS = {
+    backend.vendor: backend for backend in (SQLiteSearchBackend, PostgresSearchBackend)
+}
+
+
+def get_search_backend(using='default'):
+    """
+    Moteur configuré par PRODUCT_SEARCH_BACKEND, sinon celui qui correspond à la
+    base. Renvoie None si la base n'a pas de moteur plein texte : la recherche
+    retombe alors sur le SearchFilter de DRF.
+    """
+    path = getattr(settings, 'PRODUCT_SEARCH_BACKEND', None)
+    if path:
+        return import_string(path)(using)
+    backend_class = SEARCH_BACKENDS.get(connections[using].vendor)
+    return backend_class(using) if backend_class else None
@@ -1,16 +1,22 @@
+from django.db import transaction
+from django.db.models import Case, F, Q, When
+from django.db.models.functions import Now
 from rest_framework import serializers
+from . import cache, metrics, renditions, tasks
 from .models import Category, Product, ProductImage, Review, Wishlist
 from .models import Order, OrderItem, Product
+from .sparse import DynamicFieldsMixin
 
-class OrderItemSerializer(serializers.ModelSerializer):
+class OrderItemSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     product_name = serializers.CharField(source="product.name", read_only=True)
 
     class Meta:
         model = OrderItem
         fields = ['id', 'product', 'product_name', 'quantity', 'price']
+        expandable_fields = {'product': ('ProductListSerializer', {'read_only': True})}
 
-class OrderSerializer(serializers.ModelSerializer):
-    items = OrderItemSerializer(source="orderitem_set", many=True, read_only=True)
+class OrderSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    items = OrderItemSerializer(many=True, read_only=True)
     total_price = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
 
     class Meta:
@@ -18,49 +24,115 @@ class OrderSerializer(serializers.ModelSerializer):
         fields = ['id', 'first_name', 'last_name', 'email', 'phone', 'address', 'status', 'total_price', 'items', 'created_at']
         read_only_fields = ['status', 'total_price', 'created_at']
 
+class OrderLineSerializer(serializers.Serializer):
+    product = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1, default=1)
+
 class CreateOrderSerializer(serializers.ModelSerializer):
-    items = serializers.ListField(child=serializers.DictField(), write_only=True)
+    items = OrderLineSerializer(many=True, write_only=True, allow_empty=False)
 
     class Meta:
         model = Order
-        fields = ['first_name', 'last_name', 'email', 'phone', 'address', 'items']
+        fields = ['id', 'first_name', 'last_name', 'email', 'phone', 'address', 'total_price', 'items']
+        read_only_fields = ['id', 'total_price']
 
     def create(self, validated_data):
+        """
+        Crée la commande en une transaction et en un nombre constant de requêtes :
+        un seul chargement des produits, une seule mise à jour conditionnelle du
+        stock (annulée si une ligne manque de stock), puis les insertions.
+        """
         items_data = validated_data.pop('items')
-        order = Order.objects.create(**validated_data)
-
-        total_price = 0
-        order_items = []
-        
+        quantities = {}
         for item in items_data:
-            product_id = item.get('product')
-            quantity = item.get('quantity', 1)
+            quantities[item['product']] = quantities.get(item['product'], 0) + item['quantity']
+
+        with transaction.atomic():
+            products = Product.objects.filter(is_active=True).select_for_update().in_bulk(quantities)
+            missing = [product_id for product_id in quantities if product_id not in products]
+            if missing:
+                raise serializers.ValidationError(
+                    f"Produit avec ID {', '.join(map(str, missing))} introuvable"
+                )
+
+            self.reserve_stock(products, quantities)
+
+            order_items = []
+            total_price = 0
+            for item in items_data:
+                product = products[item['product']]
+                price = product.price * item['quantity']
+                total_price += price
+                order_items.append(OrderItem(product=product, quantity=item['quantity'], price=price))
+
+            order = Order.objects.create(total_price=total_price, **validated_data)
+            for order_item in order_items:
+                order_item.order = order
+            OrderItem.objects.bulk_create(order_items)
+            tasks.send_order_confirmation.enqueue_on_commit(order.pk)
+            transaction.on_commit(lambda: metrics.record_order(len(order_items)))
 
-            try:
-                product = Product.objects.get(id=product_id)
-            except Product.DoesNotExist:
-                raise serializers.ValidationError(f"Produit avec ID {product_id} introuvable")
+        return order
 
-            price = product.price * quantity
-            total_price += price
+    def reserve_stock(self, products, quantities):
+        # Une seule requête UPDATE ; chaque ligne n'est modifiée que si son stock
+        # suffit, donc un nombre de lignes inférieur signale une rupture
+        available = Q()
+        new_stock = []
+        for product_id, quantity in quantities.items():
+            available |= Q(pk=product_id, stock__gte=quantity)
+            new_stock.append(When(pk=product_id, then=F('stock') - quantity))
+        updated = Product.objects.filter(available).update(
+            stock=Case(*new_stock, default=F('stock')),
+            updated_at=Now(),
+        )
+        if updated != len(quantities):
+            metrics.STOCK_RESERVATION_FAILURES.inc()
+            unavailable = [
+                products[product_id].name for product_id, quantity in quantities.items()
+                if products[product_id].stock < quantity
+            ]
+            raise serializers.ValidationError(
+                f"Stock insuffisant pour : {', '.join(unavailable) or 'certains produits'}"
+            )
+        cache.bump_generation_on_commit(Product)
+
+class ImageRenditionsField(serializers.Field):
+    """ srcset de chaque format décliné d'un champ image (voir renditions.py) """
+
+    def __init__(self, image_field='image', **kwargs):
+        self.image_field = image_field
+        kwargs.update(source='*', read_only=True)
+        super().__init__(**kwargs)
+
+    def to_representation(self, instance):
+        return renditions.srcsets(instance, self.image_field, self.context.get('request'))
+
+class CategorySerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    product_count = serializers.SerializerMethodField()
+    image_renditions = ImageRenditionsField()
 
-            order_items.append(OrderItem(order=order, product=product, quantity=quantity, price=price))
+    class Meta:
+        model = Category
+        fields = ['id', 'name', 'description', 'image', 'image_renditions', 'slug', 'is_active', 'product_count']
 
-        OrderItem.objects.bulk_create(order_items)
-        order.total_price = total_price
-        order.save()
+    def get_product_count(self, obj):
+        # Utilise l'annotation de Category.objects.with_product_count() si présente
+        if hasattr(obj, 'num_products'):
+            return obj.num_products
+        return obj.product_count
 
-        return order
-
-class CategorySerializer(serializers.ModelSerializer):
+class CategorySummarySerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Category
-        fields = ['id', 'name', 'description', 'image', 'slug', 'is_active', 'product_count']
+        fields = ['id', 'name', 'slug']
+
+class ProductImageSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    image_renditions = ImageRenditionsField()
 
-class ProductImageSerializer(serializers.ModelSerializer):
     class Meta:
         model = ProductImage
-        fields = ['id', 'image', 'alt_text', 'order']
+        fields = ['id', 'image', 'image_renditions', 'alt_text', 'order']
 
 class ReviewSerializer(serializers.ModelSerializer):
     user = serializers.StringRelatedField()
@@ -70,24 +142,67 @@ class ReviewSerializer(serializers.ModelSerializer):
         fields = ['id', 'user', 'rating', 'comment', 'is_verified_purchase', 'created_at']
         read_only_fields = ['user', 'is_verified_purchase']
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     category = CategorySerializer()
     additional_images = ProductImageSerializer(many=True, read_only=True)
-    reviews = ReviewSerializer(many=True, read_only=True)
+    image_renditions = ImageRenditionsField()
+    thumbnail_renditions = ImageRenditionsField('thumbnail')
 
     class Meta:
         model = Product
         fields = [
             'id', 'name', 'description', 'price', 'category', 'stock',
-            'thumbnail', 'image', 'additional_images', 'ingredients',
+            'thumbnail', 'thumbnail_renditions', 'image', 'image_renditions',
+            'additional_images', 'ingredients',
             'usage_instructions', 'weight', 'is_active', 'is_featured',
-            'slug', 'discount_price', 'average_rating', 'review_count',
-            'reviews', 'is_in_stock', 'created_at'
+            'slug', 'discount_price', 'average_rating', 'review_count', 'rating_histogram',
+            'is_in_stock', 'created_at'
+        ]
+
+class ProductListSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    """ Représentation allégée pour les listes (sans avis, images additionnelles ni textes longs) """
+    category = CategorySummarySerializer(read_only=True)
+    thumbnail_renditions = ImageRenditionsField('thumbnail')
+    image_renditions = ImageRenditionsField()
+
+    class Meta:
+        model = Product
+        fields = [
+            'id', 'name', 'slug', 'price', 'discount_price', 'category',
+            'thumbnail', 'thumbnail_renditions', 'image', 'image_renditions', 'is_featured', 'is_in_stock',
+            'average_rating', 'review_count', 'created_at'
         ]
+        expandable_fields = {
+            'category': (CategorySerializer, {'read_only': True}),
+            'additional_images': (ProductImageSerializer, {'many': True, 'read_only': True}),
+        }
 
-class WishlistSerializer(serializers.ModelSerializer):
-    products = ProductSerializer(many=True, read_only=True)
+class WishlistSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    products = ProductListSerializer(many=True, read_only=True)
 
     class Meta:
         model = Wishlist
         fields = ['id', 'products', 'created_at']
+
+class WishlistProductSerializer(serializers.ModelSerializer):
+    """ Projection minimale d'un produit de la liste de souhaits (voir WISHLIST_PRODUCT_FIELDS) """
+
+    class Meta:
+        model = Product
+        fields = ['id', 'name', 'slug', 'price', 'discount_price', 'thumbnail', 'is_in_stock']
+
+# Colonnes chargées pour WishlistProductSerializer (is_in_stock lit stock)
+WISHLIST_PRODUCT_FIELDS = ('id', 'name', 'slug', 'price', 'discount_price', 'thumbnail', 'stock')
+
+class ProductIdsSerializer(serializers.Serializer):
+    """ Liste d'identifiants de produits, bornée pour garder une requête IN raisonnable """
+    product_ids = serializers.ListField(child=serializers.IntegerField(min_value=1), max_length=500)
+
+class WishlistBulkSerializer(serializers.Serializer):
+    add = serializers.ListField(child=serializers.IntegerField(min_value=1), max_length=500, required=False, default=list)
+    remove = serializers.ListField(child=serializers.IntegerField(min_value=1), max_length=500, required=False, default=list)
+
+    def validate(self, data):
+        if not data['add'] and not data['remove']:
+            raise serializers.ValidationError("Rien à ajouter ni à retirer")
+        return data
@@ -0,0 +1,146 @@
+from django.db.models.functions import Now
+from django.db.models.signals import post_delete, post_init, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import cache, renditions, similarity, tasks
+from .models import Category, Product, ProductImage, ProductSimilarity, Review
+from .search import get_search_backend
+
+
+@receiver(post_init, sender=Review)
+def remember_review_rating(sender, instance, **kwargs):
+    # Mémorise l'état chargé pour pouvoir retirer l'ancienne note lors d'une modification
+    # (lecture via __dict__ pour ne pas déclencher de requête sur un champ différé)
+    loaded = instance.__dict__
+    if instance.pk and 'rating' in loaded and 'product_id' in loaded:
+        instance._stored_rating = (loaded['product_id'], loaded['rating'])
+    else:
+        instance._stored_rating = None
+
+
+@receiver(pre_save, sender=Review)
+@receiver(pre_delete, sender=Review)
+def load_deferred_review_rating(sender, instance, raw=False, using='default', **kwargs):
+    # Avis chargé sans sa note ou son produit (.only(), .defer()) : l'ancienne
+    # note est relue en base avant qu'elle ne soit modifiée ou supprimée
+    if raw or instance._stored_rating is not None or instance.pk is None or instance._state.adding:
+        return
+    instance._stored_rating = (
+        Review.objects.using(using).filter(pk=instance.pk).values_list('product_id', 'rating').first()
+    )
+
+
+@receiver(post_save, sender=Review)
+def update_rating_on_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    current = (instance.product_id, instance.rating)
+    previous = None if created else instance._stored_rating
+    if previous != current:
+        if previous is not None:
+            Product.update_rating_aggregates(*previous, delta=-1)
+        Product.update_rating_aggregates(*current, delta=1)
+    instance._stored_rating = current
+
+
+@receiver(post_delete, sender=Review)
+def update_rating_on_delete(sender, instance, **kwargs):
+    if instance._stored_rating is not None:
+        Product.update_rating_aggregates(*instance._stored_rating, delta=-1)
+    instance._stored_rating = None
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, raw=False, using='default', **kwargs):
+    backend = None if raw else get_search_backend(using)
+    if backend is not None:
+        backend.index_products([instance])
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, using='default', **kwargs):
+    backend = get_search_backend(using)
+    if backend is not None:
+        backend.remove_products([instance.pk])
+
+
+@receiver(post_init, sender=Product)
+def remember_similarity_source(sender, instance, **kwargs):
+    loaded = instance.__dict__
+    instance._similarity_source = tuple(loaded.get(field) for field in similarity.SOURCE_FIELDS)
+
+
+@receiver(post_save, sender=Product)
+def refresh_similarity_on_save(sender, instance, created, raw=False, using='default', **kwargs):
+    source = tuple(getattr(instance, field) for field in similarity.SOURCE_FIELDS)
+    changed = created or source != instance._similarity_source
+    instance._similarity_source = source
+    if raw or not changed or not similarity.is_auto_refresh_enabled():
+        return
+    tasks.refresh_product_similarity.enqueue_on_commit(instance.pk, unique=True, using=using)
+
+
+@receiver(pre_delete, sender=Product)
+def remember_similarity_referencing(sender, instance, **kwargs):
+    instance._similarity_referencing = list(
+        ProductSimilarity.objects.filter(neighbour=instance).values_list('product_id', flat=True)
+    )
+
+
+@receiver(post_delete, sender=Product)
+def refresh_similarity_on_delete(sender, instance, using='default', **kwargs):
+    if not similarity.is_auto_refresh_enabled():
+        return
+    tasks.refresh_product_similarity.enqueue_on_commit(
+        instance.pk, instance._similarity_referencing, unique=True, using=using
+    )
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=ProductImage)
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=ProductImage)
+@receiver(post_delete, sender=Review)
+def invalidate_catalog_cache(sender, using='default', **kwargs):
+    cache.bump_generation_on_commit(sender, using=using)
+
+
+@receiver(post_init, sender=Product)
+def remember_product_category(sender, instance, **kwargs):
+    instance._loaded_category_id = instance.__dict__.get('category_id') if instance.pk else None
+
+
+@receiver(post_save, sender=Product)
+def touch_category_on_save(sender, instance, created, raw=False, **kwargs):
+    # Le nombre de produits des catégories concernées change : leur updated_at
+    # (Last-Modified des vues de catégorie) doit suivre
+    previous = instance._loaded_category_id
+    instance._loaded_category_id = instance.category_id
+    if raw or (not created and previous == instance.category_id):
+        return
+    Category.objects.filter(pk__in={previous, instance.category_id} - {None}).update(updated_at=Now())
+
+
+@receiver(post_delete, sender=Product)
+def touch_category_on_delete(sender, instance, **kwargs):
+    Category.objects.filter(pk=instance.category_id).update(updated_at=Now())
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+def touch_product_on_image_change(sender, instance, raw=False, **kwargs):
+    if not raw:
+        Product.objects.filter(pk=instance.product_id).update(updated_at=Now())
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=ProductImage)
+def schedule_image_renditions(sender, instance, raw=False, using='default', **kwargs):
+    if not raw and renditions.needs_renditions(instance):
+        tasks.generate_image_renditions.enqueue_on_commit(
+            sender._meta.label, instance.pk, using=using, unique=True
+        )
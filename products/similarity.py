@@ -0,0 +1,318 @@
+"""
+Index de similarité entre produits.
+
+Chaque produit actif est représenté par un vecteur TF-IDF creux (ingrédients,
+nom, description et catégorie, tokens hachés sur un grand nombre de colonnes)
+dont les coordonnées non nulles sont stockées dans ProductFeature : c'est un
+index inversé, interrogé par colonne. Les K meilleurs voisins de chaque produit
+sont stockés dans ProductSimilarity ; ProductViewSet.similar n'a alors plus
+qu'une lecture indexée à faire.
+
+La reconstruction complète lit le catalogue une seule fois et calcule les
+scores par blocs de lignes avec NumPy : produit matriciel sur les seules
+colonnes fréquentes, listes de postings pour les autres. Après la modification d'un produit, seul son vecteur
+est recalculé puis comparé à l'index par une requête agrégée ; les vecteurs des
+autres produits gardent l'IDF de leur dernière indexation, jusqu'à la
+reconstruction suivante.
+"""
+import heapq
+import math
+import zlib
+from collections import defaultdict
+
+import numpy as np
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, Count, F, FloatField, Min, Sum, Value, When, Window
+from django.db.models.functions import RowNumber
+
+from . import cache
+from .models import Product, ProductFeature, ProductSimilarity
+from .search import tokenize
+
+# Champs dont dépendent les vecteurs : une modification de l'un d'eux déclenche
+# le recalcul des voisins du produit
+SOURCE_FIELDS = ('name', 'description', 'ingredients', 'category_id', 'is_active')
+
+FIELD_WEIGHTS = {
+    'ingredients': 2.0,
+    'category': 1.5,
+    'name': 1.0,
+    'description': 0.5,
+}
+
+# Une colonne présente dans au moins une ligne sur DENSE_COLUMN_RATIO est
+# calculée en dense à la reconstruction (voir _neighbours)
+DENSE_COLUMN_RATIO = 32
+# Taille maximale d'un bloc de scores (lignes x produits), en cellules float32
+BLOCK_CELLS = 2 ** 25
+
+
+def get_top_k():
+    return getattr(settings, 'PRODUCT_SIMILARITY_TOP_K', 10)
+
+
+def is_auto_refresh_enabled():
+    return getattr(settings, 'PRODUCT_SIMILARITY_AUTO_REFRESH', True)
+
+
+def get_n_features():
+    return getattr(settings, 'PRODUCT_SIMILARITY_FEATURES', 2 ** 20)
+
+
+def _feature_tokens(product):
+    yield 'ingredients', tokenize(product.ingredients)
+    yield 'name', tokenize(product.name)
+    yield 'description', tokenize(product.description)
+    yield 'category', [f'category:{product.category_id}']
+
+
+def term_frequencies(product, n_features=None):
+    """ TF sous-linéaire du produit, par colonne hachée ({colonne: poids}) """
+    n_features = n_features or get_n_features()
+    counts = defaultdict(float)
+    for field, tokens in _feature_tokens(product):
+        weight = FIELD_WEIGHTS[field]
+        for token in tokens:
+            counts[zlib.crc32(f'{field}:{token}'.encode('utf-8')) % n_features] += weight
+    return {feature: math.log1p(count) for feature, count in counts.items()}
+
+
+def tfidf(frequencies, document_frequency, n_documents):
+    """ Vecteur TF-IDF normalisé, IDF lissé ; ``document_frequency`` exclut le produit lui-même """
+    vector = {
+        feature: frequency * (math.log((2 + n_documents) / (2 + document_frequency.get(feature, 0))) + 1)
+        for feature, frequency in frequencies.items()
+    }
+    norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+    return {feature: weight / norm for feature, weight in vector.items()}
+
+
+def _active_products():
+    return (
+        Product.objects.filter(is_active=True)
+        .only('pk', 'name', 'description', 'ingredients', 'category_id')
+        .order_by('pk')
+    )
+
+
+def rebuild_similarity_index(chunk_size=512, top_k=None):
+    """
+    Recalcule tout l'index. Le catalogue est lu une fois en flux ; seuls les
+    vecteurs creux (tableaux NumPy de colonnes et de poids) sont gardés en mémoire.
+    """
+    top_k = top_k or get_top_k()
+    n_features = get_n_features()
+    ids, row_features, row_frequencies = [], [], []
+    for product in _active_products().iterator(chunk_size=chunk_size):
+        frequencies = term_frequencies(product, n_features)
+        ids.append(product.pk)
+        row_features.append(np.fromiter(frequencies.keys(), dtype=np.int64, count=len(frequencies)))
+        row_frequencies.append(np.fromiter(frequencies.values(), dtype=np.float32, count=len(frequencies)))
+    if not ids:
+        indptr = np.zeros(1, dtype=np.int64)
+        columns = indices = np.zeros(0, dtype=np.int64)
+        weights = np.zeros(0, dtype=np.float32)
+    else:
+        indptr, columns, indices, weights = _tfidf_rows(row_features, row_frequencies)
+    del row_features, row_frequencies
+
+    feature_table = connection.ops.quote_name(ProductFeature._meta.db_table)
+    similarity_table = connection.ops.quote_name(ProductSimilarity._meta.db_table)
+    with transaction.atomic(), connection.cursor() as cursor:
+        ProductSimilarity.objects.all().delete()
+        ProductFeature.objects.all().delete()
+        for start in range(0, len(ids), chunk_size):
+            stop = min(start + chunk_size, len(ids))
+            low, high = indptr[start], indptr[stop]
+            cursor.executemany(
+                f'INSERT INTO {feature_table} (product_id, feature, weight) VALUES (%s, %s, %s)',
+                zip(
+                    np.repeat(ids[start:stop], np.diff(indptr[start:stop + 1])).tolist(),
+                    columns[indices[low:high]].tolist(),
+                    weights[low:high].tolist(),
+                )
+            )
+
+        similarities = []
+        for row, neighbours in enumerate(_neighbours(indptr, indices, weights, top_k, chunk_size)):
+            similarities.extend((ids[row], ids[neighbour], score) for neighbour, score in neighbours)
+            if len(similarities) >= chunk_size * top_k or row == len(ids) - 1:
+                cursor.executemany(
+                    f'INSERT INTO {similarity_table} (product_id, neighbour_id, score) VALUES (%s, %s, %s)',
+                    similarities
+                )
+                similarities = []
+        cache.bump_generation_on_commit(ProductSimilarity)
+    return len(ids)
+
+
+def _tfidf_rows(row_features, row_frequencies):
+    """
+    Vecteurs TF-IDF normalisés de toutes les lignes, au format CSR : (indptr,
+    colonnes distinctes, indice de colonne et poids de chaque coordonnée). Même
+    IDF que ``tfidf`` : la ligne elle-même n'est pas comptée.
+    """
+    lengths = np.fromiter((len(features) for features in row_features), dtype=np.int64, count=len(row_features))
+    indptr = np.concatenate(([0], np.cumsum(lengths)))
+    columns, indices = np.unique(np.concatenate(row_features), return_inverse=True)
+    document_frequency = np.bincount(indices, minlength=len(columns))
+    idf = np.log((1 + len(row_features)) / (1 + document_frequency)) + 1
+    weights = np.concatenate(row_frequencies) * idf[indices].astype(np.float32)
+    norms = np.sqrt(np.add.reduceat(weights * weights, indptr[:-1]))
+    norms[norms == 0] = 1
+    weights /= np.repeat(norms, lengths)
+    return indptr, columns, indices, weights
+
+
+def _neighbours(indptr, indices, weights, top_k, block_size):
+    """
+    Pour chaque ligne, ses top_k voisins [(ligne, score)] de score positif.
+
+    Les colonnes fréquentes (au moins une ligne sur DENSE_COLUMN_RATIO) forment
+    une petite matrice dense multipliée par blocs de lignes ; les autres sont
+    parcourues par leurs listes de postings, où seules les lignes qui partagent
+    la colonne sont visitées.
+    """
+    n_rows = len(indptr) - 1
+    if n_rows < 2:
+        yield from ([] for _ in range(n_rows))
+        return
+    rows = np.repeat(np.arange(n_rows), np.diff(indptr))
+    n_columns = int(indices.max()) + 1
+
+    is_dense_column = np.bincount(indices, minlength=n_columns) * DENSE_COLUMN_RATIO >= n_rows
+    dense_entries = is_dense_column[indices]
+    dense_position = np.cumsum(is_dense_column) - 1
+    dense = np.zeros((n_rows, int(is_dense_column.sum())), dtype=np.float32)
+    dense[rows[dense_entries], dense_position[indices[dense_entries]]] = weights[dense_entries]
+
+    # Postings des colonnes rares, triés par colonne
+    order = np.flatnonzero(~dense_entries)
+    order = order[np.argsort(indices[order], kind='stable')]
+    posting_columns, posting_rows, posting_weights = indices[order], rows[order], weights[order]
+
+    block_size = max(1, min(block_size, BLOCK_CELLS // n_rows))
+    k = min(top_k, n_rows - 1)
+    for start in range(0, n_rows, block_size):
+        stop = min(start + block_size, n_rows)
+        scores = dense[start:stop] @ dense.T
+
+        entries = np.arange(indptr[start], indptr[stop])
+        entries = entries[~dense_entries[entries]]
+        entries = entries[np.argsort(indices[entries], kind='stable')]
+        block_columns, splits = np.unique(indices[entries], return_index=True)
+        lows = np.searchsorted(posting_columns, block_columns, side='left')
+        highs = np.searchsorted(posting_columns, block_columns, side='right')
+        for group, low, high in zip(np.split(entries, splits[1:]), lows, highs):
+            # Une ligne n'apparaît qu'une fois par colonne : pas de doublon d'indice
+            scores[(rows[group] - start)[:, None], posting_rows[low:high]] += (
+                weights[group][:, None] * posting_weights[low:high]
+            )
+
+        block = np.arange(stop - start)
+        scores[block, block + start] = -np.inf
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        for line, candidates in zip(scores, best):
+            candidate_scores = line[candidates]
+            ranked = np.argsort(-candidate_scores, kind='stable')
+            yield [
+                (int(candidates[index]), float(candidate_scores[index]))
+                for index in ranked if candidate_scores[index] > 0
+            ]
+
+
+def _index_scores(vector, product_id):
+    """ Produit scalaire de ``vector`` avec chaque produit indexé qui partage une colonne """
+    weight = Case(
+        *[When(feature=feature, then=Value(weight)) for feature, weight in vector.items()],
+        output_field=FloatField(),
+    )
+    return (
+        ProductFeature.objects.filter(feature__in=vector).exclude(product_id=product_id)
+        .values('product_id').annotate(score=Sum(F('weight') * weight)).order_by()
+    )
+
+
+def _replace_neighbours(product_id, scores, top_k):
+    ProductSimilarity.objects.filter(product_id=product_id).delete()
+    ProductSimilarity.objects.bulk_create([
+        ProductSimilarity(product_id=product_id, neighbour_id=neighbour, score=score)
+        for neighbour, score in heapq.nlargest(top_k, scores, key=lambda item: item[1])
+        if score > 0
+    ])
+
+
+def _refresh_neighbours(product_id, top_k):
+    """ Recalcule les voisins d'un produit à partir de son vecteur déjà indexé """
+    vector = dict(ProductFeature.objects.filter(product_id=product_id).values_list('feature', 'weight'))
+    scores = _index_scores(vector, product_id).values_list('product_id', 'score') if vector else []
+    _replace_neighbours(product_id, scores, top_k)
+
+
+def _trim_neighbours(product_ids, top_k):
+    """ Ne garde que les top_k meilleurs voisins de chacun des produits donnés """
+    ranked = ProductSimilarity.objects.filter(product_id__in=product_ids).annotate(
+        rank=Window(RowNumber(), partition_by=F('product_id'), order_by=[F('score').desc(), F('pk')])
+    )
+    extra = list(ranked.filter(rank__gt=top_k).values_list('pk', flat=True))
+    ProductSimilarity.objects.filter(pk__in=extra).delete()
+
+
+def refresh_product_similarity(product_id, referencing=(), top_k=None):
+    """
+    Mise à jour incrémentale après la modification d'un produit : son vecteur
+    est recalculé et comparé à l'index, il prend sa place dans le top K des
+    produits dont il fait désormais partie, et les produits qui le listaient
+    (``referencing`` s'il vient d'être supprimé) sans plus le garder sont
+    recalculés à partir de leur vecteur indexé.
+    """
+    top_k = top_k or get_top_k()
+    with transaction.atomic():
+        referencing = set(referencing) | set(
+            ProductSimilarity.objects.filter(neighbour_id=product_id).values_list('product_id', flat=True)
+        )
+        ProductSimilarity.objects.filter(neighbour_id=product_id).delete()
+        ProductFeature.objects.filter(product_id=product_id).delete()
+        # Produit supprimé ou désactivé : il disparaît de l'index
+        product = _active_products().filter(pk=product_id).first()
+        promoted = set()
+
+        if product is not None:
+            frequencies = term_frequencies(product)
+            document_frequency = dict(
+                ProductFeature.objects.filter(feature__in=frequencies)
+                .values_list('feature').annotate(count=Count('id')).order_by()
+            )
+            n_documents = Product.objects.filter(is_active=True).exclude(pk=product_id).count()
+            vector = tfidf(frequencies, document_frequency, n_documents)
+            ProductFeature.objects.bulk_create([
+                ProductFeature(product_id=product_id, feature=feature, weight=weight)
+                for feature, weight in vector.items()
+            ], batch_size=1000)
+
+            scores = dict(_index_scores(vector, product_id).values_list('product_id', 'score'))
+            _replace_neighbours(product_id, scores.items(), top_k)
+
+            thresholds = {
+                pk: (count, lowest)
+                for pk, count, lowest in ProductSimilarity.objects.filter(
+                    product_id__in=ProductFeature.objects.filter(feature__in=vector).values('product_id')
+                ).values('product_id').annotate(
+                    count=Count('id'), lowest=Min('score')
+                ).values_list('product_id', 'count', 'lowest').order_by()
+            }
+            for pk, score in scores.items():
+                count, lowest = thresholds.get(pk, (0, 0))
+                if score > 0 and (count < top_k or score > lowest):
+                    promoted.add(pk)
+            ProductSimilarity.objects.bulk_create([
+                ProductSimilarity(product_id=pk, neighbour_id=product_id, score=scores[pk]) for pk in promoted
+            ], batch_size=1000)
+            _trim_neighbours([pk for pk in promoted if thresholds.get(pk, (0, 0))[0] >= top_k], top_k)
+        else:
+            ProductSimilarity.objects.filter(product_id=product_id).delete()
+
+        for pk in sorted(referencing - promoted - {product_id}):
+            _refresh_neighbours(pk, top_k)
+        cache.bump_generation_on_commit(ProductSimilarity)
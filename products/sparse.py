@@ -0,0 +1,186 @@
+"""
+Champs choisis par le client : ``?fields=`` et ``?expand=``.
+
+``?fields=id,name,price`` restreint la représentation aux champs nommés,
+``relation.champ`` s'appliquant au serializer imbriqué (``?fields=id,products.name``).
+``?expand=category`` ajoute ou remplace un champ par la représentation déclarée
+dans ``Meta.expandable_fields`` du serializer (``?expand=items.product`` pour
+un serializer imbriqué). Un nom inconnu est refusé par une erreur 400 qui le
+nomme.
+
+Les vues adaptent aussi leur requête : la projection compilée ne lit que les
+colonnes des champs retenus, et le chemin des serializers restreint le queryset
+(only(), select_related et prefetch des seules relations servies, voir
+compiled.Projection.restrict).
+"""
+import sys
+from functools import lru_cache
+
+from rest_framework.exceptions import ValidationError
+from rest_framework.serializers import ListSerializer
+
+SAFE_METHODS = ('GET', 'HEAD')
+
+
+def parse_names(value):
+    """ Noms d'une liste séparée par des virgules, triés et sans doublons """
+    return tuple(sorted({name.strip() for name in value.split(',') if name.strip()}))
+
+
+def split_paths(names):
+    """ Chemins pointés regroupés par premier nom : {'products': ('name',), 'id': ()} """
+    paths = {}
+    for name in names:
+        head, _, tail = name.partition('.')
+        paths.setdefault(head, [])
+        if tail:
+            paths[head].append(tail)
+    return {head: tuple(tails) for head, tails in paths.items()}
+
+
+def nested_selection(fields, expand, name):
+    """ Sélection (fields, expand) transmise au serializer imbriqué ``name`` """
+    nested_fields = None
+    if fields is not None:
+        # « products » seul demande le serializer imbriqué entier
+        tails = [path.partition('.')[2] for path in fields if path.startswith(name + '.')]
+        if tails and name not in fields:
+            nested_fields = tuple(tails)
+    nested_expand = tuple(path.partition('.')[2] for path in expand if path.startswith(name + '.'))
+    return nested_fields, nested_expand
+
+
+def expandable_serializer(serializer_class, name):
+    """ (classe de serializer, arguments) de l'entrée ``name`` de Meta.expandable_fields """
+    expandable_class, kwargs = serializer_class.Meta.expandable_fields[name]
+    if isinstance(expandable_class, str):
+        # Serializer déclaré plus loin dans le même module
+        expandable_class = getattr(sys.modules[serializer_class.__module__], expandable_class)
+    return expandable_class, kwargs
+
+
+@lru_cache(maxsize=None)
+def selectable_fields(serializer_class):
+    """
+    Champs sélectionnables de ``serializer_class`` : ({nom: classe imbriquée},
+    {nom: classe imbriquée}) pour les champs déclarés et ceux de
+    Meta.expandable_fields. La classe vaut None pour un champ sans sélection
+    imbriquée possible.
+    """
+    declared = {}
+    for name, field in serializer_class().fields.items():
+        child = field.child if isinstance(field, ListSerializer) else field
+        declared[name] = type(child) if isinstance(child, DynamicFieldsMixin) else None
+    expandable = {
+        name: expandable_serializer(serializer_class, name)[0]
+        for name in getattr(serializer_class.Meta, 'expandable_fields', {})
+    }
+    return declared, expandable
+
+
+def normalize_selection(serializer_class, fields, expand):
+    """
+    Sélection (fields, expand) réduite aux chemins qui changent la
+    représentation, triés : deux sélections équivalentes donnent la même clé
+    (compiled.compile_serializer). Lève ValidationError (400) en nommant les
+    champs inconnus.
+    """
+    unknown = {'fields': [], 'expand': []}
+    fields, expand = _normalize_selection(serializer_class, fields, expand, '', unknown)
+    unknown = {key: sorted(set(names)) for key, names in unknown.items() if names}
+    if unknown:
+        raise ValidationError(unknown)
+    return fields, expand
+
+
+def _normalize_selection(serializer_class, fields, expand, path, unknown):
+    declared, expandable = selectable_fields(serializer_class)
+    children = dict(declared)
+    expand_paths = split_paths(expand)
+    kept_expand = []
+    for name in expand_paths:
+        if name in expandable:
+            children[name] = expandable[name]
+            kept_expand.append(name)
+        elif name not in declared:
+            unknown['expand'].append(path + name)
+    field_paths = split_paths(fields) if fields is not None else {}
+    unknown['fields'] += [path + name for name in field_paths if name not in children]
+    kept_fields = None if fields is None else []
+    for name, child_class in children.items():
+        if fields is not None and name not in field_paths and name not in kept_expand:
+            continue
+        nested_fields, nested_expand = nested_selection(fields, expand, name)
+        if child_class is not None and (nested_fields is not None or nested_expand):
+            nested_fields, nested_expand = _normalize_selection(
+                child_class, nested_fields, nested_expand, f'{path}{name}.', unknown
+            )
+        elif child_class is None:
+            unknown['fields'] += [f'{path}{name}.{tail}' for tail in nested_fields or ()]
+            unknown['expand'] += [f'{path}{name}.{tail}' for tail in nested_expand]
+            nested_fields, nested_expand = None, ()
+        if kept_fields is not None and name in field_paths:
+            kept_fields += [name] if nested_fields is None else [f'{name}.{tail}' for tail in nested_fields]
+        kept_expand += [f'{name}.{tail}' for tail in nested_expand]
+    if kept_fields is not None:
+        kept_fields = tuple(sorted(kept_fields))
+    return kept_fields, tuple(sorted(kept_expand))
+
+
+class DynamicFieldsMixin:
+    """
+    Serializer acceptant ``fields`` (noms à garder, None pour tous) et
+    ``expand`` (champs de Meta.expandable_fields à ajouter). Chaque entrée de
+    expandable_fields est un couple (classe de serializer ou son nom, arguments).
+    """
+
+    def __init__(self, *args, fields=None, expand=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None or expand:
+            self.select_fields(*normalize_selection(type(self), fields, expand))
+
+    def select_fields(self, fields, expand):
+        expandable = getattr(self.Meta, 'expandable_fields', {})
+        expanded = split_paths(expand).keys() & expandable.keys()
+        for name in expanded:
+            serializer_class, kwargs = expandable_serializer(type(self), name)
+            self.fields[name] = serializer_class(**kwargs)
+        if fields is not None:
+            kept = split_paths(fields).keys() | expanded
+            for name in list(self.fields):
+                if name not in kept:
+                    self.fields.pop(name)
+        for name, field in self.fields.items():
+            child = field.child if isinstance(field, ListSerializer) else field
+            nested_fields, nested_expand = nested_selection(fields, expand, name)
+            if isinstance(child, DynamicFieldsMixin) and (nested_fields is not None or nested_expand):
+                child.select_fields(nested_fields, nested_expand)
+
+
+class SparseFieldsMixin:
+    """ Vue DRF dont les serializers suivent ?fields= et ?expand= (lectures seulement) """
+    fields_query_param = 'fields'
+    expand_query_param = 'expand'
+
+    def get_field_selection(self):
+        """ (fields, expand) demandés : fields vaut None si tous les champs sont servis """
+        request = getattr(self, 'request', None)
+        if request is None or request.method not in SAFE_METHODS:
+            return None, ()
+        fields = parse_names(request.query_params.get(self.fields_query_param, ''))
+        expand = parse_names(request.query_params.get(self.expand_query_param, ''))
+        return fields or None, expand
+
+    def selects(self, name):
+        """ Le champ ``name`` fait-il partie de la représentation demandée ? """
+        fields, expand = self.get_field_selection()
+        return fields is None or name in split_paths(fields) or name in split_paths(expand)
+
+    def get_selected_serializer(self, serializer_class, *args, **kwargs):
+        if issubclass(serializer_class, DynamicFieldsMixin):
+            kwargs['fields'], kwargs['expand'] = self.get_field_selection()
+        kwargs.setdefault('context', self.get_serializer_context())
+        return serializer_class(*args, **kwargs)
+
+    def get_serializer(self, *args, **kwargs):
+        return self.get_selected_serializer(self.get_serializer_class(), *args, **kwargs)
@@ -0,0 +1,53 @@
+"""
+Tâches différées du catalogue, exécutées par run_worker (voir queue.py).
+Les arguments sont des identifiants : l'objet est relu au moment de l'exécution.
+"""
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.core.mail import send_mail
+from django.utils import timezone
+
+from . import renditions, similarity
+from .models import Order, Task
+from .queue import task
+
+
+@task(max_attempts=3)
+def generate_image_renditions(model_label, pk):
+    renditions.generate_renditions(apps.get_model(model_label), pk)
+
+
+@task(priority=-1)
+def refresh_product_similarity(product_id, referencing=()):
+    similarity.refresh_product_similarity(product_id, referencing)
+
+
+@task(priority=-1, max_attempts=3)
+def rebuild_similarity_index():
+    similarity.rebuild_similarity_index()
+
+
+@task(priority=1)
+def send_order_confirmation(order_id):
+    order = Order.objects.with_items().filter(pk=order_id).first()
+    if order is None:
+        return
+    lines = '\n'.join(
+        f'- {item.quantity} x {item.product.name} : {item.price} €' for item in order.items.all()
+    )
+    send_mail(
+        f'Confirmation de votre commande n°{order.pk}',
+        f'Bonjour {order.first_name},\n\nNous avons bien reçu votre commande :\n{lines}\n\n'
+        f'Total : {order.total_price} €\n',
+        settings.DEFAULT_FROM_EMAIL,
+        [order.email],
+    )
+
+
+@task(every=timedelta(days=1))
+def purge_finished_tasks():
+    """ Supprime les tâches terminées depuis plus de TASK_RETENTION_DAYS jours """
+    retention = timedelta(days=getattr(settings, 'TASK_RETENTION_DAYS', 7))
+    Task.objects.filter(status__in=('done', 'failed'), finished_at__lt=timezone.now() - retention).delete()
@@ -1,3 +1,2209 @@
-from django.test import TestCase
+import base64
+import csv
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+import importlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.apps import apps as django_apps
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core import mail
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError, connection, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from django.utils import timezone
+from django.utils.http import parse_http_date, urlencode
+from django.utils.text import slugify
+from django.utils.translation import gettext_lazy
+from PIL import Image
+from prometheus_client import REGISTRY
+from rest_framework.exceptions import ParseError, ValidationError
+from rest_framework.permissions import BasePermission
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIClient
+
+from .models import (
+    Category, Order, OrderItem, Product, ProductImage, ProductSimilarity, Review, Task, Wishlist
+)
+from . import async_views, metrics, replicas, tasks, urls as product_urls
+from .compiled import _compile_serializer, compile_serializer
+from .renderers import ORJSONParser, ORJSONRenderer
+from .serializers import CategorySerializer, OrderSerializer, ProductListSerializer, ProductSerializer
+from .queue import Worker, task
+from .search import get_search_backend
+from .views import ProductViewSet
+
+# Tailles de catalogue sur lesquelles chaque route est mesurée
+CATALOG_SIZES = (10, 100, 1000)
+
+
+class CatalogFixture:
+    """
+    Catalogue de test agrandi par paliers avec bulk_create : une catégorie et
+    une liste de souhaits anonyme pour dix produits ; chaque produit a deux
+    images, trois avis, des voisins de similarité, une place dans la liste de
+    souhaits de l'utilisateur et une commande de trois lignes.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.categories = []
+        self.wishlist = Wishlist.objects.create(user=user)
+        self.size = 0
+
+    def grow(self, size):
+        if size <= self.size:
+            return
+        self.categories += Category.objects.bulk_create([
+            Category(name=f'Catégorie {index}', slug=f'categorie-{index}')
+            for index in range(len(self.categories), size // 10)
+        ])
+        products = Product.objects.bulk_create([
+            Product(
+                name=f'Produit {index}',
+                slug=f'produit-{index}',
+                description='Soin hydratant',
+                ingredients="huile d'argan, karité",
+                price=Decimal('10.00') + index % 50,
+                category=self.categories[index % len(self.categories)],
+                stock=index % 20,
+                image='products/produit.jpg',
+                is_featured=index % 3 == 0,
+                rating_sum=12,
+                rating_count=3,
+            )
+            for index in range(self.size, size)
+        ])
+        ProductImage.objects.bulk_create([
+            ProductImage(product=product, image='products/additional/image.jpg', alt_text=product.name, order=order)
+            for product in products for order in range(2)
+        ])
+        Review.objects.bulk_create([
+            Review(product=product, user=self.user, rating=rating, comment='Très bien')
+            for product in products for rating in (3, 4, 5)
+        ])
+        ProductSimilarity.objects.bulk_create([
+            ProductSimilarity(product=product, neighbour=neighbour, score=1.0 / (offset + 1))
+            for offset, product in enumerate(products)
+            for neighbour in products[offset + 1:offset + 6]
+        ])
+        search_backend = get_search_backend()
+        if search_backend is not None:
+            search_backend.index_products(products)
+        self.wishlist.products.add(*products)
+        for wishlist in Wishlist.objects.bulk_create([Wishlist() for _ in range(len(products) // 10)]):
+            wishlist.products.add(*products[:3])
+        orders = Order.objects.bulk_create([
+            Order(first_name='Jeanne', last_name='Martin', email='jeanne@example.com', address='Paris')
+            for product in products
+        ])
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, quantity=1, price=product.price)
+            for order, product in zip(orders, products) for _ in range(3)
+        ])
+        self.size = size
+
+
+class QueryBudgetTestCase(TestCase):
+    """
+    Vérifie qu'une route reste sous un budget de requêtes SQL et que ce nombre
+    ne dépend pas de la taille du catalogue (pas de N+1).
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        User = get_user_model()
+        cls.user = User.objects.create_user('client', 'client@example.com', 'secret')
+        cls.staff = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+
+    def setUp(self):
+        cache.clear()
+        self.catalog = CatalogFixture(self.user)
+        self.api = APIClient()
+
+    def measure(self, request):
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = request()
+        self.assertLess(response.status_code, 300, getattr(response, 'data', response))
+        return len(context.captured_queries)
+
+    def assertFlatQueryBudget(self, request, budget, prepare=None):
+        counts = []
+        for size in CATALOG_SIZES:
+            self.catalog.grow(size)
+            if prepare is not None:
+                prepare()
+            counts.append(self.measure(request))
+        self.assertLessEqual(max(counts), budget, f'requêtes par taille {CATALOG_SIZES}: {counts}')
+        self.assertEqual(len(set(counts)), 1, f'requêtes par taille {CATALOG_SIZES}: {counts}')
+
+
+class ProductQueryBudgetTests(QueryBudgetTestCase):
+
+    def test_list(self):
+        self.assertFlatQueryBudget(lambda: self.api.get('/api/products/?page_size=100'), 2)
+
+    def test_list_filtered_and_ordered(self):
+        self.assertFlatQueryBudget(
+            lambda: self.api.get('/api/products/?page_size=100&ordering=-price&in_stock=1&min_price=12'), 2
+        )
+
+    def test_list_deep_cursor(self):
+        def request():
+            response = self.api.get('/api/products/?page_size=5&ordering=price')
+            return self.api.get(response.data['next'])
+        self.assertFlatQueryBudget(request, 4)
+
+    def test_search(self):
+        self.assertFlatQueryBudget(lambda: self.api.get('/api/products/?search=hydratant&page_size=100'), 2)
+
+    def test_featured(self):
+        self.assertFlatQueryBudget(lambda: self.api.get('/api/products/featured/?page_size=100'), 2)
+
+    def test_retrieve(self):
+        self.assertFlatQueryBudget(lambda: self.api.get('/api/products/produit-0/'), 4)
+
+    def test_by_slug(self):
+        self.assertFlatQueryBudget(lambda: self.api.get('/api/products/produit-0/by_slug/'), 3)
+
+    def test_similar(self):
+        self.assertFlatQueryBudget(lambda: self.api.get('/api/products/produit-0/similar/'), 2)
+
+    def test_reviews(self):
+        self.assertFlatQueryBudget(lambda: self.api.get('/api/products/produit-0/reviews/'), 2)
+
+    def test_low_stock(self):
+        self.api.force_authenticate(self.staff)
+        self.assertFlatQueryBudget(lambda: self.api.get('/api/products/low_stock/'), 1)
+
+    def test_review_create(self):
+        self.api.force_authenticate(self.staff)
+        reviewed = iter(range(len(CATALOG_SIZES)))
+        self.assertFlatQueryBudget(
+            lambda: self.api.post(
+                f'/api/products/produit-{next(reviewed)}/review/', {'rating': 4, 'comment': 'Parfait'}
+            ),
+            5
+        )
+
+
+class CategoryQueryBudgetTests(QueryBudgetTestCase):
+
+    def test_list(self):
+        self.assertFlatQueryBudget(lambda: self.api.get('/api/categories/'), 3)
+
+    def test_retrieve(self):
+        self.assertFlatQueryBudget(lambda: self.api.get('/api/categories/categorie-0/'), 2)
+
+    def test_products(self):
+        self.assertFlatQueryBudget(lambda: self.api.get('/api/categories/categorie-0/products/'), 4)
+
+
+class WishlistQueryBudgetTests(QueryBudgetTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.api.force_authenticate(self.user)
+        self.product = None
+
+    def take_latest_product(self):
+        self.product = Product.objects.latest('pk')
+
+    def test_list(self):
+        self.assertFlatQueryBudget(lambda: self.api.get('/api/wishlist/'), 3)
+
+    def test_retrieve(self):
+        self.assertFlatQueryBudget(lambda: self.api.get(f'/api/wishlist/{self.catalog.wishlist.pk}/'), 2)
+
+    def test_add(self):
+        def prepare():
+            self.take_latest_product()
+            self.catalog.wishlist.products.remove(self.product)
+        self.assertFlatQueryBudget(
+            lambda: self.api.post(f'/api/wishlist/add/{self.product.pk}/'), 4, prepare=prepare
+        )
+
+    def test_remove(self):
+        self.assertFlatQueryBudget(
+            lambda: self.api.delete(f'/api/wishlist/remove/{self.product.pk}/'), 4,
+            prepare=self.take_latest_product
+        )
+
+    def test_contains(self):
+        self.assertFlatQueryBudget(
+            lambda: self.api.get(f'/api/wishlist/contains/?ids={",".join(map(str, range(1, 51)))}'), 1
+        )
+
+    def test_items(self):
+        self.assertFlatQueryBudget(lambda: self.api.get('/api/wishlist/items/'), 1)
+
+    def test_bulk(self):
+        self.assertFlatQueryBudget(
+            lambda: self.api.post(
+                '/api/wishlist/bulk/', {'add': list(range(1, 51)), 'remove': list(range(51, 101))}, format='json'
+            ),
+            7
+        )
+
+
+class WishlistTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('client', 'client@example.com', 'secret')
+        category = Category.objects.create(name='Soins', slug='soins')
+        cls.products = Product.objects.bulk_create([
+            Product(
+                name=f'Produit {index}', slug=f'produit-{index}', description='Soin', price=Decimal('10.00'),
+                category=category, image='products/produit.jpg', is_active=index != 3,
+            )
+            for index in range(5)
+        ])
+
+    def setUp(self):
+        self.api = APIClient()
+        self.api.force_authenticate(self.user)
+
+    def bulk(self, **changes):
+        response = self.api.post('/api/wishlist/bulk/', changes, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data['product_ids']
+
+    def test_bulk_add_and_remove(self):
+        first, second, third, inactive, fifth = (product.pk for product in self.products)
+        self.assertEqual(self.bulk(add=[first, second, inactive, 999999]), [first, second])
+        self.assertEqual(self.bulk(add=[second, third], remove=[first]), [second, third])
+
+    def test_contains(self):
+        first, second = self.products[0].pk, self.products[1].pk
+        self.bulk(add=[first])
+        response = self.api.get(f'/api/wishlist/contains/?ids={first},{second}')
+        self.assertEqual(response.data['in_wishlist'], {first: True, second: False})
+        response = self.api.post('/api/wishlist/contains/', {'product_ids': [second]}, format='json')
+        self.assertEqual(response.data['in_wishlist'], {second: False})
+        self.assertEqual(self.api.get('/api/wishlist/contains/?ids=abc').status_code, 400)
+
+    def test_items(self):
+        self.bulk(add=[self.products[1].pk, self.products[0].pk])
+        response = self.api.get('/api/wishlist/items/')
+        self.assertEqual(response.data['product_ids'], [self.products[0].pk, self.products[1].pk])
+        self.assertEqual(
+            set(response.data['products'][0]),
+            {'id', 'name', 'slug', 'price', 'discount_price', 'thumbnail', 'is_in_stock'}
+        )
+
+    def test_add_twice(self):
+        url = f'/api/wishlist/add/{self.products[0].pk}/'
+        self.assertEqual(self.api.post(url).status_code, 200)
+        self.assertEqual(self.api.post(url).status_code, 400)
+
+
+class OrderQueryBudgetTests(QueryBudgetTestCase):
+
+    def test_list(self):
+        self.assertFlatQueryBudget(lambda: self.api.get('/api/orders/?page_size=100'), 2)
+
+    def test_retrieve(self):
+        self.assertFlatQueryBudget(lambda: self.api.get(f'/api/orders/{Order.objects.first().pk}/'), 3)
+
+    @override_settings(ORDER_EXPORT_SAFETY_LAG=0)
+    def test_export(self):
+        self.api.force_authenticate(self.staff)
+
+        def request():
+            response = self.api.get('/api/orders/export/?format=ndjson')
+            response.exported = b''.join(response.streaming_content)
+            return response
+        self.assertFlatQueryBudget(request, 3)
+
+    def test_create_is_constant_in_number_of_items(self):
+        self.catalog.grow(max(CATALOG_SIZES))
+        Product.objects.update(stock=1000)
+        counts = []
+        for items_count in (1, 10, 100):
+            payload = {
+                'first_name': 'Jeanne', 'last_name': 'Martin', 'email': 'jeanne@example.com',
+                'address': 'Paris',
+                'items': [
+                    {'product': pk, 'quantity': 2}
+                    for pk in Product.objects.values_list('pk', flat=True)[:items_count]
+                ],
+            }
+            counts.append(self.measure(
+                lambda: self.api.post('/api/orders/create/', json.dumps(payload), content_type='application/json')
+            ))
+        self.assertLessEqual(max(counts), 6, counts)
+        self.assertEqual(len(set(counts)), 1, counts)
+
+
+class AdminQueryBudgetTests(QueryBudgetTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.staff)
+
+    def changelist(self, model):
+        url = reverse(f'admin:products_{model}_changelist')
+        return lambda: self.client.get(url)
+
+    def test_product_changelist(self):
+        self.assertFlatQueryBudget(self.changelist('product'), 5)
+
+    def test_product_changelist_search(self):
+        url = reverse('admin:products_product_changelist') + '?q=karite'
+        self.assertFlatQueryBudget(lambda: self.client.get(url), 5)
+
+    def test_review_changelist(self):
+        self.assertFlatQueryBudget(self.changelist('review'), 5)
+
+    def test_category_changelist(self):
+        self.assertFlatQueryBudget(self.changelist('category'), 5)
+
+    def test_wishlist_changelist(self):
+        self.assertFlatQueryBudget(self.changelist('wishlist'), 4)
+
+    def test_changelists_sorted_by_aggregate(self):
+        self.assertFlatQueryBudget(lambda: self.client.get(reverse('admin:products_product_changelist') + '?o=7'), 5)
+        self.assertFlatQueryBudget(lambda: self.client.get(reverse('admin:products_category_changelist') + '?o=4'), 5)
+
+    def change_form(self, model, pk):
+        url = reverse(f'admin:products_{model}_change', args=[pk])
+        return lambda: self.client.get(url)
+
+    def test_product_change_form(self):
+        # Premier affichage : met en cache les ContentType, hors budget
+        self.catalog.grow(CATALOG_SIZES[0])
+        request = self.change_form('product', Product.objects.first().pk)
+        self.assertFlatQueryBudget(request, 11, prepare=request)
+
+    def test_wishlist_change_form(self):
+        # Les produits de la liste sont affichés en autocomplétion, pas tous chargés
+        request = self.change_form('wishlist', self.catalog.wishlist.pk)
+        self.assertFlatQueryBudget(request, 6, prepare=request)
+
+
+@override_settings(TASK_ALWAYS_EAGER=True, IMAGE_RENDITION_WIDTHS=(100, 200))
+class ImageRenditionTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.category = Category.objects.create(name='Soins', slug='soins')
+
+    def upload(self, name, size=(400, 300), image_format='JPEG'):
+        buffer = BytesIO()
+        Image.new('RGB', size, 'pink').save(buffer, image_format)
+        return SimpleUploadedFile(name, buffer.getvalue())
+
+    def create_product(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Product.objects.create(
+                name='Crème', slug='creme', description='Soin', price=Decimal('10.00'),
+                category=self.category, image=self.upload('creme.jpg'),
+            )
+
+    def test_renditions_and_thumbnail_are_generated_after_commit(self):
+        product = self.create_product()
+        product.refresh_from_db()
+        self.assertTrue(product.thumbnail)
+        with Image.open(product.thumbnail.path) as thumbnail:
+            self.assertEqual(thumbnail.width, 320)
+        variants = product.renditions['image']['variants']
+        self.assertEqual(
+            [(width, image_format) for width, image_format, _ in variants],
+            [(100, 'jpeg'), (100, 'webp'), (200, 'jpeg'), (200, 'webp'), (400, 'jpeg'), (400, 'webp')]
+        )
+        for width, _, name in variants:
+            with Image.open(os.path.join(self.media_root, name)) as rendition:
+                self.assertEqual(rendition.width, width)
+
+    def test_serializer_exposes_srcset(self):
+        self.create_product()
+        response = self.client.get('/api/products/creme/')
+        renditions = response.json()['image_renditions']
+        self.assertEqual(set(renditions), {'jpeg', 'webp'})
+        self.assertRegex(renditions['webp'], r'^http://testserver/media/renditions/products/creme\S*-100w\.webp 100w, ')
+
+    def test_replaced_image_gets_new_renditions(self):
+        product = self.create_product()
+        product.refresh_from_db()
+        with self.captureOnCommitCallbacks(execute=True):
+            product.image = self.upload('serum.png', size=(150, 150), image_format='PNG')
+            product.save()
+        product.refresh_from_db()
+        self.assertEqual(product.renditions['image']['source'], product.image.name)
+        self.assertEqual(
+            [(width, image_format) for width, image_format, _ in product.renditions['image']['variants']],
+            [(100, 'png'), (100, 'webp'), (150, 'png'), (150, 'webp')]
+        )
+
+
+@override_settings(ORDER_EXPORT_SAFETY_LAG=0)
+class OrderExportTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        User = get_user_model()
+        cls.staff = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        cls.customer = User.objects.create_user('client', 'client@example.com', 'secret')
+        category = Category.objects.create(name='Soins', slug='soins')
+        cls.product = Product.objects.create(
+            name='Crème, "riche"', slug='creme', description='Soin', price=Decimal('12.50'),
+            category=category, image='products/creme.jpg',
+        )
+        cls.orders = []
+        for index, order_status in enumerate(['pending', 'delivered', 'delivered']):
+            order = Order.objects.create(
+                first_name='Jeanne', last_name=f'Martin {index}', email='jeanne@example.com',
+                address='Paris', status=order_status, total_price=Decimal('25.00'),
+            )
+            OrderItem.objects.create(order=order, product=cls.product, quantity=2, price=Decimal('25.00'))
+            cls.orders.append(order)
+
+    def setUp(self):
+        self.api = APIClient()
+        self.api.force_authenticate(self.staff)
+
+    def export(self, query=''):
+        response = self.api.get(f'/api/orders/export/{query}')
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join(response.streaming_content).decode('utf-8')
+
+    def test_csv(self):
+        response, content = self.export()
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertIn('attachment;', response['Content-Disposition'])
+        lines = content.splitlines()
+        self.assertEqual(lines[0].split(',')[:3], ['order_id', 'created_at', 'status'])
+        self.assertEqual(len(lines), 4)
+        self.assertIn('"Crème, ""riche""",2,25.00', lines[1])
+
+    def test_ndjson_with_status_filter(self):
+        response, content = self.export('?format=ndjson&status=delivered')
+        documents = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([document['id'] for document in documents], [order.pk for order in self.orders[1:]])
+        self.assertEqual(documents[0]['items'], [
+            {'product_id': self.product.pk, 'product_name': 'Crème, "riche"', 'quantity': 2, 'price': '25.00'}
+        ])
+
+    def test_incremental_export(self):
+        response, _ = self.export('?format=ndjson')
+        cursor = response['X-Export-Cursor']
+        self.assertTrue(cursor.endswith(f'_{self.orders[-1].pk}'))
+
+        response, content = self.export(f'?format=ndjson&after={cursor}')
+        self.assertEqual(content, '')
+        self.assertEqual(response['X-Export-Cursor'], cursor)
+
+        new_order = Order.objects.create(first_name='Léa', last_name='Petit', email='lea@example.com', address='Lyon')
+        response, content = self.export(f'?format=ndjson&after={cursor}')
+        self.assertEqual([json.loads(line)['id'] for line in content.splitlines()], [new_order.pk])
+
+    def test_safety_lag(self):
+        new_order = Order.objects.create(first_name='Léa', last_name='Petit', email='lea@example.com', address='Lyon')
+        with override_settings(ORDER_EXPORT_SAFETY_LAG=60):
+            response, content = self.export('?format=ndjson')
+        self.assertNotIn(new_order.pk, [json.loads(line)['id'] for line in content.splitlines()])
+        cursor = response['X-Export-Cursor']
+        Order.objects.filter(pk=new_order.pk).update(created_at=timezone.now() - timedelta(minutes=5))
+        with override_settings(ORDER_EXPORT_SAFETY_LAG=60):
+            _, content = self.export(f'?format=ndjson&after={cursor}')
+        self.assertEqual([json.loads(line)['id'] for line in content.splitlines()], [new_order.pk])
+
+    def test_orders_without_items_and_formulas(self):
+        order = Order.objects.create(
+            first_name='=HYPERLINK("http://example.com")', last_name='@SOMME(A1)', email='lea@example.com',
+            address='-2+3', phone='+33600000000',
+        )
+        _, content = self.export()
+        row = next(line for line in csv.reader(content.splitlines()) if line[0] == str(order.pk))
+        self.assertEqual(row[3:7], ["'=HYPERLINK(\"http://example.com\")", "'@SOMME(A1)", 'lea@example.com', "'+33600000000"])
+        self.assertEqual(row[7], "'-2+3")
+        self.assertEqual(row[-4:], ['', '', '', ''])
+
+    def test_date_filter(self):
+        Order.objects.filter(pk=self.orders[0].pk).update(created_at=timezone.now() - timedelta(days=10))
+        _, content = self.export(f'?format=ndjson&created_after={(timezone.now() - timedelta(days=1)).date()}')
+        self.assertEqual(len(content.splitlines()), 2)
+
+    def test_invalid_filter(self):
+        response = self.api.get('/api/orders/export/?status=inconnu')
+        self.assertEqual(response.status_code, 400)
+        response = self.api.get('/api/orders/export/?after=42')
+        self.assertEqual(response.status_code, 400)
+
+    def test_staff_only(self):
+        self.api.force_authenticate(self.customer)
+        self.assertEqual(self.api.get('/api/orders/export/').status_code, 403)
+
+
+class BenchCommandsTests(TestCase):
+
+    def test_seed_then_bench(self):
+        call_command(
+            'seed_catalog', categories=2, products=6, images_per_product=1, reviews_per_product=1,
+            wishlists=2, orders=3, seed=1, stdout=StringIO(),
+        )
+        self.assertEqual(Product.objects.count(), 6)
+        self.assertEqual(Order.objects.count(), 3)
+        get_user_model().objects.create_superuser('bench', 'bench@example.com', 'secret')
+        out = StringIO()
+        call_command(
+            'bench_api', requests=2, warmup=0, user='bench', writes=True, stdout=out, stderr=StringIO(),
+        )
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['mode'], 'test-client')
+        self.assertEqual(report['catalog']['products'], 6)
+        self.assertTrue({
+            'product-facets', 'order-create', 'order-export', 'wishlist-add', 'wishlist-remove',
+            'wishlist-contains', 'wishlist-items', 'wishlist-bulk', 'wishlist-detail',
+        } <= set(report['endpoints']))
+        for name, result in report['endpoints'].items():
+            with self.subTest(endpoint=name):
+                self.assertEqual(result['requests'], 2)
+                self.assertEqual(set(result['latency_ms']), {'mean', 'p50', 'p95', 'p99', 'max'})
+                self.assertIn('queries', result)
+                self.assertFalse(any(status.startswith('5') for status in result['statuses']), result['statuses'])
+        self.assertEqual(report['endpoints']['order-create']['statuses'], {'201': 2})
+
+    def test_writes_are_opt_in(self):
+        call_command('seed_catalog', categories=1, products=2, wishlists=0, orders=1, seed=1, stdout=StringIO())
+        out = StringIO()
+        call_command('bench_api', requests=1, warmup=0, stdout=out, stderr=StringIO())
+        endpoints = json.loads(out.getvalue())['endpoints']
+        self.assertIn('product-list', endpoints)
+        self.assertNotIn('order-create', endpoints)
+        self.assertNotIn('wishlist-items', endpoints)
+
+
+class ImportProductsTests(TestCase):
+    CSV = (
+        'name,price,category,stock,description\n'
+        'Crème hydratante,12.50,soins,5,Pour le visage\n'
+        'Crème hydratante,14.00,soins,2,Format voyage\n'
+        'Sérum éclat,"29,90",soins,0,Vitamine C\n'
+    )
+
+    def setUp(self):
+        self.category = Category.objects.create(name='Soins', slug='soins')
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.directory = directory
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w', encoding='utf-8') as handle:
+            handle.write(content)
+        return path
+
+    def run_import(self, path, *args):
+        stdout, stderr = StringIO(), StringIO()
+        call_command('import_products', path, *args, stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_create_then_idempotent_reimport(self):
+        path = self.write('catalogue.csv', self.CSV)
+        output, _ = self.run_import(path, '--chunk-size', '2')
+        self.assertIn('3 créés', output)
+        self.assertEqual(
+            dict(Product.objects.values_list('slug', 'price')),
+            {'creme-hydratante': Decimal('12.50'), 'creme-hydratante-2': Decimal('14.00'),
+             'serum-eclat': Decimal('29.90')}
+        )
+        output, _ = self.run_import(path)
+        self.assertIn('0 créés, 0 modifiés, 3 inchangés', output)
+        self.assertEqual(Product.objects.count(), 3)
+
+    def test_upsert_keeps_columns_absent_from_file(self):
+        self.run_import(self.write('catalogue.csv', self.CSV))
+        self.run_import(self.write('prix.ndjson', '{"slug": "serum-eclat", "price": 24.9}\n'))
+        serum = Product.objects.get(slug='serum-eclat')
+        self.assertEqual((serum.price, serum.description, serum.stock), (Decimal('24.90'), 'Vitamine C', 0))
+
+    def test_dry_run_writes_nothing(self):
+        self.run_import(self.write('catalogue.csv', self.CSV))
+        updated_at = Product.objects.get(slug='serum-eclat').updated_at
+        path = self.write('catalogue.json', '[{"slug": "serum-eclat", "stock": 7}, {"name": "Baume", "price": "8", "category": "soins"}]')
+        output, _ = self.run_import(path, '--dry-run')
+        self.assertIn("~ serum-eclat\n    stock : 0 -> 7", output)
+        self.assertIn('+ baume', output)
+        self.assertEqual(Product.objects.count(), 3)
+        self.assertEqual(Product.objects.get(slug='serum-eclat').updated_at, updated_at)
+
+    def test_invalid_rows_are_reported_and_skipped(self):
+        path = self.write('catalogue.csv', 'name,price,category\nBaume,abc,soins\nGel,5,inconnue\nLait,5,soins\n')
+        output, errors = self.run_import(path)
+        self.assertIn('Ligne 1 : nombre invalide', errors)
+        self.assertIn("Ligne 2 : catégorie inconnue : 'inconnue'", errors)
+        self.assertEqual(list(Product.objects.values_list('slug', flat=True)), ['lait'])
+        self.assertIn('1 créés', output)
+
+    def test_create_categories(self):
+        path = self.write('catalogue.csv', 'name,price,category\nGel douche,5,corps\n')
+        self.run_import(path, '--create-categories')
+        self.assertEqual(Product.objects.get().category.slug, 'corps')
+
+    def test_json_array_is_read_incrementally(self):
+        products = [{'name': f'Produit {index}', 'price': '5', 'category': 'soins'} for index in range(50)]
+        path = self.write('catalogue.json', json.dumps(products))
+        from products.management.commands import import_products
+        with open(path, encoding='utf-8') as handle:
+            self.assertEqual(list(import_products.iter_json(handle, buffer_size=64)), products)
+
+
+calls = []
+
+
+@task(name='tests.record')
+def record(value):
+    calls.append(value)
+
+
+@task(name='tests.flaky', max_attempts=2)
+def flaky():
+    raise RuntimeError('indisponible')
+
+
+@task(name='tests.periodic', every=timedelta(hours=1))
+def periodic():
+    calls.append('periodic')
+
+
+class TaskQueueTests(TestCase):
+
+    def setUp(self):
+        calls.clear()
+        self.worker = Worker()
+
+    def run_ready(self):
+        for queued in self.worker.claim(100):
+            self.worker.execute(queued)
+
+    def test_only_ready_tasks_are_run(self):
+        record.enqueue('maintenant')
+        later = record.enqueue('plus tard', delay=timedelta(minutes=5))
+        self.run_ready()
+        self.assertEqual(calls, ['maintenant'])
+        self.assertEqual(Task.objects.get(args=['maintenant']).status, 'done')
+        self.assertEqual(Task.objects.get(pk=later.pk).status, 'pending')
+
+    def test_unique_enqueue_reuses_pending_task(self):
+        first = record.enqueue(1, unique=True)
+        self.assertEqual(record.enqueue(1, unique=True), first)
+        self.assertNotEqual(record.enqueue(2, unique=True), first)
+
+    def test_failure_is_retried_with_backoff_then_abandoned(self):
+        queued = flaky.enqueue()
+        with self.assertLogs('products.queue', 'WARNING'):
+            self.run_ready()
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), ('pending', 1))
+        self.assertGreater(queued.run_at, timezone.now() + timedelta(seconds=5))
+        self.assertIn('indisponible', queued.last_error)
+
+        Task.objects.filter(pk=queued.pk).update(run_at=timezone.now())
+        with self.assertLogs('products.queue', 'ERROR'):
+            self.run_ready()
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), ('failed', 2))
+
+    def test_stale_running_task_is_requeued(self):
+        queued = record.enqueue('bloquée')
+        Task.objects.filter(pk=queued.pk).update(status='running', started_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(self.worker.requeue_stale(), 1)
+        self.run_ready()
+        self.assertEqual(calls, ['bloquée'])
+
+    def test_stale_task_without_attempts_left_is_failed(self):
+        queued = flaky.enqueue()
+        stale = timezone.now() - timedelta(hours=1)
+        Task.objects.filter(pk=queued.pk).update(status='running', attempts=2, started_at=stale, heartbeat_at=stale)
+        with self.assertLogs('products.queue', 'ERROR'):
+            self.assertEqual(self.worker.requeue_stale(), 0)
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, 'failed')
+        self.assertIn('Worker arrêté', queued.last_error)
+        self.run_ready()
+        self.assertEqual(Task.objects.get(pk=queued.pk).status, 'failed')
+
+    def test_requeued_task_outcome_belongs_to_new_worker(self):
+        queued = record.enqueue('lente')
+        [slow] = self.worker.claim(1)
+        long_ago = timezone.now() - timedelta(hours=1)
+        Task.objects.filter(pk=queued.pk).update(heartbeat_at=long_ago)
+        other = Worker()
+        other.name = 'autre'
+        self.assertEqual(other.requeue_stale(), 1)
+        [retry] = other.claim(1)
+
+        # Le premier worker termine après la reprise : son issue est ignorée
+        self.worker.execute(slow)
+        self.assertEqual(Task.objects.get(pk=queued.pk).status, 'running')
+        other.execute(retry)
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.worker), ('done', 'autre'))
+
+    def test_heartbeat_keeps_long_running_task_claimed(self):
+        queued = record.enqueue('longue')
+        [claimed] = self.worker.claim(1)
+        self.assertEqual(claimed.heartbeat_at, claimed.started_at)
+        other = Worker()
+        long_ago = timezone.now() - timedelta(hours=1)
+        Task.objects.filter(pk=queued.pk).update(started_at=long_ago, heartbeat_at=long_ago)
+
+        # Le worker signale ses tâches en cours : elles ne sont pas reprises par un autre
+        self.worker.heartbeat(force=True)
+        self.assertEqual(other.requeue_stale(), 0)
+        self.assertEqual(Task.objects.get(pk=queued.pk).status, 'running')
+
+        # Plus de signal depuis TASK_TIMEOUT : le worker est considéré arrêté
+        Task.objects.filter(pk=queued.pk).update(heartbeat_at=long_ago)
+        self.assertEqual(other.requeue_stale(), 1)
+        self.assertEqual(Task.objects.get(pk=queued.pk).status, 'pending')
+
+    def test_heartbeat_is_throttled(self):
+        record.enqueue('longue')
+        self.worker.claim(1)
+        self.worker.heartbeat(force=True)
+        with self.assertNumQueries(0):
+            self.worker.heartbeat()
+
+    def test_periodic_task_is_rescheduled_after_run(self):
+        self.worker.schedule_periodic()
+        self.run_ready()
+        self.assertIn('periodic', calls)
+        self.worker.schedule_periodic()
+        upcoming = Task.objects.get(name='tests.periodic', status='pending')
+        self.assertGreater(upcoming.run_at, timezone.now() + timedelta(minutes=59))
+
+    def test_order_confirmation_is_sent_by_worker(self):
+        category = Category.objects.create(name='Soins', slug='soins')
+        product = Product.objects.create(
+            name='Crème', slug='creme', description='Soin', price=Decimal('10.00'),
+            category=category, stock=5, image='products/creme.jpg',
+        )
+        payload = {
+            'first_name': 'Jeanne', 'last_name': 'Martin', 'email': 'jeanne@example.com',
+            'address': 'Paris', 'items': [{'product': product.pk, 'quantity': 2}],
+        }
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/orders/create/', json.dumps(payload), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(mail.outbox, [])
+        self.run_ready()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['jeanne@example.com'])
+
+    def test_admin_changelist_shows_queue_stats(self):
+        record.enqueue('visible')
+        admin_user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.force_login(admin_user)
+        response = self.client.get(reverse('admin:products_task_changelist'))
+        self.assertContains(response, 'État de la file')
+        self.assertContains(response, 'tests.record : 1')
+
+
+@override_settings(DATABASE_REPLICAS=['replica'], DATABASE_REPLICA_MAX_LAG=5)
+class ReplicaRoutingTests(TestCase):
+
+    def setUp(self):
+        replicas._lags.clear()
+        patcher = mock.patch('products.replicas.replica_lag', return_value=0)
+        self.replica_lag = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.router = replicas.ReplicaRouter()
+
+    def test_reads_use_primary_unless_allowed(self):
+        self.assertEqual(self.router.db_for_read(Product), 'default')
+        with replicas.replica_reads():
+            self.assertEqual(self.router.db_for_read(Product), 'replica')
+        self.assertEqual(self.router.db_for_read(Product), 'default')
+
+    def test_write_pins_rest_of_request_to_primary(self):
+        with replicas.replica_reads():
+            self.assertEqual(self.router.db_for_write(Product), 'default')
+            self.assertEqual(self.router.db_for_read(Product), 'default')
+
+    def test_lagging_replica_is_skipped(self):
+        self.replica_lag.return_value = 30
+        with replicas.replica_reads():
+            self.assertEqual(self.router.db_for_read(Product), 'default')
+        # Mesure mise en cache : pas de nouvelle requête de retard à chaque lecture
+        self.assertEqual(self.replica_lag.call_count, 1)
+
+    def test_pin_cookie_routes_reads_to_primary(self):
+        def view(request):
+            with replicas.replica_reads():
+                return HttpResponse(self.router.db_for_read(Product))
+        middleware = replicas.PrimaryPinningMiddleware(view)
+        factory = RequestFactory()
+        self.assertEqual(middleware(factory.get('/')).content, b'replica')
+        factory.cookies[replicas.PIN_COOKIE] = '1'
+        self.assertEqual(middleware(factory.get('/')).content, b'default')
+
+    def test_order_creation_sets_pin_cookie(self):
+        category = Category.objects.create(name='Soins', slug='soins')
+        product = Product.objects.create(
+            name='Crème', slug='creme', description='Soin', price=Decimal('10.00'),
+            category=category, stock=5, image='products/creme.jpg',
+        )
+        payload = {
+            'first_name': 'Jeanne', 'last_name': 'Martin', 'email': 'jeanne@example.com',
+            'address': 'Paris', 'items': [{'product': product.pk, 'quantity': 2}],
+        }
+        response = self.client.post('/api/orders/create/', json.dumps(payload), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertIn(replicas.PIN_COOKIE, response.cookies)
+        response = self.client.get('/api/products/')
+        self.assertNotIn(replicas.PIN_COOKIE, response.cookies)
+
+    def test_replica_responses_are_neither_cached_nor_validated(self):
+        category = Category.objects.create(name='Soins', slug='soins')
+        Product.objects.create(
+            name='Crème', slug='creme', description='Soin', price=Decimal('10.00'),
+            category=category, stock=5, image='products/creme.jpg',
+        )
+        cache.clear()
+        # Réplica en retard (mais sous DATABASE_REPLICA_MAX_LAG) simulé par la base de test
+        self.replica_lag.return_value = 4
+        with mock.patch('products.replicas.choose_replica', return_value='default'):
+            for _ in range(2):
+                response = self.client.get('/api/products/creme/')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response['X-Cache'], 'MISS')
+                self.assertNotIn('ETag', response)
+                self.assertNotIn('Last-Modified', response)
+            response = async_to_sync(async_views.product_list)(RequestFactory().get('/api/products/'))
+            self.assertEqual(response['X-Cache'], 'MISS')
+            self.assertNotIn('ETag', response)
+            self.assertEqual(
+                async_to_sync(async_views.product_list)(RequestFactory().get('/api/products/'))['X-Cache'], 'MISS'
+            )
+        with override_settings(DATABASE_REPLICAS=[]):
+            self.assertIn('ETag', self.client.get('/api/products/creme/'))
+            self.assertEqual(self.client.get('/api/products/creme/')['X-Cache'], 'HIT')
+
+
+class AsyncCatalogViewTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Soins', slug='soins')
+        cls.products = Product.objects.bulk_create([
+            Product(
+                name=f'Crème {index}', slug=f'creme-{index}', description='Soin', price=Decimal('10.00') + index,
+                category=category, stock=index, is_featured=index % 2 == 0, image='products/creme.jpg',
+            )
+            for index in range(15)
+        ])
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+
+    def call(self, view, url, **kwargs):
+        headers = kwargs.pop('headers', {})
+        return async_to_sync(view)(self.factory.get(url, headers=headers), **kwargs)
+
+    def test_same_response_as_viewset(self):
+        cases = [
+            (async_views.product_list, '/api/products/?ordering=-price&page_size=5', {}),
+            (async_views.product_list, f'/api/products/?category={self.products[0].category_id}&in_stock=1', {}),
+            (async_views.product_featured, '/api/products/featured/', {}),
+            (async_views.product_detail, '/api/products/creme-3/', {'slug': 'creme-3'}),
+            (async_views.product_detail, '/api/products/creme-3/?fields=id,category.name', {'slug': 'creme-3'}),
+            (async_views.category_list, '/api/categories/', {}),
+        ]
+        for view, url, kwargs in cases:
+            with self.subTest(url=url):
+                response = self.call(view, url, **kwargs)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response['X-Cache'], 'MISS')
+                # Même clé de cache que le viewset : la réponse mise en cache lui sert
+                expected = self.client.get(url, headers={'Accept': 'application/json'})
+                self.assertEqual(expected['X-Cache'], 'HIT')
+                self.assertEqual(json.loads(response.content), expected.json())
+                self.assertEqual(response['ETag'], expected['ETag'])
+
+    def test_cursor_pagination(self):
+        first = json.loads(self.call(async_views.product_list, '/api/products/?page_size=10').content)
+        cursor = first['next'].split('cursor=')[1]
+        second = json.loads(self.call(async_views.product_list, f'/api/products/?page_size=10&cursor={cursor}').content)
+        slugs = [product['slug'] for product in first['results'] + second['results']]
+        self.assertEqual(len(set(slugs)), 15)
+        self.assertIsNone(second['next'])
+
+    def test_not_modified(self):
+        response = self.call(async_views.product_list, '/api/products/')
+        response = self.call(async_views.product_list, '/api/products/', headers={'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    @override_settings(CATALOG_ASYNC_VIEWS=True)
+    def test_collection_actions_are_not_caught_by_detail_route(self):
+        self.addCleanup(importlib.reload, product_urls)
+        importlib.reload(product_urls)
+        self.assertIs(resolve('/products/creme-3/', product_urls).func, async_views.product_detail)
+        for url_path, action in (('low_stock', 'low_stock'), ('facets', 'facets')):
+            with self.subTest(action=action):
+                match = resolve(f'/products/{url_path}/', product_urls)
+                self.assertEqual(match.func.actions, {'get': action})
+                self.assertFalse(match.func.initkwargs['detail'])
+
+    def test_errors_fall_back_to_viewset(self):
+        response = self.call(async_views.product_detail, '/api/products/absent/', slug='absent')
+        self.assertEqual(response.status_code, 404)
+        response = self.call(async_views.product_list, '/api/products/?cursor=invalide')
+        self.assertEqual(response.status_code, 404)
+        response = self.call(async_views.product_list, '/api/products/?category=abc')
+        self.assertEqual(response.status_code, 400)
+
+
+class CompiledSerializationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('client', 'client@example.com', 'secret')
+        CatalogFixture(cls.user).grow(20)
+        Product.objects.filter(slug='produit-1').update(
+            discount_price=Decimal('8.50'), thumbnail='products/thumbnails/produit.jpg',
+            renditions={'image': {'source': 'products/produit.jpg', 'variants': [
+                [320, 'webp', 'renditions/produit-320w.webp'], [640, 'webp', 'renditions/produit-640w.webp'],
+            ]}},
+        )
+        Category.objects.create(name='Vide', slug='vide')
+
+    def setUp(self):
+        self.request = Request(RequestFactory().get('/api/'))
+
+    def test_same_data_as_serializers(self):
+        cases = [
+            (ProductListSerializer, Product.objects.for_listing()),
+            (ProductSerializer, Product.objects.for_detail()),
+            (CategorySerializer, Category.objects.with_product_count()),
+            (OrderSerializer, Order.objects.with_items()),
+        ]
+        context = {'request': self.request}
+        for serializer_class, queryset in cases:
+            with self.subTest(serializer=serializer_class.__name__):
+                projection = compile_serializer(serializer_class)
+                expected = serializer_class(queryset.order_by('pk'), many=True, context=context).data
+                self.assertEqual(projection.serialize(projection.values(queryset.order_by('pk')), context), expected)
+
+    def test_selection_normalized_before_cache(self):
+        self.assertIs(
+            compile_serializer(ProductListSerializer, ('name', 'id', 'category', 'category.name')),
+            compile_serializer(ProductListSerializer, ('category', 'id', 'name')),
+        )
+        cached = _compile_serializer.cache_info().currsize
+        with self.assertRaises(ValidationError):
+            compile_serializer(ProductListSerializer, ('id', 'inconnu'))
+        self.assertEqual(_compile_serializer.cache_info().currsize, cached)
+
+    def test_object_permissions_receive_instances(self):
+        checked = []
+
+        class OwnProductsOnly(BasePermission):
+            def has_object_permission(self, request, view, obj):
+                checked.append(obj)
+                return obj.slug != 'produit-2'
+
+        view = ProductViewSet.as_view({'get': 'retrieve'}, permission_classes=[OwnProductsOnly])
+        for slug, allowed in (('produit-1', True), ('produit-2', False)):
+            with self.subTest(slug=slug):
+                cache.clear()
+                response = view(RequestFactory().get(f'/api/products/{slug}/?fields=id,slug'), slug=slug)
+                self.assertEqual(response.status_code == 200, allowed)
+                self.assertIsInstance(checked[-1], Product)
+
+    def test_same_responses_as_serializers(self):
+        order = Order.objects.first()
+        urls = [
+            '/api/products/?ordering=price&page_size=5',
+            '/api/products/featured/',
+            '/api/products/produit-1/',
+            '/api/categories/',
+            '/api/categories/categorie-1/',
+            '/api/categories/categorie-0/products/',
+            '/api/orders/?page_size=5',
+            f'/api/orders/{order.pk}/',
+        ]
+        for url in urls:
+            with self.subTest(url=url):
+                cache.clear()
+                response = self.client.get(url)
+                cache.clear()
+                with override_settings(CATALOG_COMPILED_SERIALIZERS=False):
+                    expected = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.content, expected.content)
+
+    def test_cursor_pages(self):
+        first = self.client.get('/api/products/?ordering=-price&page_size=15').json()
+        second = self.client.get(first['next']).json()
+        slugs = [product['slug'] for product in first['results'] + second['results']]
+        self.assertEqual(len(set(slugs)), 20)
+        self.assertIsNone(second['next'])
+
+    def test_missing_object(self):
+        self.assertEqual(self.client.get('/api/products/absent/').status_code, 404)
+        self.assertEqual(self.client.get('/api/orders/0/').status_code, 404)
+
+
+class ORJSONRendererTests(TestCase):
+
+    def test_same_output_as_json_renderer(self):
+        data = {
+            'price': Decimal('12.50'),
+            'histogram': {1: 0, 5: 3},
+            'created_at': timezone.now(),
+            'text': 'ligne suivante',
+            'lazy': gettext_lazy('Annulé'),
+            'items': [None, True, 1.5],
+        }
+        self.assertEqual(
+            json.loads(ORJSONRenderer().render(data)),
+            json.loads(JSONRenderer().render(data)),
+        )
+        self.assertIn(b'\\u2028', ORJSONRenderer().render(data))
+        self.assertEqual(ORJSONRenderer().render(None), b'')
+
+    def test_indented_output_falls_back_to_drf(self):
+        renderer = ORJSONRenderer()
+        self.assertEqual(
+            renderer.render({'a': 1}, 'application/json; indent=4'),
+            JSONRenderer().render({'a': 1}, 'application/json; indent=4'),
+        )
+
+    def test_parser(self):
+        parsed = ORJSONParser().parse(BytesIO('{"name": "Crème", "quantity": 2}'.encode()))
+        self.assertEqual(parsed, {'name': 'Crème', 'quantity': 2})
+        with self.assertRaises(ParseError):
+            ORJSONParser().parse(BytesIO(b'{"name": '))
+
+    def test_api_uses_fast_json(self):
+        response = APIClient().post('/api/orders/create/', '{"items": ', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIsInstance(response.accepted_renderer, ORJSONRenderer)
+
+
+class SparseFieldsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('client', 'client@example.com', 'secret')
+        cls.catalog = CatalogFixture(cls.user)
+        cls.catalog.grow(20)
+        cls.order = Order.objects.first()
+
+    def setUp(self):
+        cache.clear()
+        self.api = APIClient()
+
+    def get(self, url, compiled=True):
+        cache.clear()
+        with override_settings(CATALOG_COMPILED_SERIALIZERS=compiled):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.api.get(url)
+        self.assertEqual(response.status_code, 200, url)
+        return response, [query['sql'] for query in queries.captured_queries]
+
+    def test_fields_trim_response_and_columns(self):
+        url = '/api/products/?fields=id,name,slug,price,thumbnail,average_rating'
+        for compiled in (True, False):
+            with self.subTest(compiled=compiled):
+                response, queries = self.get(url, compiled)
+                self.assertEqual(
+                    list(response.json()['results'][0]),
+                    ['id', 'name', 'slug', 'price', 'thumbnail', 'average_rating'],
+                )
+                page_query = queries[-1]
+                self.assertNotIn('"description"', page_query)
+                self.assertNotIn('products_category', page_query)
+
+    def test_nested_fields_and_expand(self):
+        response, _ = self.get('/api/products/?fields=id,category.name')
+        self.assertEqual(list(response.json()['results'][0]['category']), ['name'])
+        response, queries = self.get('/api/products/?fields=id&expand=category,additional_images')
+        product = response.json()['results'][0]
+        self.assertEqual(list(product), ['id', 'category', 'additional_images'])
+        self.assertIn('product_count', product['category'])
+        self.assertEqual(len(product['additional_images']), 2)
+        self.assertEqual(len(queries), 4)
+        response, _ = self.get('/api/products/?fields=id,additional_images.alt_text&expand=additional_images')
+        self.assertEqual(list(response.json()['results'][0]['additional_images'][0]), ['alt_text'])
+
+    def test_detail_skips_unrequested_relations(self):
+        _, full = self.get('/api/products/produit-1/')
+        response, trimmed = self.get('/api/products/produit-1/?fields=id,name,category.name')
+        self.assertEqual(set(response.json()), {'id', 'name', 'category'})
+        self.assertLess(len(trimmed), len(full))
+        self.assertFalse(any('productimage' in query for query in trimmed))
+
+    def test_category_count_only_when_requested(self):
+        response, queries = self.get('/api/categories/?fields=id,name')
+        self.assertEqual(list(response.json()['results'][0]), ['id', 'name'])
+        self.assertFalse(any('COUNT("products_product"' in query for query in queries))
+
+    def test_order_items_expand(self):
+        response, queries = self.get(f'/api/orders/{self.order.pk}/?fields=id,items.quantity&expand=items.product')
+        items = response.json()['items']
+        self.assertEqual(list(items[0]), ['product', 'quantity'])
+        self.assertEqual(items[0]['product']['slug'], self.order.items.first().product.slug)
+
+    def test_wishlist_products_fields(self):
+        self.api.force_authenticate(self.user)
+        response, queries = self.get(f'/api/wishlist/{self.catalog.wishlist.pk}/?fields=products.name')
+        self.assertEqual(list(response.json()), ['products'])
+        self.assertEqual(list(response.json()['products'][0]), ['name'])
+        self.assertNotIn('"description"', queries[-1])
+
+    def test_same_output_with_serializers(self):
+        urls = [
+            '/api/products/?fields=id,category.name&expand=additional_images',
+            '/api/products/produit-1/?fields=id,name,category.name,additional_images.alt_text',
+            '/api/products/produit-1/similar/?fields=id,name',
+            '/api/products/produit-1/?fields=id,category,category.name&expand=additional_images',
+            '/api/categories/?fields=id,product_count',
+            f'/api/orders/{self.order.pk}/?expand=items.product',
+        ]
+        for url in urls:
+            with self.subTest(url=url):
+                self.assertEqual(self.get(url, True)[0].content, self.get(url, False)[0].content)
+
+    def test_unknown_names_rejected(self):
+        cases = {
+            '/api/products/?fields=inconnu': {'fields': ['inconnu']},
+            '/api/products/?fields=id,inconnu,price.devise': {'fields': ['inconnu', 'price.devise']},
+            '/api/products/produit-1/?fields=id,category.inconnu': {'fields': ['category.inconnu']},
+            '/api/products/?expand=inconnu': {'expand': ['inconnu']},
+            f'/api/orders/{self.order.pk}/?expand=items.inconnu': {'expand': ['items.inconnu']},
+        }
+        for url, unknown in cases.items():
+            for compiled in (True, False):
+                with self.subTest(url=url, compiled=compiled), override_settings(CATALOG_COMPILED_SERIALIZERS=compiled):
+                    cache.clear()
+                    response = self.api.get(url)
+                    self.assertEqual(response.status_code, 400)
+                    self.assertEqual(response.json(), unknown)
+
+
+@override_settings(REQUEST_TIMING=True)
+class ServerTimingTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('client', 'client@example.com', 'secret')
+        CatalogFixture(cls.user).grow(10)
+
+    def setUp(self):
+        cache.clear()
+
+    def metrics(self, response):
+        return {
+            metric.split(';')[0]: dict(part.split('=', 1) for part in metric.split(';')[1:])
+            for metric in response['Server-Timing'].split(', ')
+        }
+
+    def test_server_timing_header(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/products/')
+        metrics = self.metrics(response)
+        self.assertEqual(set(metrics), {'sql', 'view', 'serialize', 'render', 'total'})
+        self.assertEqual(metrics['sql']['desc'], f'"{len(queries)} queries"')
+        self.assertLessEqual(float(metrics['view']['dur']), float(metrics['total']['dur']))
+
+    def test_asgi_handler(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = async_to_sync(self.async_client.get)('/api/products/')
+        metrics = self.metrics(response)
+        self.assertEqual(metrics['sql']['desc'], f'"{len(queries)} queries"')
+        self.assertIn('serialize', metrics)
+
+    @override_settings(CATALOG_COMPILED_SERIALIZERS=False)
+    def test_serialize_on_serializer_path(self):
+        product = Product.objects.filter(is_active=True).first()
+        urls = [
+            '/api/products/', f'/api/products/{product.slug}/', '/api/categories/',
+            f'/api/categories/{product.category.slug}/', f'/api/products/{product.slug}/similar/',
+            f'/api/products/{product.slug}/reviews/', f'/api/products/{product.slug}/by_slug/',
+        ]
+        for url in urls:
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertIn('serialize', self.metrics(response))
+
+    @override_settings(REQUEST_TIMING=False)
+    def test_disabled(self):
+        response = self.client.get('/api/products/')
+        self.assertNotIn('Server-Timing', response)
+
+    @override_settings(REQUEST_TIMING=False, SLOW_REQUEST_MS=0.001, SLOW_REQUEST_QUERIES=2)
+    def test_slow_request_log(self):
+        with self.assertLogs('products.timing', 'WARNING') as logs:
+            response = self.client.get('/api/products/?page_size=3')
+        self.assertNotIn('Server-Timing', response)
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['event'], 'slow_request')
+        self.assertEqual((record['path'], record['query'], record['status']), ('/api/products/', 'page_size=3', 200))
+        self.assertGreater(record['sql_count'], 0)
+        self.assertEqual(len(record['worst_queries']), 2)
+        self.assertGreaterEqual(record['worst_queries'][0]['ms'], record['worst_queries'][1]['ms'])
+        self.assertIn('SELECT', record['worst_queries'][0]['sql'])
+
+
+class AsgiEntryPointTests(TestCase):
+    SCRIPT = "import core.asgi; from django.conf import settings; print(settings.DATABASES['default']['CONN_MAX_AGE'])"
+
+    def run_asgi(self, **environ):
+        env = {key: value for key, value in os.environ.items() if key not in ('DB_CONN_MAX_AGE', 'DJANGO_SETTINGS_MODULE')}
+        return subprocess.run([sys.executable, '-c', self.SCRIPT], env={**env, **environ}, capture_output=True, text=True)
+
+    def test_persistent_connections_disabled(self):
+        result = self.run_asgi()
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), '0')
+
+    def test_persistent_connections_refused(self):
+        result = self.run_asgi(DB_CONN_MAX_AGE='600')
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn('ImproperlyConfigured', result.stderr)
+
+
+@override_settings(METRICS_ENABLED=True)
+class MetricsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('client', 'client@example.com', 'secret')
+        CatalogFixture(cls.user).grow(10)
+        cls.product = Product.objects.filter(stock__gte=5).first()
+
+    def setUp(self):
+        cache.clear()
+
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def order(self, quantity):
+        payload = {
+            'first_name': 'Jeanne', 'last_name': 'Martin', 'email': 'jeanne@example.com',
+            'address': 'Paris', 'items': [{'product': self.product.pk, 'quantity': quantity}],
+        }
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/api/orders/create/', json.dumps(payload), content_type='application/json')
+
+    def test_request_histograms_by_route(self):
+        labels = {'route': 'product-list', 'method': 'GET', 'status': '200'}
+        requests = self.sample('http_request_duration_seconds_count', **labels)
+        queries = self.sample('http_request_db_queries_sum', route='product-list')
+        with CaptureQueriesContext(connection) as captured:
+            self.client.get('/api/products/')
+        self.assertEqual(self.sample('http_request_duration_seconds_count', **labels), requests + 1)
+        self.assertEqual(self.sample('http_request_db_queries_sum', route='product-list'), queries + len(captured))
+        self.assertGreater(self.sample('db_query_duration_seconds_count', alias='default'), 0)
+
+        # Route sans nom : son motif ; URL inconnue : une seule série
+        self.client.post(f'/api/wishlist/add/{self.product.pk}/')
+        self.client.get('/introuvable/')
+        self.assertTrue(self.sample(
+            'http_request_duration_seconds_count', route='api/wishlist/add/<int:product_id>/', method='POST', status='401'
+        ))
+        self.assertTrue(self.sample('http_request_duration_seconds_count', route='unmatched', method='GET', status='404'))
+
+    def test_cache_counters(self):
+        hits = self.sample('catalog_cache_requests_total', view='ProductViewSet.list', result='hit')
+        self.client.get('/api/products/')
+        self.client.get('/api/products/')
+        self.assertEqual(self.sample('catalog_cache_requests_total', view='ProductViewSet.list', result='hit'), hits + 1)
+
+    def test_business_counters(self):
+        orders, items = self.sample('orders_created_total'), self.sample('order_line_items_total')
+        failures = self.sample('stock_reservation_failures_total')
+        self.assertEqual(self.order(2).status_code, 201)
+        self.assertEqual(self.order(10_000).status_code, 400)
+        self.assertEqual(self.sample('orders_created_total'), orders + 1)
+        self.assertEqual(self.sample('order_line_items_total'), items + 1)
+        self.assertEqual(self.sample('stock_reservation_failures_total'), failures + 1)
+
+        reviews = self.sample('reviews_submitted_total')
+        other = get_user_model().objects.create_user('autre', 'autre@example.com', 'secret')
+        api = APIClient()
+        api.force_authenticate(other)
+        response = api.post(f'/api/products/{self.product.slug}/review/', {'rating': 5, 'comment': 'Parfait'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.sample('reviews_submitted_total'), reviews + 1)
+
+    def test_metrics_endpoint_is_staff_only(self):
+        self.client.get('/api/products/')
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.client.force_login(get_user_model().objects.create_user('staff', is_staff=True))
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn(b'http_request_duration_seconds_bucket{', response.content)
+
+    @override_settings(METRICS_TOKEN='jeton')
+    def test_metrics_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer autre').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer jeton').status_code, 200)
+
+    @override_settings(METRICS_ENABLED=False, METRICS_TOKEN='jeton')
+    def test_disabled(self):
+        labels = {'route': 'product-list', 'method': 'GET', 'status': '200'}
+        requests = self.sample('http_request_duration_seconds_count', **labels)
+        response = self.client.get('/api/products/')
+        self.assertEqual(self.sample('http_request_duration_seconds_count', **labels), requests)
+        self.assertFalse(response.has_header('Server-Timing'))
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer jeton').status_code, 404)
+
+    def test_aggregates_worker_processes(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        env = {**os.environ, 'PROMETHEUS_MULTIPROC_DIR': directory}
+        script = 'import os; from products import metrics; metrics.worker_started(); metrics.record_order(3); print(os.getpid())'
+        pids = [
+            int(subprocess.run([sys.executable, '-c', script], env=env, check=True, capture_output=True, text=True).stdout)
+            for _ in range(2)
+        ]
+        with mock.patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_DIR': directory}):
+            metrics.worker_exited(pids[0])
+            exposition = metrics.render().decode()
+        self.assertIn('orders_created_total 2.0', exposition)
+        self.assertIn('order_line_items_total 6.0', exposition)
+        self.assertIn('gunicorn_workers 1.0', exposition)
+
+
+class FacetTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('client', 'client@example.com', 'secret')
+        CatalogFixture(cls.user).grow(100)
+        Product.objects.filter(slug='produit-7').update(is_active=False)
+
+    def setUp(self):
+        cache.clear()
+
+    def expected(self, queryset):
+        bounds = [None, *ProductViewSet.price_facet_bounds, None]
+        return {
+            'count': queryset.count(),
+            'category': [
+                {'id': category.pk, 'name': category.name, 'slug': category.slug, 'count': count}
+                for category in Category.objects.order_by('name')
+                for count in [queryset.filter(category=category).count()] if count
+            ],
+            'price': [
+                {
+                    'min_price': low and str(low), 'max_price': high and str(high),
+                    'count': queryset.filter(
+                        **({'price__gte': low} if low else {}), **({'price__lt': high} if high else {})
+                    ).count(),
+                }
+                for low, high in zip(bounds, bounds[1:])
+            ],
+            'in_stock': {'true': queryset.filter(stock__gt=0).count(), 'false': queryset.filter(stock=0).count()},
+            'is_featured': {'true': queryset.filter(is_featured=True).count(), 'false': queryset.filter(is_featured=False).count()},
+        }
+
+    def test_counts_follow_filters(self):
+        category = Category.objects.get(slug='categorie-3')
+        products = Product.objects.filter(is_active=True)
+        cases = [
+            ('/api/products/facets/', products),
+            (f'/api/products/facets/?category={category.pk}&in_stock=1', products.filter(category=category, stock__gt=0)),
+            ('/api/products/facets/?min_price=30&max_price=50&ordering=-price', products.filter(price__gte=30, price__lte=50)),
+            ('/api/products/facets/?search=Produit 4', products.filter(name__icontains='Produit 4')),
+        ]
+        for url, queryset in cases:
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).json(), self.expected(queryset))
+
+    def test_single_aggregate_query_and_cache(self):
+        # Une requête pour Last-Modified (réponse conditionnelle), une pour les effectifs
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/products/facets/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        response = self.client.get('/api/products/facets/')
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(self.client.get('/api/products/facets/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        # Même invalidation que le catalogue
+        product = Product.objects.get(slug='produit-1')
+        product.is_featured = not product.is_featured
+        product.save()
+        response = self.client.get('/api/products/facets/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.json(), self.expected(Product.objects.filter(is_active=True)))
+
+
+class CatalogRepresentationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        users = [get_user_model().objects.create_user(f'client{index}') for index in range(3)]
+        cls.user = users[0]
+        cls.category = Category.objects.create(name='Soins', slug='soins')
+        other = Category.objects.create(name='Parfums', slug='parfums')
+        cls.rated = Product.objects.create(
+            name='Crème', slug='creme', description='Soin', price=Decimal('10.00'), category=cls.category,
+            image='products/creme.jpg',
+        )
+        cls.unrated = Product.objects.create(
+            name='Sérum', slug='serum', description='Soin', price=Decimal('20.00'), category=cls.category,
+            image='products/serum.jpg',
+        )
+        Product.objects.create(
+            name='Baume', slug='baume', description='Soin', price=Decimal('5.00'), category=cls.category,
+            image='products/baume.jpg', is_active=False,
+        )
+        Product.objects.create(
+            name='Eau', slug='eau', description='Parfum', price=Decimal('30.00'), category=other,
+            image='products/eau.jpg',
+        )
+        for user, rating in zip(users, (5, 4, 2)):
+            Review.objects.create(product=cls.rated, user=user, rating=rating, comment='Avis')
+
+    def setUp(self):
+        cache.clear()
+
+    def test_ratings_and_category_count(self):
+        detail = self.client.get('/api/products/creme/').json()
+        self.assertAlmostEqual(detail['average_rating'], 11 / 3)
+        self.assertEqual(detail['review_count'], 3)
+        self.assertEqual(detail['category']['product_count'], 3)
+
+        listed = {product['slug']: product for product in self.client.get('/api/products/').json()['results']}
+        self.assertEqual(set(listed), {'creme', 'serum', 'eau'})
+        self.assertAlmostEqual(listed['creme']['average_rating'], 11 / 3)
+        self.assertEqual((listed['serum']['average_rating'], listed['serum']['review_count']), (None, 0))
+
+    def test_category_products(self):
+        response = self.client.get('/api/categories/soins/products/')
+        self.assertEqual({product['slug'] for product in response.json()['results']}, {'creme', 'serum'})
+        categories = {category['slug']: category for category in self.client.get('/api/categories/').json()['results']}
+        self.assertEqual((categories['soins']['product_count'], categories['parfums']['product_count']), (3, 1))
+
+    def test_wishlist_products(self):
+        api = APIClient()
+        api.force_authenticate(self.user)
+        api.post(f'/api/wishlist/add/{self.rated.pk}/')
+        products = api.get('/api/wishlist/').json()['results'][0]['products']
+        self.assertEqual([(product['slug'], product['review_count']) for product in products], [('creme', 3)])
+
+
+class RatingAggregateTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [get_user_model().objects.create_user(f'client{index}') for index in range(3)]
+        category = Category.objects.create(name='Soins', slug='soins')
+        cls.product = Product.objects.create(
+            name='Crème', slug='creme', description='Soin', price=Decimal('10.00'), category=category,
+            image='products/creme.jpg',
+        )
+        cls.other = Product.objects.create(
+            name='Sérum', slug='serum', description='Soin', price=Decimal('20.00'), category=category,
+            image='products/serum.jpg',
+        )
+
+    def aggregates(self, product):
+        product.refresh_from_db()
+        return product.rating_sum, product.rating_count, product.rating_histogram
+
+    def review(self, user, rating, product=None):
+        return Review.objects.create(product=product or self.product, user=user, rating=rating, comment='Avis')
+
+    def test_create_edit_delete(self):
+        first = self.review(self.users[0], 5)
+        self.review(self.users[1], 3)
+        self.assertEqual(self.aggregates(self.product), (8, 2, {1: 0, 2: 0, 3: 1, 4: 0, 5: 1}))
+        self.assertEqual(self.product.average_rating, 4)
+
+        first.rating = 1
+        first.save()
+        self.assertEqual(self.aggregates(self.product), (4, 2, {1: 1, 2: 0, 3: 1, 4: 0, 5: 0}))
+
+        # Avis déplacé sur un autre produit : retiré de l'un, ajouté à l'autre
+        first.product = self.other
+        first.save()
+        self.assertEqual(self.aggregates(self.product)[:2], (3, 1))
+        self.assertEqual(self.aggregates(self.other)[:2], (1, 1))
+
+        Review.objects.get(pk=first.pk).delete()
+        self.assertEqual(self.aggregates(self.other), (0, 0, {1: 0, 2: 0, 3: 0, 4: 0, 5: 0}))
+        self.assertIsNone(self.other.average_rating)
+
+    def test_deferred_rating_is_loaded_before_delete_or_save(self):
+        first = self.review(self.users[0], 5)
+        self.review(self.users[1], 3)
+        self.review(self.users[2], 4)
+
+        Review.objects.only('id').get(pk=first.pk).delete()
+        self.assertEqual(self.aggregates(self.product), (7, 2, {1: 0, 2: 0, 3: 1, 4: 1, 5: 0}))
+
+        deferred = Review.objects.defer('rating').get(rating=3)
+        deferred.comment = 'Modifié'
+        deferred.save()
+        self.assertEqual(self.aggregates(self.product)[:2], (7, 2))
+
+        deferred = Review.objects.only('id', 'comment').get(rating=4)
+        deferred.rating = 2
+        deferred.save()
+        self.assertEqual(self.aggregates(self.product), (5, 2, {1: 0, 2: 1, 3: 1, 4: 0, 5: 0}))
+
+        Review.objects.filter(product=self.product).only('id').delete()
+        self.assertEqual(self.aggregates(self.product)[:2], (0, 0))
+
+    def test_migration_backfills_existing_reviews(self):
+        self.review(self.users[0], 4)
+        self.review(self.users[1], 4)
+        self.review(self.users[2], 1, product=self.other)
+        Product.objects.update(rating_sum=0, rating_count=0, rating_1_count=0, rating_4_count=0)
+
+        migration = importlib.import_module('products.migrations.0015_backfill_rating_aggregates')
+        migration.backfill_rating_aggregates(django_apps, mock.Mock(connection=connection))
+        self.assertEqual(self.aggregates(self.product), (8, 2, {1: 0, 2: 0, 3: 0, 4: 2, 5: 0}))
+        self.assertEqual(self.aggregates(self.other), (1, 1, {1: 1, 2: 0, 3: 0, 4: 0, 5: 0}))
+
+    def test_rebuild_ratings(self):
+        self.review(self.users[0], 4)
+        self.review(self.users[1], 2)
+        self.review(self.users[2], 5, product=self.other)
+        # Écarts laissés par des écritures qui contournent les signaux
+        Product.objects.update(rating_sum=0, rating_count=7, rating_5_count=3)
+        Review.objects.filter(product=self.other).update(rating=1)
+
+        out = StringIO()
+        call_command('rebuild_ratings', batch_size=1, stdout=out)
+        self.assertIn('2 produits mis à jour', out.getvalue())
+        self.assertEqual(self.aggregates(self.product), (6, 2, {1: 0, 2: 1, 3: 0, 4: 1, 5: 0}))
+        self.assertEqual(self.aggregates(self.other), (1, 1, {1: 1, 2: 0, 3: 0, 4: 0, 5: 0}))
+
+    def test_rating_range_constraint(self):
+        for rating in (0, 6):
+            with self.subTest(rating=rating), self.assertRaises(IntegrityError), transaction.atomic():
+                Review.objects.create(product=self.product, rating=rating, comment='Hors bornes')
+
+
+class ProductRepresentationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Soins', slug='soins')
+        cls.product = Product.objects.create(
+            name='Crème', slug='creme', description='Soin', price=Decimal('10.00'), category=category,
+            image='products/creme.jpg', is_featured=True,
+        )
+        ProductImage.objects.create(product=cls.product, image='products/additional/creme.jpg', alt_text='Crème')
+        users = [get_user_model().objects.create_user(f'client{index}') for index in range(12)]
+        for index, user in enumerate(users):
+            review = Review.objects.create(product=cls.product, user=user, rating=1 + index % 5, comment=f'Avis {index}')
+            Review.objects.filter(pk=review.pk).update(created_at=timezone.now() - timedelta(days=index))
+
+    def setUp(self):
+        cache.clear()
+
+    def test_collections_use_list_representation(self):
+        list_fields = set(ProductListSerializer.Meta.fields)
+        for url in ('/api/products/', '/api/products/featured/', '/api/categories/soins/products/'):
+            with self.subTest(url=url):
+                self.assertEqual(set(self.client.get(url).json()['results'][0]), list_fields)
+
+        detail = self.client.get('/api/products/creme/').json()
+        self.assertEqual(set(detail), set(ProductSerializer.Meta.fields))
+        self.assertEqual(len(detail['additional_images']), 1)
+        self.assertNotIn('reviews', detail)
+
+    def test_reviews_are_paginated_newest_first(self):
+        first = self.client.get('/api/products/creme/reviews/').json()
+        self.assertEqual([review['comment'] for review in first['results']], [f'Avis {index}' for index in range(10)])
+        second = self.client.get(first['next']).json()
+        self.assertEqual([review['comment'] for review in second['results']], ['Avis 10', 'Avis 11'])
+        self.assertIsNone(second['next'])
+        self.assertEqual(self.client.get('/api/products/absent/reviews/').status_code, 404)
+
+
+class KeysetPaginationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Soins', slug='soins')
+        other = Category.objects.create(name='Parfums', slug='parfums')
+        # Prix et noms répétés : les égalités sont départagées par l'id
+        Product.objects.bulk_create([
+            Product(
+                name=f'Produit {index % 4}', slug=f'produit-{index}', description='Soin', price=Decimal(index % 5) + 10,
+                category=category if index % 3 else other, stock=index % 7, image='products/produit.jpg',
+            )
+            for index in range(23)
+        ])
+        get_search_backend().index_products(Product.objects.all())
+        Order.objects.bulk_create([
+            Order(first_name='Jeanne', last_name='Martin', email='jeanne@example.com', address='Paris')
+            for _ in range(12)
+        ])
+
+    def setUp(self):
+        cache.clear()
+
+    def walk(self, url):
+        """ Identifiants de toutes les pages en suivant ``next``, puis en revenant par ``previous`` """
+        pages, page = [], self.client.get(url).json()
+        while True:
+            pages.append([item['id'] for item in page['results']])
+            if page['next'] is None:
+                break
+            page = self.client.get(page['next']).json()
+        backwards = [pages[-1]]
+        while page['previous'] is not None:
+            page = self.client.get(page['previous']).json()
+            backwards.insert(0, [item['id'] for item in page['results']])
+        self.assertEqual(backwards, pages)
+        return [pk for page in pages for pk in page]
+
+    def test_every_ordering_matches_queryset(self):
+        products = Product.objects.filter(is_active=True)
+        for ordering in ('-created_at', 'price', '-price', 'name', 'stock', '-stock'):
+            with self.subTest(ordering=ordering):
+                expected = list(products.order_by(ordering, ordering.replace(ordering.lstrip('-'), 'pk')).values_list('pk', flat=True))
+                self.assertEqual(self.walk(f'/api/products/?ordering={ordering}&page_size=4'), expected)
+
+    def test_filters_and_counts(self):
+        category = Category.objects.get(slug='parfums')
+        expected = Product.objects.filter(category=category, stock__gt=0).order_by('price', 'pk')
+        url = f'/api/products/?ordering=price&page_size=3&category={category.pk}&in_stock=1'
+        self.assertEqual(self.walk(url), list(expected.values_list('pk', flat=True)))
+
+        page = self.client.get('/api/products/?page_size=5').json()
+        self.assertNotIn('count', page)
+        self.assertEqual(self.client.get('/api/products/?count=exact').json()['count'], 23)
+        # Estimation du planificateur sous PostgreSQL, comptage exact ailleurs
+        self.assertGreater(self.client.get('/api/products/?count=approx').json()['count'], 0)
+
+    def test_orders(self):
+        expected = list(Order.objects.order_by('-created_at', '-pk').values_list('pk', flat=True))
+        self.assertEqual(self.walk('/api/orders/?page_size=5'), expected)
+
+    def test_cursor_of_other_ordering_is_rejected(self):
+        cursor = self.client.get('/api/products/?ordering=price&page_size=2').json()['next'].split('cursor=')[1].split('&')[0]
+        self.assertEqual(self.client.get(f'/api/products/?ordering=name&cursor={cursor}').status_code, 404)
+
+    def test_tampered_cursor_is_rejected(self):
+        def encode(data):
+            return base64.b64encode(json.dumps(data).encode()).decode()
+
+        cursors = [
+            {'f': 'price', 'v': 'abc', 'i': 1},
+            {'f': 'price', 'v': None, 'i': 1},
+            {'f': 'created_at', 'v': ['2024-01-01'], 'i': 1},
+            {'f': 'created_at', 'v': 'hier', 'i': 1},
+            {'f': 'stock', 'v': {'a': 1}, 'i': 1},
+            {'f': 'price', 'v': '10', 'i': 'abc'},
+            ['price', '10', 1],
+        ]
+        for cursor in cursors:
+            ordering = cursor['f'] if isinstance(cursor, dict) else 'price'
+            with self.subTest(cursor=cursor):
+                response = self.client.get(f'/api/products/?ordering={ordering}&cursor={encode(cursor)}')
+                self.assertEqual(response.status_code, 404)
+        response = self.client.get(f'/api/products/?ordering=price&cursor={encode({"f": "price", "v": "11", "i": 1})}')
+        self.assertEqual(response.status_code, 200)
+
+    def test_search_rank_cursor(self):
+        first = self.client.get('/api/products/?search=produit&page_size=5').json()
+        second = self.client.get(first['next']).json()
+        self.assertEqual(len(second['results']), 5)
+        self.assertFalse({item['id'] for item in first['results']} & {item['id'] for item in second['results']})
+
+
+class SearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Soins', slug='soins')
+        other = Category.objects.create(name='Parfums', slug='parfums')
+        products = [
+            ('Crème hydratante', 'Soin du visage', "huile d'argan", category),
+            ('Sérum éclat', 'Texture crémeuse et hydratation intense', 'acide hyaluronique', category),
+            ('Baume pour les mains', 'Nourrit les peaux sèches', 'beurre de karité', category),
+            ('Eau florale', 'Brume parfumée', 'eau de rose, crème de coco', other),
+        ]
+        cls.products = {
+            name: Product.objects.create(
+                name=name, slug=slugify(name), description=description, ingredients=ingredients,
+                price=Decimal('10.00'), category=category, image='products/produit.jpg',
+            )
+            for name, description, ingredients, category in products
+        }
+
+    def setUp(self):
+        cache.clear()
+
+    def search(self, terms, **params):
+        query = urlencode({'search': terms, **params})
+        return [product['name'] for product in self.client.get(f'/api/products/?{query}').json()['results']]
+
+    def test_ranking_by_field_weight(self):
+        # Le nom pèse plus que les ingrédients, qui pèsent plus que la description
+        self.assertEqual(self.search('crème'), ['Crème hydratante', 'Eau florale', 'Sérum éclat'])
+
+    def test_french_stemming_and_accents(self):
+        # « hydratantes », « hydratante » et « hydratation » ont la même racine
+        self.assertEqual(self.search('hydratantes'), ['Crème hydratante', 'Sérum éclat'])
+        self.assertEqual(self.search('ECLAT'), ['Sérum éclat'])
+        self.assertEqual(self.search('seche'), ['Baume pour les mains'])
+        self.assertEqual(self.search('karite'), ['Baume pour les mains'])
+        self.assertEqual(self.search('introuvable'), [])
+
+    def test_admin_search_covers_description_and_ingredients(self):
+        staff = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.force_login(staff)
+        url = reverse('admin:products_product_changelist')
+        for terms, expected in (('karite', ['Baume pour les mains']), ('brume', ['Eau florale']), ('sérum', ['Sérum éclat'])):
+            with self.subTest(terms=terms):
+                response = self.client.get(url, {'q': terms})
+                self.assertEqual([product.name for product in response.context['cl'].result_list], expected)
+
+    def test_combined_with_filters(self):
+        category = Category.objects.get(slug='soins')
+        self.assertEqual(self.search('creme', category=category.pk), ['Crème hydratante', 'Sérum éclat'])
+
+    def test_index_follows_writes(self):
+        product = self.products['Baume pour les mains']
+        product.name = 'Baume réparateur'
+        product.save()
+        self.assertEqual(self.search('reparateur'), ['Baume réparateur'])
+        self.assertEqual(self.search('mains'), [])
+        product.delete()
+        self.assertEqual(self.search('baume'), [])
+
+
+class SimilarityTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        soins = Category.objects.create(name='Soins', slug='soins')
+        parfums = Category.objects.create(name='Parfums', slug='parfums')
+        products = [
+            ('Crème argan', 'Soin nourrissant', "huile d'argan, beurre de karité", soins),
+            ('Baume argan', 'Baume pour les mains', "huile d'argan, beurre de karité", soins),
+            ('Gel aloe', 'Gel frais', 'aloe vera, concombre', soins),
+            ('Eau de rose', 'Brume parfumée', 'eau de rose, alcool', parfums),
+            ('Parfum ambre', 'Eau de parfum', 'ambre, alcool', parfums),
+        ]
+        with override_settings(PRODUCT_SIMILARITY_AUTO_REFRESH=False):
+            cls.products = {
+                name: Product.objects.create(
+                    name=name, slug=slugify(name), description=description, ingredients=ingredients,
+                    price=Decimal('10.00'), category=category, image='products/produit.jpg',
+                )
+                for name, description, ingredients, category in products
+            }
+
+    def setUp(self):
+        cache.clear()
+
+    def run_refreshes(self):
+        worker = Worker()
+        refreshes = Task.objects.filter(name=tasks.refresh_product_similarity.name)
+        refreshes.filter(status='pending').update(status='running', worker=worker.name)
+        for queued in refreshes.filter(status='running', worker=worker.name):
+            worker.execute(queued)
+
+    def similar(self, name):
+        response = self.client.get(f'/api/products/{slugify(name)}/similar/')
+        self.assertEqual(response.status_code, 200)
+        return [product['name'] for product in response.json()]
+
+    def test_falls_back_to_category_without_index(self):
+        self.assertEqual(set(self.similar('Crème argan')), {'Baume argan', 'Gel aloe'})
+
+    def test_rebuild_ranks_shared_ingredients_first(self):
+        out = StringIO()
+        call_command('rebuild_similarity', stdout=out)
+        self.assertIn('5 produits indexés', out.getvalue())
+        self.assertEqual(self.similar('Crème argan')[0], 'Baume argan')
+        self.assertEqual(self.similar('Eau de rose')[0], 'Parfum ambre')
+        scores = list(
+            ProductSimilarity.objects.filter(product=self.products['Crème argan'])
+            .order_by('-score').values_list('score', flat=True)
+        )
+        self.assertTrue(all(0 < score <= 1 for score in scores))
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+    def test_index_follows_writes(self):
+        call_command('rebuild_similarity', stdout=StringIO())
+        with self.captureOnCommitCallbacks(execute=True):
+            twin = Product.objects.create(
+                name='Crème argan intense', slug='creme-argan-intense', description='Soin nourrissant',
+                ingredients="huile d'argan, beurre de karité", price=Decimal('12.00'),
+                category=self.products['Crème argan'].category, image='products/produit.jpg',
+            )
+        self.run_refreshes()
+        self.assertEqual(self.similar('Crème argan')[0], 'Crème argan intense')
+        self.assertEqual(self.similar('Crème argan intense')[0], 'Crème argan')
+
+        twin.is_active = False
+        with self.captureOnCommitCallbacks(execute=True):
+            twin.save()
+        self.run_refreshes()
+        self.assertNotIn('Crème argan intense', self.similar('Crème argan'))
+        self.assertFalse(ProductSimilarity.objects.filter(product=twin).exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products['Baume argan'].delete()
+        self.run_refreshes()
+        self.assertNotIn('Baume argan', self.similar('Crème argan'))
+        self.assertTrue(self.similar('Crème argan'))
+
+    def test_refresh_scores_only_the_changed_product(self):
+        call_command('rebuild_similarity', stdout=StringIO())
+        product = self.products['Gel aloe']
+        product.ingredients = "huile d'argan, beurre de karité"
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+            product.save(update_fields=['ingredients'])
+        with self.captureOnCommitCallbacks(execute=True):
+            product.name = 'Gel argan'
+            product.save()
+        # Les modifications successives ne laissent qu'une tâche en attente
+        self.assertEqual(Task.objects.filter(name=tasks.refresh_product_similarity.name).count(), 1)
+        with CaptureQueriesContext(connection) as queries:
+            self.run_refreshes()
+        self.assertLess(len(queries), 25)
+        self.assertIn('Gel argan', self.similar('Crème argan')[:2])
+        self.assertIn(self.similar('Gel aloe')[0], ('Crème argan', 'Baume argan'))
+
+    def test_rebuild_matches_incremental_refresh(self):
+        call_command('rebuild_similarity', stdout=StringIO())
+        rebuilt = set(ProductSimilarity.objects.values_list('product', 'neighbour'))
+        for product in self.products.values():
+            with self.captureOnCommitCallbacks(execute=True):
+                product.description += ' '
+                product.save()
+            self.run_refreshes()
+        self.assertEqual(set(ProductSimilarity.objects.values_list('product', 'neighbour')), rebuilt)
+
+
+class CatalogCacheTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Soins', slug='soins')
+        cls.product = Product.objects.create(
+            name='Crème', slug='creme', description='Soin', price=Decimal('10.00'),
+            category=cls.category, stock=5, image='products/creme.jpg', is_featured=True,
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def assertServedFromCache(self, url):
+        self.assertEqual(self.get(url)['X-Cache'], 'MISS')
+        response = self.get(url)
+        self.assertEqual(response['X-Cache'], 'HIT')
+        return response.json()
+
+    def test_each_catalog_read_is_cached(self):
+        for url in (
+            '/api/products/', '/api/products/creme/', '/api/products/featured/',
+            '/api/products/creme/similar/', '/api/categories/', '/api/categories/soins/',
+            '/api/categories/soins/products/',
+        ):
+            with self.subTest(url=url):
+                self.assertServedFromCache(url)
+                # Seule la date de Last-Modified est relue (réponse conditionnelle)
+                with self.assertNumQueries(0 if url.endswith('/similar/') else 1):
+                    self.get(url)
+
+    def test_query_parameters_are_normalized(self):
+        self.assertEqual(self.get('/api/products/?is_featured=true&ordering=price')['X-Cache'], 'MISS')
+        self.assertEqual(self.get('/api/products/?ordering=price&is_featured=true')['X-Cache'], 'HIT')
+        self.assertEqual(self.get('/api/products/?ordering=-price&is_featured=true')['X-Cache'], 'MISS')
+
+    def test_product_write_invalidates_product_and_category_reads(self):
+        self.assertServedFromCache('/api/products/creme/')
+        self.assertServedFromCache('/api/categories/soins/products/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.price = Decimal('12.00')
+            self.product.save()
+        response = self.get('/api/products/creme/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.json()['price'], '12.00')
+        response = self.get('/api/categories/soins/products/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.json()['results'][0]['price'], '12.00')
+
+    def test_delete_invalidates_lists(self):
+        self.assertEqual(self.assertServedFromCache('/api/categories/soins/')['product_count'], 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.delete()
+        self.assertEqual(self.get('/api/categories/soins/').json()['product_count'], 0)
+        self.assertEqual(self.get('/api/products/').json()['results'], [])
+
+    def test_related_writes_invalidate_product_reads(self):
+        writes = [
+            (lambda: Review.objects.create(product=self.product, rating=4, comment='Bien'),
+             lambda data: data['review_count'] == 1),
+            (lambda: ProductImage.objects.create(product=self.product, image='products/additional/a.jpg', alt_text='A'),
+             lambda data: len(data['additional_images']) == 1),
+            (lambda: Category.objects.filter(pk=self.category.pk).first().save(),
+             lambda data: True),
+        ]
+        self.get('/api/products/creme/')
+        for write, check in writes:
+            self.assertEqual(self.get('/api/products/creme/')['X-Cache'], 'HIT')
+            with self.captureOnCommitCallbacks(execute=True):
+                write()
+            response = self.get('/api/products/creme/')
+            self.assertEqual(response['X-Cache'], 'MISS')
+            self.assertTrue(check(response.json()))
+
+    def test_order_stock_reservation_invalidates_product_reads(self):
+        self.assertEqual(self.assertServedFromCache('/api/products/creme/')['stock'], 5)
+        payload = {
+            'first_name': 'Jeanne', 'last_name': 'Martin', 'email': 'jeanne@example.com',
+            'address': 'Paris', 'items': [{'product': self.product.pk, 'quantity': 2}],
+        }
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/orders/create/', json.dumps(payload), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.get('/api/products/creme/').json()['stock'], 3)
+
+    def test_hit_and_miss_stats(self):
+        self.assertServedFromCache('/api/products/')
+        self.get('/api/products/')
+        out = StringIO()
+        call_command('catalog_cache_stats', 'ProductViewSet.list', stdout=out)
+        stats = json.loads(out.getvalue())
+        self.assertEqual(stats['ProductViewSet.list'], {'hits': 2, 'misses': 1, 'hit_rate': 2 / 3})
+
+    @override_settings(CATALOG_CACHE_ENABLED=False)
+    def test_disabled(self):
+        self.assertFalse(self.get('/api/products/').has_header('X-Cache'))
+
+
+class ConditionalResponseTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Soins', slug='soins')
+        cls.product = Product.objects.create(
+            name='Crème', slug='creme', description='Soin', price=Decimal('10.00'),
+            category=cls.category, stock=5, image='products/creme.jpg', is_featured=True,
+        )
+        Product.objects.create(
+            name='Baume', slug='baume', description='Soin', price=Decimal('8.00'),
+            category=cls.category, stock=5, image='products/baume.jpg',
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    urls = (
+        '/api/products/', '/api/products/creme/', '/api/products/featured/',
+        '/api/categories/', '/api/categories/soins/', '/api/categories/soins/products/',
+    )
+
+    def test_validators_and_not_modified(self):
+        for url in self.urls:
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response.has_header('ETag'))
+                self.assertTrue(response.has_header('Last-Modified'))
+                # Validateurs relus sans sérialiser la réponse : une seule requête
+                with self.assertNumQueries(1):
+                    not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+                self.assertEqual(not_modified.status_code, 304)
+                self.assertEqual(not_modified.content, b'')
+                not_modified = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+                self.assertEqual(not_modified.status_code, 304)
+
+    def test_head_is_conditional(self):
+        response = self.client.get('/api/products/creme/')
+        self.assertEqual(self.client.head('/api/products/creme/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_query_parameters_change_the_etag(self):
+        etags = {self.client.get(url)['ETag'] for url in (
+            '/api/products/', '/api/products/?ordering=price', '/api/products/?is_featured=true',
+        )}
+        self.assertEqual(len(etags), 3)
+
+    def test_writes_change_the_validators(self):
+        response = self.client.get('/api/products/creme/')
+        with self.captureOnCommitCallbacks(execute=True):
+            Review.objects.create(product=self.product, rating=5, comment='Parfait')
+        updated = self.client.get('/api/products/creme/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(updated.status_code, 200)
+        self.assertNotEqual(updated['ETag'], response['ETag'])
+
+        # Une catégorie modifiée change la fiche de ses produits
+        response = self.client.get('/api/products/creme/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category.save()
+        self.assertEqual(self.client.get('/api/products/creme/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_deletion_changes_the_list_etag(self):
+        # La date la plus récente peut rester la même : la génération du cache change
+        response = self.client.get('/api/categories/soins/products/')
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.get(slug='baume').delete()
+        updated = self.client.get('/api/categories/soins/products/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(updated.status_code, 200)
+        self.assertEqual([product['slug'] for product in updated.json()['results']], ['creme'])
+
+    def test_last_modified_never_moves_backwards(self):
+        # Le produit le plus récemment modifié date la liste, puis disparaît de celle-ci
+        Product.objects.filter(slug='creme').update(updated_at=timezone.now() + timedelta(minutes=1))
+        url = '/api/categories/soins/products/'
+        response = self.client.get(url)
+
+        def deactivate():
+            product = Product.objects.get(slug='creme')
+            product.is_active = False
+            product.save()
+
+        later = time.time() + 120
+        for write in (deactivate, lambda: Product.objects.get(slug='baume').delete()):
+            with self.subTest(write=write), mock.patch('products.cache.time.time', return_value=later):
+                with self.captureOnCommitCallbacks(execute=True):
+                    write()
+                updated = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+                self.assertEqual(updated.status_code, 200)
+                self.assertGreater(
+                    parse_http_date(updated['Last-Modified']), parse_http_date(response['Last-Modified'])
+                )
+            response = updated
+            later += 120
+
+    def test_unknown_object_is_not_found(self):
+        self.assertEqual(self.client.get('/api/products/inconnu/', HTTP_IF_NONE_MATCH='"x"').status_code, 404)
+
+
+class OrderCreationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Soins', slug='soins')
+        cls.creme = Product.objects.create(
+            name='Crème', slug='creme', description='Soin', price=Decimal('10.00'),
+            category=category, stock=5, image='products/creme.jpg',
+        )
+        cls.baume = Product.objects.create(
+            name='Baume', slug='baume', description='Soin', price=Decimal('8.50'),
+            category=category, stock=1, image='products/baume.jpg',
+        )
+
+    def create(self, items, key=None, **customer):
+        payload = {
+            'first_name': 'Jeanne', 'last_name': 'Martin', 'email': 'jeanne@example.com',
+            'address': 'Paris', 'items': items, **customer,
+        }
+        headers = {'HTTP_IDEMPOTENCY_KEY': key} if key else {}
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(
+                '/api/orders/create/', json.dumps(payload), content_type='application/json', **headers
+            )
+
+    def stock(self):
+        return dict(Product.objects.values_list('slug', 'stock'))
+
+    def test_reserves_stock_and_totals_lines(self):
+        response = self.create([
+            {'product': self.creme.pk, 'quantity': 2},
+            {'product': self.baume.pk},
+            {'product': self.creme.pk, 'quantity': 1},
+        ])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['total_price'], '38.50')
+        self.assertEqual(self.stock(), {'creme': 2, 'baume': 0})
+        order = Order.objects.get()
+        self.assertEqual(order.total_price, Decimal('38.50'))
+        self.assertEqual(order.items.count(), 3)
+
+    def test_insufficient_stock_rolls_back_every_line(self):
+        response = self.create([
+            {'product': self.creme.pk, 'quantity': 2},
+            {'product': self.baume.pk, 'quantity': 2},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Baume', str(response.json()))
+        self.assertEqual(self.stock(), {'creme': 5, 'baume': 1})
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(OrderItem.objects.exists())
+
+    def test_unknown_or_inactive_product_creates_nothing(self):
+        Product.objects.filter(pk=self.baume.pk).update(is_active=False)
+        for missing in (self.baume.pk, 999999):
+            with self.subTest(product=missing):
+                response = self.create([{'product': self.creme.pk}, {'product': missing}])
+                self.assertEqual(response.status_code, 400)
+                self.assertIn(str(missing), str(response.json()))
+        self.assertEqual(self.stock()['creme'], 5)
+        self.assertFalse(Order.objects.exists())
+
+    def test_idempotency_key_replays_the_first_order(self):
+        items = [{'product': self.creme.pk, 'quantity': 2}]
+        first = self.create(items, key='commande-1')
+        self.assertEqual(first.status_code, 201)
+        self.assertFalse(first.has_header('Idempotent-Replayed'))
+
+        replay = self.create(items, key='commande-1')
+        self.assertEqual(replay.status_code, 201)
+        self.assertEqual(replay['Idempotent-Replayed'], 'true')
+        self.assertEqual(replay.json()['id'], first.json()['id'])
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(self.stock()['creme'], 3)
+        self.assertEqual(Task.objects.filter(name=tasks.send_order_confirmation.name).count(), 1)
+
+        # Une autre clé crée bien une autre commande
+        self.assertNotEqual(self.create(items, key='commande-2').json()['id'], first.json()['id'])
+        self.assertEqual(self.stock()['creme'], 1)
+
+    def test_idempotency_key_reused_with_another_payload_is_rejected(self):
+        self.create([{'product': self.creme.pk}], key='commande-1')
+        response = self.create([{'product': self.creme.pk, 'quantity': 3}], key='commande-1')
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(self.stock()['creme'], 4)
+
+    def test_failed_order_does_not_consume_the_key(self):
+        self.assertEqual(self.create([{'product': self.baume.pk, 'quantity': 5}], key='commande-1').status_code, 400)
+        response = self.create([{'product': self.baume.pk}], key='commande-1')
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(response.has_header('Idempotent-Replayed'))
+
+    def test_idempotency_key_too_long(self):
+        response = self.create([{'product': self.creme.pk}], key='x' * 300)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Order.objects.exists())
@@ -0,0 +1,213 @@
+"""
+Mesures par requête : nombre et durée des requêtes SQL, temps de la vue, de la
+sérialisation et du rendu.
+
+Avec REQUEST_TIMING, ServerTimingMiddleware les renvoie dans l'en-tête
+Server-Timing (visible dans l'onglet réseau du navigateur). Une requête plus
+longue que SLOW_REQUEST_MS est journalisée (logger ``products.timing``, une
+ligne JSON) avec ses SLOW_REQUEST_QUERIES requêtes SQL les plus lentes.
+
+Les requêtes SQL sont chronométrées par un execute wrapper (le mécanisme de
+``connection.execute_wrapper``) posé sur chaque connexion à sa création, ou au
+début de la requête pour une connexion déjà ouverte ; cela couvre aussi les
+threads de sync_to_async des vues asynchrones. La sérialisation et le rendu
+sont mesurés par span() dans compiled.py, views.py, async_views.py et
+renderers.py ; la sérialisation inclut les requêtes qu'elle lance (serializers
+imbriqués).
+
+Avec METRICS_ENABLED, chaque requête alimente aussi les métriques Prometheus
+(voir metrics.py).
+
+Désactivé (REQUEST_TIMING et METRICS_ENABLED faux, SLOW_REQUEST_MS à 0), le
+middleware se retire de la chaîne au démarrage, aucun wrapper n'est posé et
+span() se réduit à la lecture d'une ContextVar.
+"""
+import heapq
+import json
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.signals import request_started
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_current = ContextVar('request_timing', default=None)
+# Longueur maximale du SQL d'une requête dans le journal des requêtes lentes
+MAX_SQL_LENGTH = 2000
+
+
+class RequestTiming:
+    """ Mesures de la requête en cours, en millisecondes """
+
+    def __init__(self, top_queries=0, observe_query=None):
+        self.start = time.perf_counter()
+        self.view_start = None
+        self.spans = defaultdict(float)
+        self.sql_count = 0
+        self.top_queries = top_queries
+        self.observe_query = observe_query
+        # Tas des requêtes SQL les plus lentes : (durée, rang, sql)
+        self.queries = []
+
+    def add_query(self, sql, duration, alias):
+        self.sql_count += 1
+        self.spans['sql'] += duration
+        if self.observe_query is not None:
+            self.observe_query(alias, duration)
+        if self.top_queries:
+            item = (duration, self.sql_count, sql)
+            if len(self.queries) < self.top_queries:
+                heapq.heappush(self.queries, item)
+            else:
+                heapq.heappushpop(self.queries, item)
+
+    def finish(self):
+        """ Temps total, et temps de la vue hors rendu (depuis process_view) """
+        end = time.perf_counter()
+        self.spans['total'] = (end - self.start) * 1000
+        if self.view_start is not None:
+            self.spans['view'] = (end - self.view_start) * 1000 - self.spans['render']
+
+    def server_timing(self):
+        metrics = [f'sql;dur={self.spans["sql"]:.1f};desc="{self.sql_count} queries"']
+        metrics += [
+            f'{name};dur={self.spans[name]:.1f}'
+            for name in ('view', 'serialize', 'render', 'total') if name in self.spans
+        ]
+        return ', '.join(metrics)
+
+    def worst_queries(self):
+        return [
+            {'ms': round(duration, 2), 'sql': sql[:MAX_SQL_LENGTH]}
+            for duration, _, sql in sorted(self.queries, reverse=True)
+        ]
+
+
+@contextmanager
+def span(name):
+    """ Ajoute la durée du bloc à la mesure ``name`` de la requête en cours (si elle est mesurée) """
+    timing = _current.get()
+    if timing is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.spans[name] += (time.perf_counter() - start) * 1000
+
+
+def time_query(execute, sql, params, many, context):
+    timing = _current.get()
+    if timing is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timing.add_query(sql, (time.perf_counter() - start) * 1000, context['connection'].alias)
+
+
+def install_query_timer(sender=None, connection=None, **kwargs):
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+
+def install_query_timers(sender=None, **kwargs):
+    """ Chronomètre les connexions déjà ouvertes du thread qui va servir la requête """
+    for connection in connections.all(initialized_only=True):
+        install_query_timer(connection=connection)
+
+
+class ServerTimingMiddleware:
+    """ Mesure chaque requête : en-tête Server-Timing, journal des requêtes lentes et métriques """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.header = getattr(settings, 'REQUEST_TIMING', False)
+        self.slow_ms = getattr(settings, 'SLOW_REQUEST_MS', 0)
+        self.metrics = getattr(settings, 'METRICS_ENABLED', False)
+        if not (self.header or self.slow_ms or self.metrics):
+            raise MiddlewareNotUsed
+        self.top_queries = getattr(settings, 'SLOW_REQUEST_QUERIES', 5) if self.slow_ms else 0
+        # Les connexions sont propres à chaque thread : celles ouvertes avant
+        # l'activation sont prises au début de chaque requête
+        connection_created.connect(install_query_timer, dispatch_uid='products.timing')
+        request_started.connect(install_query_timers, dispatch_uid='products.timing')
+
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+            # Sinon le gestionnaire ASGI passerait par un thread pour l'appeler
+            self.process_view = self.aprocess_view
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timing, token = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(timing, request, response)
+
+    async def __acall__(self, request):
+        timing, token = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(timing, request, response)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        self.start_view()
+
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        self.start_view()
+
+    def start_view(self):
+        timing = _current.get()
+        if timing is not None:
+            timing.view_start = time.perf_counter()
+
+    def start(self):
+        if self.metrics:
+            metrics.request_started()
+        timing = RequestTiming(self.top_queries, metrics.observe_query if self.metrics else None)
+        return timing, _current.set(timing)
+
+    def finish(self, timing, request, response):
+        timing.finish()
+        if self.header:
+            response['Server-Timing'] = timing.server_timing()
+            response['Timing-Allow-Origin'] = '*'
+        if self.slow_ms and timing.spans['total'] >= self.slow_ms:
+            self.log_slow_request(timing, request, response)
+        if self.metrics:
+            metrics.observe_request(request, response, timing)
+        return response
+
+    def log_slow_request(self, timing, request, response):
+        record = {
+            'event': 'slow_request',
+            'method': request.method,
+            'path': request.path,
+            'query': request.META.get('QUERY_STRING', ''),
+            'status': response.status_code,
+            'sql_count': timing.sql_count,
+            **{f'{name}_ms': round(duration, 1) for name, duration in timing.spans.items()},
+            'worst_queries': timing.worst_queries(),
+        }
+        logger.warning(json.dumps(record, ensure_ascii=False), extra={'timing': record})
@@ -1,6 +1,7 @@
+from django.conf import settings
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from . import views
+from . import async_views, views
 from .views import OrderListView, OrderDetailView, CreateOrderView
 
 router = DefaultRouter()
@@ -17,5 +18,28 @@ urlpatterns = [
     path('wishlist/remove/<int:product_id>/', views.WishlistViewSet.as_view({'delete': 'remove'})),
     path('orders/', OrderListView.as_view(), name='order-list'),
     path('orders/create/', CreateOrderView.as_view(), name='order-create'),
+    path('orders/export/', views.OrderExportView.as_view(), name='order-export'),
     path('orders/<int:pk>/', OrderDetailView.as_view(), name='order-detail'),
 ]
+
+if settings.CATALOG_ASYNC_VIEWS:
+    # Déploiement ASGI : lectures du catalogue servies par les vues asynchrones,
+    # placées avant les routes du viewset qu'elles remplacent. Les autres actions
+    # de collection du viewset (low_stock, facets...) sont déclarées avant le
+    # motif de la fiche produit, qui les capturerait sinon.
+    list_actions = [
+        path(
+            f'products/{action.url_path}/',
+            views.ProductViewSet.as_view(dict(action.mapping), basename='product', detail=False, **action.kwargs),
+            name=f'product-{action.url_name}',
+        )
+        for action in views.ProductViewSet.get_extra_actions()
+        if not action.detail and action.url_path != 'featured'
+    ]
+    urlpatterns = [
+        path('products/', async_views.product_list, name='product-list'),
+        path('products/featured/', async_views.product_featured, name='product-featured'),
+        *list_actions,
+        path('products/<slug:slug>/', async_views.product_detail, name='product-detail'),
+        path('categories/', async_views.category_list, name='category-list'),
+    ] + urlpatterns
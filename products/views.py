@@ -2,57 +2,191 @@ from rest_framework import viewsets, permissions, status, filters
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
-from django.db.models import Q, Count
+from django.db.models import Count, Prefetch, prefetch_related_objects
 from django_filters.rest_framework import DjangoFilterBackend
-from .models import Category, Product, Review, Wishlist
+from . import metrics
+from .cache import cache_catalog_response
+from .compiled import CompiledSerializerMixin, compile_serializer
+from .conditional import conditional_catalog_response, latest_update
+from .models import Category, Product, ProductImage, ProductSimilarity, Review, Wishlist
 from .serializers import (
-    CategorySerializer, ProductSerializer, ReviewSerializer, WishlistSerializer
+    CategorySerializer, ProductSerializer, ProductListSerializer, ProductIdsSerializer, ReviewSerializer,
+    WishlistBulkSerializer, WishlistProductSerializer, WishlistSerializer, WISHLIST_PRODUCT_FIELDS
 )
 
+import hashlib
+import json
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+from django.utils import timezone
 from rest_framework import generics
-from .models import Order
+from .export import CSVRenderer, EXPORT_FORMATS, NDJSONRenderer
+from .models import IdempotencyKey, Order, OrderItem
+from .filters import FullTextSearchFilter, OrderExportFilter, export_cursor
+from .pagination import KeysetPagination
+from .replicas import ReplicaReadMixin
+from .sparse import SparseFieldsMixin, nested_selection
+from .timing import span
 from .serializers import OrderSerializer, CreateOrderSerializer
 
-class OrderListView(generics.ListAPIView):
+class OrderListView(CompiledSerializerMixin, generics.ListAPIView):
     """ Liste toutes les commandes """
-    queryset = Order.objects.all()
+    queryset = Order.objects.with_items()
     serializer_class = OrderSerializer
+    pagination_class = KeysetPagination
 
-class OrderDetailView(generics.RetrieveAPIView):
+class OrderDetailView(CompiledSerializerMixin, generics.RetrieveAPIView):
     """ Affiche une commande spécifique """
-    queryset = Order.objects.all()
+    queryset = Order.objects.with_items()
     serializer_class = OrderSerializer
 
+class OrderExportView(generics.GenericAPIView):
+    """
+    Export en flux des commandes et de leurs lignes, réservé au staff
+    (?format=csv ou ?format=ndjson), dans l'ordre (created_at, id). L'en-tête
+    X-Export-Cursor donne la valeur de ?after= pour n'exporter ensuite que les
+    nouvelles commandes.
+    """
+    queryset = Order.objects.with_items()
+    permission_classes = [permissions.IsAdminUser]
+    renderer_classes = [CSVRenderer, NDJSONRenderer]
+    filter_backends = [DjangoFilterBackend]
+    filterset_class = OrderExportFilter
+    chunk_size = 2000
+
+    def get(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        # Les commandes des dernières ORDER_EXPORT_SAFETY_LAG secondes attendent
+        # l'export suivant : une transaction encore ouverte peut valider une
+        # commande créée avant une autre déjà visible, que le curseur dépasserait
+        horizon = timezone.now() - timedelta(seconds=getattr(settings, 'ORDER_EXPORT_SAFETY_LAG', 60))
+        last = queryset.filter(created_at__lt=horizon).order_by('-created_at', '-id').values_list(
+            'created_at', 'id'
+        ).first()
+        if last is None:
+            orders = queryset.none()
+        else:
+            orders = queryset.filter(Q(created_at__lt=last[0]) | Q(created_at=last[0], id__lte=last[1]))
+        orders = orders.order_by('created_at', 'id').iterator(chunk_size=self.chunk_size)
+        export_format = request.accepted_renderer.format
+        rows, content_type = EXPORT_FORMATS[export_format]
+
+        response = StreamingHttpResponse(rows(orders), content_type=content_type)
+        response['Content-Disposition'] = (
+            f'attachment; filename="commandes-{timezone.now():%Y%m%d-%H%M%S}.{export_format}"'
+        )
+        response['X-Export-Cursor'] = export_cursor(*last) if last else request.query_params.get('after', '')
+        return response
+
 class CreateOrderView(generics.CreateAPIView):
-    """ Crée une nouvelle commande """
+    """
+    Crée une nouvelle commande. Avec un en-tête Idempotency-Key, une nouvelle
+    tentative portant la même clé renvoie la commande déjà créée au lieu d'en
+    créer une seconde.
+    """
     queryset = Order.objects.all()
     serializer_class = CreateOrderSerializer
+    idempotency_header = 'Idempotency-Key'
+
+    def create(self, request, *args, **kwargs):
+        key = request.headers.get(self.idempotency_header)
+        if not key:
+            return super().create(request, *args, **kwargs)
+        if len(key) > IdempotencyKey._meta.get_field('key').max_length:
+            return Response(
+                {'error': f"{self.idempotency_header} trop long"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        fingerprint = hashlib.sha256(
+            json.dumps(request.data, sort_keys=True, default=str).encode('utf-8')
+        ).hexdigest()
+        existing = IdempotencyKey.objects.select_related('order').filter(key=key).first()
+        if existing is not None:
+            return self.replay(existing, fingerprint)
 
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            with transaction.atomic():
+                order = serializer.save()
+                IdempotencyKey.objects.create(key=key, fingerprint=fingerprint, order=order)
+        except IntegrityError:
+            # Tentative concurrente avec la même clé : elle a gagné, on la rejoue
+            return self.replay(IdempotencyKey.objects.select_related('order').get(key=key), fingerprint)
+        headers = self.get_success_headers(serializer.data)
+        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
 
-class CategoryViewSet(viewsets.ReadOnlyModelViewSet):
+    def replay(self, idempotency_key, fingerprint):
+        if idempotency_key.fingerprint != fingerprint:
+            return Response(
+                {'error': f"{self.idempotency_header} déjà utilisée pour une autre commande"},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY
+            )
+        serializer = self.get_serializer(idempotency_key.order)
+        response = Response(serializer.data, status=status.HTTP_201_CREATED)
+        response['Idempotent-Replayed'] = 'true'
+        return response
+
+
+class CategoryViewSet(CompiledSerializerMixin, ReplicaReadMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Category.objects.filter(is_active=True)
     serializer_class = CategorySerializer
     lookup_field = 'slug'
+    cache_dependencies = (Category, Product, Review)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        # Le comptage des produits n'est calculé que s'il est servi (?fields=)
+        if self.action in ('list', 'retrieve') and self.selects('product_count'):
+            queryset = queryset.with_product_count()
+        return queryset
+
+    def get_last_modified(self, slug=None):
+        categories = Category.objects.filter(is_active=True)
+        if slug is None:
+            return latest_update(categories, 'updated_at')
+        categories = categories.filter(slug=slug)
+        if self.action == 'products':
+            return latest_update(categories, 'updated_at', 'products__updated_at')
+        return latest_update(categories, 'updated_at')
+
+    @conditional_catalog_response
+    @cache_catalog_response
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @conditional_catalog_response
+    @cache_catalog_response
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
 
     @action(detail=True)
+    @conditional_catalog_response
+    @cache_catalog_response
     def products(self, request, slug=None):
         category = self.get_object()
-        products = Product.objects.filter(category=category, is_active=True)
-        page = self.paginate_queryset(products)
-        if page is not None:
-            serializer = ProductSerializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
-        serializer = ProductSerializer(products, many=True)
-        return Response(serializer.data)
+        products = Product.objects.for_listing().filter(category=category, is_active=True)
+        return self.list_response(products, ProductListSerializer)
 
-class ProductViewSet(viewsets.ReadOnlyModelViewSet):
+class ProductViewSet(CompiledSerializerMixin, ReplicaReadMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Product.objects.filter(is_active=True)
     serializer_class = ProductSerializer
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
+    pagination_class = KeysetPagination
+    list_actions = ('list', 'featured', 'similar', 'low_stock')
+    filter_backends = [DjangoFilterBackend, FullTextSearchFilter, filters.OrderingFilter]
     filterset_fields = ['category', 'is_featured', 'is_active']
     search_fields = ['name', 'description', 'ingredients']
     ordering_fields = ['created_at', 'price', 'name', 'stock']
     lookup_field = 'slug'
+    cache_dependencies = (Product, Category, ProductImage, Review, ProductSimilarity)
+    # Bornes des tranches de prix de /products/facets/
+    price_facet_bounds = (Decimal('20'), Decimal('50'), Decimal('100'))
 
     def get_queryset(self):
         queryset = super().get_queryset()
@@ -67,37 +201,87 @@ class ProductViewSet(viewsets.ReadOnlyModelViewSet):
         if in_stock:
             queryset = queryset.filter(stock__gt=0)
 
+        if self.action in self.list_actions:
+            queryset = queryset.for_listing()
+        elif self.action in ('retrieve', 'by_slug'):
+            queryset = queryset.for_detail()
         return queryset
 
+    def get_serializer_class(self):
+        if self.action in self.list_actions:
+            return ProductListSerializer
+        return super().get_serializer_class()
+
+    def get_last_modified(self, slug=None):
+        queryset = self.filter_queryset(self.get_queryset())
+        if slug is not None:
+            queryset = queryset.filter(slug=slug)
+        elif self.action == 'featured':
+            queryset = queryset.filter(is_featured=True)
+        return latest_update(queryset, 'updated_at', 'category__updated_at')
+
+    @conditional_catalog_response
+    @cache_catalog_response
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @conditional_catalog_response
+    @cache_catalog_response
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
     @action(detail=False)
+    @conditional_catalog_response
+    @cache_catalog_response
     def featured(self, request):
-        featured = self.get_queryset().filter(is_featured=True)
-        page = self.paginate_queryset(featured)
-        if page is not None:
-            serializer = self.get_serializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
-        serializer = self.get_serializer(featured, many=True)
-        return Response(serializer.data)
+        return self.list_response(self.get_queryset().filter(is_featured=True))
+
+    @action(detail=False)
+    @conditional_catalog_response
+    @cache_catalog_response
+    def facets(self, request):
+        """ Effectifs par catégorie, tranche de prix, stock et mise en avant pour les filtres courants """
+        queryset = self.filter_queryset(self.get_queryset())
+        return Response(queryset.facet_counts(self.price_facet_bounds))
 
     @action(detail=True)
+    @cache_catalog_response
     def similar(self, request, slug=None):
         product = self.get_object()
-        similar = Product.objects.filter(
-            Q(category=product.category) | 
-            Q(ingredients__icontains=product.ingredients)
-        ).exclude(id=product.id)[:5]
+        similar = self.restrict_queryset(Product.objects.for_listing().filter(
+            neighbour_of__product=product, is_active=True
+        )).order_by('-neighbour_of__score')[:5]
+        if not similar:
+            # Index pas encore calculé pour ce produit : même catégorie
+            similar = self.restrict_queryset(Product.objects.for_listing().filter(
+                category=product.category_id, is_active=True
+            )).exclude(id=product.id)[:5]
         serializer = self.get_serializer(similar, many=True)
-        return Response(serializer.data)
+        with span('serialize'):
+            return Response(serializer.data)
 
     @action(detail=False)
     def low_stock(self, request):
         if not request.user.is_staff:
             return Response(status=status.HTTP_403_FORBIDDEN)
-        products = self.get_queryset().filter(stock__lte=10).order_by('stock')
+        products = self.restrict_queryset(self.get_queryset().filter(stock__lte=10)).order_by('stock')
         serializer = self.get_serializer(products, many=True)
-        return Response(serializer.data)
+        with span('serialize'):
+            return Response(serializer.data)
 
-    @action(detail=True, methods=['post'])
+    @action(detail=True)
+    def reviews(self, request, slug=None):
+        product = self.get_object()
+        reviews = Review.objects.filter(product=product).select_related('user').order_by('-created_at', '-id')
+        page = self.paginate_queryset(reviews)
+        serializer = ReviewSerializer(reviews if page is None else page, many=True)
+        with span('serialize'):
+            data = serializer.data
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
+
+    @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated])
     def review(self, request, slug=None):
         product = self.get_object()
         serializer = ReviewSerializer(data=request.data)
@@ -109,9 +293,10 @@ class ProductViewSet(viewsets.ReadOnlyModelViewSet):
                     status=status.HTTP_400_BAD_REQUEST
                 )
             
-            # Vérifier si l'utilisateur a acheté le produit
-            has_purchased = OrderItem.objects.filter(
-                order__user=request.user,
+            # Vérifier si l'utilisateur a acheté le produit (les commandes sont
+            # rattachées à l'adresse e-mail, pas au compte)
+            has_purchased = bool(request.user.email) and OrderItem.objects.filter(
+                order__email__iexact=request.user.email,
                 product=product
             ).exists()
             
@@ -120,31 +305,50 @@ class ProductViewSet(viewsets.ReadOnlyModelViewSet):
                 user=request.user,
                 is_verified_purchase=has_purchased
             )
+            metrics.REVIEWS_SUBMITTED.inc()
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     @action(detail=True)
     def by_slug(self, request, slug=None):
-        product = get_object_or_404(Product, slug=slug, is_active=True)
+        product = get_object_or_404(self.restrict_queryset(Product.objects.for_detail()), slug=slug, is_active=True)
         serializer = self.get_serializer(product)
-        return Response(serializer.data)
+        with span('serialize'):
+            return Response(serializer.data)
 
-class WishlistViewSet(viewsets.ModelViewSet):
+class WishlistViewSet(SparseFieldsMixin, viewsets.ModelViewSet):
     serializer_class = WishlistSerializer
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return Wishlist.objects.filter(user=self.request.user)
+        return Wishlist.objects.filter(user=self.request.user).prefetch_related(*self.get_product_prefetch())
 
     def get_object(self):
+        wishlist = self.get_wishlist()
+        prefetch_related_objects([wishlist], *self.get_product_prefetch())
+        return wishlist
+
+    def get_product_prefetch(self):
+        """ Produits préchargés, réduits aux champs demandés (?fields=products.name,...) """
+        if not self.selects('products'):
+            return []
+        fields, expand = nested_selection(*self.get_field_selection(), 'products')
+        projection = compile_serializer(ProductListSerializer, fields, expand)
+        return [Prefetch('products', queryset=projection.restrict(Product.objects.for_listing()))]
+
+    def get_wishlist(self):
+        """ Liste de souhaits de l'utilisateur, sans ses produits """
         wishlist, _ = Wishlist.objects.get_or_create(user=self.request.user)
         return wishlist
 
+    def wishlist_items(self):
+        return Wishlist.products.through.objects.filter(wishlist__user=self.request.user)
+
     @action(detail=False, methods=['post'])
     def add(self, request, product_id=None):
-        wishlist = self.get_object()
-        product = get_object_or_404(Product, id=product_id, is_active=True)
-        if product in wishlist.products.all():
+        wishlist = self.get_wishlist()
+        product = get_object_or_404(Product.objects.only('pk'), id=product_id, is_active=True)
+        if wishlist.products.filter(pk=product.pk).exists():
             return Response(
                 {'message': 'Ce produit est déjà dans votre liste de souhaits'},
                 status=status.HTTP_400_BAD_REQUEST
@@ -154,7 +358,59 @@ class WishlistViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=['delete'])
     def remove(self, request, product_id=None):
-        wishlist = self.get_object()
-        product = get_object_or_404(Product, id=product_id)
+        wishlist = self.get_wishlist()
+        product = get_object_or_404(Product.objects.only('pk'), id=product_id)
         wishlist.products.remove(product)
         return Response({'message': 'Produit retiré de la liste de souhaits'})
+
+    @action(detail=False, methods=['get', 'post'])
+    def contains(self, request):
+        """
+        Appartenance d'une page de produits à la liste de souhaits, en une
+        requête indexée : ?ids=1,2,3 ou {"product_ids": [1, 2, 3]} en POST.
+        """
+        if request.method == 'GET':
+            ids = [value for value in request.query_params.get('ids', '').split(',') if value]
+            data = {'product_ids': ids}
+        else:
+            data = request.data
+        serializer = ProductIdsSerializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        product_ids = serializer.validated_data['product_ids']
+        present = set(
+            self.wishlist_items().filter(product_id__in=product_ids).values_list('product_id', flat=True)
+        )
+        return Response({'in_wishlist': {product_id: product_id in present for product_id in product_ids}})
+
+    @action(detail=False, methods=['get'])
+    def items(self, request):
+        """ Contenu de la liste : identifiants et projection minimale des produits """
+        products = list(
+            Product.objects.filter(wishlist__user=request.user).only(*WISHLIST_PRODUCT_FIELDS).order_by('pk')
+        )
+        return Response({
+            'product_ids': [product.pk for product in products],
+            'products': WishlistProductSerializer(products, many=True, context={'request': request}).data,
+        })
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """ Ajoute et retire plusieurs produits en une requête : {"add": [...], "remove": [...]} """
+        serializer = WishlistBulkSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        to_add, to_remove = serializer.validated_data['add'], serializer.validated_data['remove']
+        wishlist = self.get_wishlist()
+        items = Wishlist.products.through.objects
+        with transaction.atomic():
+            if to_add:
+                active = Product.objects.filter(pk__in=to_add, is_active=True).values_list('pk', flat=True)
+                items.bulk_create(
+                    [items.model(wishlist=wishlist, product_id=product_id) for product_id in active],
+                    ignore_conflicts=True,
+                )
+            if to_remove:
+                items.filter(wishlist=wishlist, product_id__in=to_remove).delete()
+        product_ids = list(
+            items.filter(wishlist=wishlist).order_by('product_id').values_list('product_id', flat=True)
+        )
+        return Response({'product_ids': product_ids})